@@ -6,12 +6,13 @@ import stat
 import subprocess
 import sys
 import textwrap
+import threading
+import time
 import urllib
-import zipfile
 
 from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager
-from distutils import file_util, dir_util
+from distutils.sysconfig import get_python_lib
 
 from utils import IS_MAC, IS_WIN
 
@@ -20,27 +21,65 @@ if IS_MAC:
     from darwin_dyliber import fix_all_dylibs
 if IS_WIN:
     import pbs
-    from pbs import cd, glob
+    from pbs import cd
     git = pbs.Command("C:\\Program Files\\Git\\bin\\git.exe")
     python = pbs.Command("C:\\Python27\\python.exe")
-    mkdir = pbs.Command("C:\\Program Files\\Git\\bin\\mkdir.exe")
     make = pbs.Command("C:\\MinGW\\bin\\mingw32-make.exe")
-    cp = pbs.Command("C:\\Program Files\\Git\\bin\\cp.exe")
-    rm = pbs.Command("C:\\Program Files\\Git\\bin\\rm.exe")
-    find = pbs.Command("C:\\Program Files\\Git\\bin\\find.exe")
-    ln = pbs.Command("C:\\Program Files\\Git\\bin\\ln.exe")
-    tar = pbs.Command("C:\\Program Files\\Git\\bin\\tar.exe")
-    mv = pbs.Command("C:\\Program Files\\Git\\bin\\mv.exe")
 else:
-    from sh import git, cd, python, mkdir, make, cp, glob, rm
-    from sh import find, ln, tar, mv, strip
+    from sh import git, cd, python, make
 
-from depcollector import collect_deps
+import archiver
+import dedup
+import fastcopy
+import fileops
+import ziplib
+
+from depcollector import collect_deps, sources_digest, LEAP, THIRD_PARTY
+from treeprocess import process_tree, Delete, KeepOnly, Strip
+from workers import run_parallel
+
+
+# Everything that ends up inside the bundle, used by the actions that work
+# on the whole tree.
+BUNDLE = ("lib", "binaries", "plist", "launcher", "assets", "extension",
+          "misc", "config")
 
 
 class Action(object):
     __metaclass__ = ABCMeta
 
+    # Names of the resources that the action reads and writes. The actions
+    # that don't share any of them can run at the same time, "cwd" is used
+    # by the ones that change the current directory.
+    inputs = ()
+    outputs = ()
+
+    # Whether the action can be skipped when its fingerprint matches the one
+    # stamped by its last successful run.
+    stamped = True
+
+    # Whether the files that the action creates can be kept in the stage
+    # cache and restored, instead of running it, by any build with the same
+    # fingerprint.
+    cached = False
+
+    # Whether the action only prepares the sources the bundle is made from,
+    # those are run for real when a build is planned.
+    prepares_sources = False
+
+    # Whether the action changes the bundle only through fastcopy and
+    # fileops, so running it while fastcopy is planning plans it.
+    plannable = False
+
+    # Whether the fingerprint covers the state of every repository, for
+    # the actions that read them. The ones that digest what they use of
+    # the repositories themselves leave it out.
+    fingerprints_repos = True
+
+    # Whether the stamp is the fingerprint taken after the run instead of
+    # before it, for the actions whose fingerprint covers what they change.
+    stamps_after_run = False
+
     def __init__(self, name, basedir, skip=[], do=[]):
         self._name = name
         self._basedir = basedir
@@ -51,6 +90,10 @@ class Action(object):
     def name(self):
         return self._name
 
+    @property
+    def basedir(self):
+        return self._basedir
+
     @property
     def skip(self):
         return self._name in self._skip
@@ -61,14 +104,53 @@ class Action(object):
             return self._name in self._do
         return True
 
+    @property
+    def enabled(self):
+        return not self.skip and self.do
+
     @abstractmethod
     def run(self, *args, **kwargs):
         pass
 
+    def fingerprint(self, *args):
+        """
+        Return a digest of everything the run with the given args depends
+        on. The default covers the args and, for the actions that use the
+        repositories, the state of each of them.
+
+        :rtype: str
+        """
+        return self._digest(*args)
+
+    def plan(self, *args):
+        """
+        Add what the run with the given args would put in the bundle to
+        the current plan of fastcopy, without touching the bundle.
+        """
+        if self.plannable:
+            self.run(*args)
+
+    def _digest(self, *parts):
+        m = hashlib.sha256()
+        m.update(type(self).__name__)
+        for part in parts:
+            m.update(repr(part))
+        if self.fingerprints_repos and ("repos" in self.inputs or
+                                        "setup" in self.inputs):
+            m.update(repr(_repo_states(self._basedir)))
+        return m.hexdigest()
+
     def log(self, msg):
         print "{0}: {1}".format(self._name.upper(), msg)
 
 
+def _lines(lines):
+    """
+    Return the text of a file made of lines, each of them ended.
+    """
+    return "".join(line + "\n" for line in lines)
+
+
 def skippable(func):
     def skip_func(self, *args, **kwargs):
         if self.skip:
@@ -81,6 +163,50 @@ def skippable(func):
     return skip_func
 
 
+def _file_digest(path):
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def _tree_digest(path):
+    """
+    Return a digest of the names, sizes and modification times of all the
+    files under the given directory.
+    """
+    m = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            full = os.path.join(root, f)
+            try:
+                st = os.stat(full)
+            except OSError:  # e.g. a broken symlink
+                continue
+            m.update(repr((os.path.relpath(full, path), st.st_size,
+                           int(st.st_mtime))))
+    return m.hexdigest()
+
+
+def _repo_states(basedir):
+    """
+    Return the HEAD sha and a digest of the uncommitted changes of every git
+    working copy in basedir.
+    """
+    states = []
+    for repo in sorted(os.listdir(basedir)):
+        repo_path = os.path.join(basedir, repo)
+        if not os.path.isdir(os.path.join(repo_path, ".git")):
+            continue
+        repo_git = _git_in(repo_path)
+        head = repo_git("rev-parse", "HEAD").strip()
+        changes = hashlib.sha1(str(repo_git("diff", "HEAD"))).hexdigest()
+        states.append((repo, head, changes))
+    return states
+
+
 def platform_dir(basedir, *args):
     dir_ = os.path.join(basedir, "Bitmask", *args)
 
@@ -115,29 +241,127 @@ def get_version(repos, version):
                             m.hexdigest()[:8])
 
 
+# Seconds spent fetching each mirror by this process. When several versions
+# are built in one run each mirror is only fetched once.
+fetched_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def _develop_links(basedir):
+    """
+    Return the egg-links and easy-install.pth that setup.py develop wrote
+    in the site-packages of the virtualenv, with basedir left out so they
+    are the same for every version while they point at its own repos.
+    """
+    site_packages = get_python_lib()
+    links = []
+    for name in sorted(os.listdir(site_packages)):
+        if name.endswith(".egg-link") or name == "easy-install.pth":
+            with open(os.path.join(site_packages, name), 'r') as f:
+                links.append((name, f.read().replace(basedir, "<basedir>")))
+    return links
+
+
+def _fetch_mirror(mirror, repo, log):
+    """
+    Fetch the given mirror unless this process fetched it already.
+
+    If the fetch fails (e.g. there is no network) we go on with the refs
+    that the mirror already has.
+    """
+    with _mirrors_lock:
+        if mirror in fetched_mirrors:
+            return
+        fetched_mirrors[mirror] = 0.0
+
+    log("updating mirror for {0}".format(repo))
+    start = time.time()
+    try:
+        git("--git-dir", mirror, "fetch", "--quiet")
+    except Exception as e:
+        log("WARNING: could not update the {0} mirror, using the "
+            "refs it already has: {1!r}".format(repo, e))
+    fetched_mirrors[mirror] = time.time() - start
+
+
+def _git_in(repo_path):
+    """
+    Return a `git` command bound to the given working copy.
+
+    This avoids changing the current directory, which is shared by all the
+    threads of the process.
+    """
+    return git.bake("--git-dir", os.path.join(repo_path, ".git"),
+                    "--work-tree", repo_path)
+
+
 class GitCloneAll(Action):
+    inputs = ()
+    outputs = ("repos",)
+    prepares_sources = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "gitclone", basedir, skip, do)
+        self._mirrors_dir = None
 
     def _repo_url(self, repo_name):
         if repo_name == "leap_assets":
             return "git://leap.se/leap_assets"
         return "git://github.com/leapcode/{0}".format(repo_name)
 
-    @skippable
-    def run(self, sorted_repos):
-        self.log("cloning repositories...")
-        cd(self._basedir)
+    def _update_mirror(self, repo, log):
+        """
+        Create or update the local bare mirror for the given repo and return
+        its path.
+        """
+        mirror = os.path.join(self._mirrors_dir, repo + ".git")
+        if not os.path.isdir(mirror):
+            log("creating mirror for {0}".format(repo))
+            start = time.time()
+            git.clone("--mirror", self._repo_url(repo), mirror)
+            # the working copies borrow objects from the mirror, so the
+            # mirror must never prune them
+            git("--git-dir", mirror, "config", "gc.auto", "0")
+            with _mirrors_lock:
+                fetched_mirrors[mirror] = time.time() - start
+        else:
+            _fetch_mirror(mirror, repo, log)
+        return mirror
+
+    def _clone(self, repo, log):
+        log("cloning {0}".format(repo))
+        repo_path = os.path.join(self._basedir, repo)
+        fileops.rm_rf(repo_path)
+        if self._mirrors_dir is None:
+            git.clone(self._repo_url(repo), repo_path)
+        else:
+            mirror = self._update_mirror(repo, log)
+            git.clone("--quiet", "--shared", mirror, repo_path)
+        log("cloned {0}".format(repo))
 
-        for repo in sorted_repos:
-            self.log("cloning {0}".format(repo))
-            rm("-rf", repo)
-            git.clone(self._repo_url(repo), repo)
+    def fingerprint(self, sorted_repos, jobs=1, mirrors_dir=None):
+        present = [os.path.isdir(os.path.join(self._basedir, repo, ".git"))
+                   for repo in sorted_repos]
+        return self._digest(sorted_repos, mirrors_dir, present)
 
+    @skippable
+    def run(self, sorted_repos, jobs=1, mirrors_dir=None):
+        self.log("cloning repositories...")
+        self._mirrors_dir = mirrors_dir
+        if mirrors_dir is not None and not os.path.isdir(mirrors_dir):
+            os.makedirs(mirrors_dir)
+        run_parallel(self._clone, sorted_repos, jobs, self.log)
         self.log("done cloning repos.")
 
 
 class GitCheckout(Action):
+    inputs = ("repos",)
+    outputs = ("repos",)
+    prepares_sources = True
+
+    # always fetch, the actions after it notice if a repo changed
+    stamped = False
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "gitcheckout", basedir, skip, do)
 
@@ -146,35 +370,56 @@ class GitCheckout(Action):
             return "git://leap.se/leap_assets"
         return "git://github.com/leapcode/{0}".format(repo_name)
 
+    def _checkout(self, repo_where, log):
+        repo, where = repo_where
+        log("Checkout {0} -> {1}".format(repo, where))
+
+        repo_git = _git_in(os.path.join(self._basedir, repo))
+
+        # refresh the mirror this repo was cloned from, if any
+        origin = repo_git.config("remote.origin.url").strip()
+        if os.path.isdir(origin):
+            _fetch_mirror(origin, repo, log)
+
+        repo_git.fetch()
+        repo_git.checkout("--quiet", where)
+
+        # just in case that we didn't just cloned but updated:
+        repo_git.reset("--hard", where)
+
+    def fingerprint(self, sorted_repos, versions_file, jobs=1):
+        return self._digest(sorted_repos, _file_digest(versions_file))
+
     @skippable
-    def run(self, sorted_repos, versions_file):
+    def run(self, sorted_repos, versions_file, jobs=1):
         self.log("`git checkout` repositories...")
 
         versions = None
         with open(versions_file, 'r') as f:
             versions = json.load(f)
 
-        cd(self._basedir)
-
+        to_checkout = []
         for repo in sorted_repos:
             if repo not in versions:
                 self.log("skipping {0}, no version specified.".format(repo))
                 continue
 
             where = versions[repo]  # where to checkout
-            self.log("Checkout {0} -> {1}".format(repo, where))
-
-            with push_pop(repo):
-                git.fetch()
-                git.checkout("--quiet", where)
+            to_checkout.append((repo, where))
 
-                # just in case that we didn't just cloned but updated:
-                git.reset("--hard", where)
+        run_parallel(self._checkout, to_checkout, jobs, self.log)
 
         self.log("done checking out repos.")
 
 
 class PythonSetupAll(Action):
+    inputs = ("repos",)
+    outputs = ("setup", "cwd")
+    prepares_sources = True
+    # the virtualenv is shared by the builds of every version, the ones
+    # run since point it at their own repos
+    stamps_after_run = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "pythonsetup", basedir, skip, do)
 
@@ -190,6 +435,10 @@ class PythonSetupAll(Action):
             self._basedir, repo, "pkg", "linux", "bitmask-root")
         python("setup.py", "hash_binaries")
 
+    def fingerprint(self, sorted_repos, binaries_path):
+        return self._digest(sorted_repos, _tree_digest(binaries_path),
+                            _develop_links(self._basedir))
+
     @skippable
     def run(self, sorted_repos, binaries_path):
         cd(self._basedir)
@@ -216,17 +465,18 @@ class PythonSetupAll(Action):
                     sys.path.append(os.path.join(self._basedir, repo, "src"))
 
 
-def _convert_path_for_win(path):
-    npath = path
-    if IS_WIN:
-        npath = path.replace("\\", "/")
-    return npath
-
-
 class CreateDirStructure(Action):
+    inputs = ()
+    outputs = ("tree",)
+    plannable = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "createdirs", basedir, skip, do)
 
+    def fingerprint(self):
+        # the whole tree needs to be redone if it is not there anymore
+        return self._digest(os.path.isdir(self._basedir))
+
     @skippable
     def run(self):
         self.log("creating directory structure...")
@@ -240,154 +490,174 @@ class CreateDirStructure(Action):
         self.log("done.")
 
     def _create_dir_structure(self, basedir):
-        mkdirp = mkdir.bake("-p")
         apps = os.path.join(basedir, "apps")
-        mkdirp(_convert_path_for_win(apps))
         if IS_WIN:
-            mkdirp(_convert_path_for_win(os.path.join(apps, "eip")))
+            fileops.mkdir_p(os.path.join(apps, "eip"))
         else:
-            mkdirp(_convert_path_for_win(os.path.join(apps, "eip", "files")))
-        mkdirp(_convert_path_for_win(os.path.join(apps, "mail")))
-        mkdirp(_convert_path_for_win(os.path.join(basedir, "lib")))
+            fileops.mkdir_p(os.path.join(apps, "eip", "files"))
+        fileops.mkdir_p(os.path.join(apps, "mail"),
+                        os.path.join(basedir, "lib"))
 
     def _darwin_create_dir_structure(self):
-        mkdirp = mkdir.bake("-p")
         app_path = os.path.join(self._basedir, "Bitmask.app")
-        mkdirp(app_path)
-        mkdirp(os.path.join(app_path, "Contents", "MacOS"))
-        mkdirp(os.path.join(app_path, "Contents", "Resources"))
-        mkdirp(os.path.join(app_path, "Contents", "PlugIns"))
-        mkdirp(os.path.join(app_path, "Contents", "StartupItems"))
-        ln("-s", "/Applications", os.path.join(self._basedir, "Applications"))
+        fileops.mkdir_p(os.path.join(app_path, "Contents", "MacOS"),
+                        os.path.join(app_path, "Contents", "Resources"),
+                        os.path.join(app_path, "Contents", "PlugIns"),
+                        os.path.join(app_path, "Contents", "StartupItems"))
+        fileops.symlink("/Applications",
+                        os.path.join(self._basedir, "Applications"))
 
 
 class CollectAllDeps(Action):
-    def __init__(self, basedir, skip, do):
-        Action.__init__(self, "collectdeps", basedir, skip, do)
-
-    def _remove_unneeded(self, lib_dir):
-        self.log("removing unneeded files...")
-        files = find(lib_dir).strip().splitlines()
-        keep = ["QtCore.so",
-                "QtGui.so",
-                "__init__.py",
-                "_utils.py",
-                "PySide",
-                ""]  # empty means the whole pyside dir
-        if IS_WIN:
-            keep = ["QtCore4.dll",
-                    "QtGui4.dll",
-                    "__init__.py",
-                    "_utils.py",
-                    "PySide",
-                    "QtGui.pyd",
-                    "QtCore.pyd",
-                    ""]  # empty means the whole pyside dir
-        for f in files:
-            if f.find("PySide") > 0:
-                if os.path.split(f)[1] not in keep:
-                    rm("-rf", f)
-                    pass
-        self.log("done.")
+    """
+    Copy the third party modules the app imports, from the virtualenv, to
+    the lib dir. The leap packages are copied by CollectLeapDeps, so the
+    stage cache reuses this part between versions that only differ in
+    those.
+    """
+    inputs = ("setup", "tree")
+    outputs = ("lib",)
+    cached = True
+    plannable = True
+    # the files copied are digested instead
+    fingerprints_repos = False
+
+    part = THIRD_PARTY
+
+    def __init__(self, basedir, skip, do, name="collectdeps"):
+        Action.__init__(self, name, basedir, skip, do)
+
+    def _app_py(self):
+        return os.path.join(self._basedir,
+                            "bitmask_client",
+                            "src",
+                            "leap",
+                            "bitmask",
+                            "app.py")
+
+    def _cache_file(self):
+        return os.path.join(self._basedir, ".depcache.json")
+
+    def fingerprint(self, path_file, prune=False, keep=()):
+        # the entry in the stage cache is shared by the builds of every
+        # version, the files of the part that are copied count too
+        # and where the virtualenv finds the repos
+        return self._digest(_file_digest(path_file), prune, keep,
+                            _develop_links(self._basedir),
+                            sources_digest(self._app_py(), path_file,
+                                           self._cache_file(), self.part))
 
     @skippable
-    def run(self, path_file):
-        self.log("collecting dependencies...")
-        app_py = os.path.join(self._basedir,
-                              "bitmask_client",
-                              "src",
-                              "leap",
-                              "bitmask",
-                              "app.py")
+    def run(self, path_file, prune=False, keep=()):
+        self.log("collecting {0} dependencies...".format(self.part))
         dest_lib_dir = platform_dir(self._basedir, "lib")
-        collect_deps(app_py, dest_lib_dir, path_file)
-
-        self._remove_unneeded(dest_lib_dir)
+        collect_deps(self._app_py(), dest_lib_dir, path_file,
+                     self._cache_file(), prune, keep, self.part)
         self.log("done.")
 
 
+class CollectLeapDeps(CollectAllDeps):
+    """
+    Copy the leap packages, from the repositories, to the lib dir.
+    """
+    part = LEAP
+
+    def __init__(self, basedir, skip, do):
+        CollectAllDeps.__init__(self, basedir, skip, do, "collectleap")
+
+
 class CopyBinaries(Action):
+    inputs = ("tree",)
+    # the libraries go into lib too, with what CollectAllDeps copies
+    outputs = ("binaries", "lib")
+    cached = True
+    plannable = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "copybinaries", basedir, skip, do)
 
+    def fingerprint(self, binaries_path):
+        return self._digest(_tree_digest(binaries_path))
+
     @skippable
     def run(self, binaries_path):
         self.log("copying binaries...")
         dest_lib_dir = platform_dir(self._basedir, "lib")
 
         if IS_MAC:
-            cp(glob(os.path.join(binaries_path, "Qt*")), dest_lib_dir)
-            cp(glob(os.path.join(binaries_path, "*.dylib")), dest_lib_dir)
-            cp(glob(os.path.join(binaries_path, "Python")), dest_lib_dir)
+            fastcopy.copy_glob(os.path.join(binaries_path, "Qt*"),
+                               dest_lib_dir)
+            fastcopy.copy_glob(os.path.join(binaries_path, "*.dylib"),
+                               dest_lib_dir)
+            fastcopy.copy_glob(os.path.join(binaries_path, "Python"),
+                               dest_lib_dir)
             resources_dir = os.path.join(self._basedir,
                                          "Bitmask",
                                          "Bitmask.app",
                                          "Contents",
                                          "Resources")
-            cp(glob(os.path.join(binaries_path, "openvpn.leap*")),
-               resources_dir)
-
-            mkdir("-p", os.path.join(resources_dir, "openvpn"))
-            cp("-r", glob(os.path.join(binaries_path, "openvpn.files", "*")),
-               os.path.join(resources_dir, "openvpn"))
-
-            cp(os.path.join(binaries_path, "cocoasudo"), resources_dir)
-
-            cp("-r", os.path.join(binaries_path, "qt_menu.nib"), resources_dir)
-            cp("-r", os.path.join(binaries_path, "tuntap-installer.app"),
-               resources_dir)
-            cp(os.path.join(binaries_path, "Bitmask"),
-               platform_dir(self._basedir))
+            fastcopy.copy_glob(os.path.join(binaries_path, "openvpn.leap*"),
+                               resources_dir)
+
+            fileops.mkdir_p(os.path.join(resources_dir, "openvpn"))
+            fastcopy.copy_glob(
+                os.path.join(binaries_path, "openvpn.files", "*"),
+                os.path.join(resources_dir, "openvpn"), recursive=True)
+
+            fastcopy.copy(os.path.join(binaries_path, "cocoasudo"),
+                          resources_dir)
+
+            fastcopy.copy(os.path.join(binaries_path, "qt_menu.nib"),
+                          resources_dir, recursive=True)
+            fastcopy.copy(os.path.join(binaries_path, "tuntap-installer.app"),
+                          resources_dir, recursive=True)
+            fastcopy.copy(os.path.join(binaries_path, "Bitmask"),
+                          platform_dir(self._basedir))
         elif IS_WIN:
-            root = _convert_path_for_win(
-                os.path.join(self._basedir, "Bitmask"))
-            for i in glob(os.path.join(binaries_path, "*.dll")):
-                cp(_convert_path_for_win(i),
-                   root)
+            root = os.path.join(self._basedir, "Bitmask")
+            fastcopy.copy_glob(os.path.join(binaries_path, "*.dll"), root)
             import win32com
             win32comext_path = os.path.split(win32com.__file__)[0] + "ext"
             shell_path = os.path.join(win32comext_path, "shell")
-            cp("-r",
-               _convert_path_for_win(shell_path),
-               _convert_path_for_win(os.path.join(dest_lib_dir, "win32com")))
-            cp(_convert_path_for_win(
-                os.path.join(binaries_path, "bitmask.exe")),
-               root)
-            cp(_convert_path_for_win(
-                os.path.join(binaries_path, "Microsoft.VC90.CRT.manifest")),
-               root)
-            cp(_convert_path_for_win(
-                os.path.join(binaries_path, "openvpn_leap.exe")),
-               _convert_path_for_win(
-                   os.path.join(root, "apps", "eip")))
-            cp(_convert_path_for_win(
-                os.path.join(binaries_path, "openvpn_leap.exe.manifest")),
-               _convert_path_for_win(
-                   os.path.join(root, "apps", "eip")))
-            cp("-r",
-               _convert_path_for_win(
-                   os.path.join(binaries_path, "tap_driver")),
-               _convert_path_for_win(
-                   os.path.join(root, "apps", "eip")))
+            fastcopy.copy(shell_path, os.path.join(dest_lib_dir, "win32com"),
+                          recursive=True)
+            fastcopy.copy(os.path.join(binaries_path, "bitmask.exe"), root)
+            fastcopy.copy(
+                os.path.join(binaries_path, "Microsoft.VC90.CRT.manifest"),
+                root)
+            fastcopy.copy(os.path.join(binaries_path, "openvpn_leap.exe"),
+                          os.path.join(root, "apps", "eip"))
+            fastcopy.copy(
+                os.path.join(binaries_path, "openvpn_leap.exe.manifest"),
+                os.path.join(root, "apps", "eip"))
+            fastcopy.copy(os.path.join(binaries_path, "tap_driver"),
+                          os.path.join(root, "apps", "eip"), recursive=True)
         else:
-            cp(glob(os.path.join(binaries_path, "*.so*")), dest_lib_dir)
-            cp(glob(os.path.join(binaries_path, "libQt*.non-ubuntu")), dest_lib_dir)
+            fastcopy.copy_glob(os.path.join(binaries_path, "*.so*"),
+                               dest_lib_dir)
+            fastcopy.copy_glob(
+                os.path.join(binaries_path, "libQt*.non-ubuntu"),
+                dest_lib_dir)
 
             eip_dir = platform_dir(self._basedir, "apps", "eip")
             # cp(os.path.join(binaries_path, "openvpn"), eip_dir)
 
-            cp("-r", glob(os.path.join(binaries_path, "openvpn.files", "*")),
-               os.path.join(eip_dir, "files"))
-            cp(os.path.join(binaries_path, "bitmask"),
-               platform_dir(self._basedir))
+            fastcopy.copy_glob(
+                os.path.join(binaries_path, "openvpn.files", "*"),
+                os.path.join(eip_dir, "files"), recursive=True)
+            fastcopy.copy(os.path.join(binaries_path, "bitmask"),
+                          platform_dir(self._basedir))
 
         mail_dir = platform_dir(self._basedir, "apps", "mail")
-        cp(_convert_path_for_win(os.path.join(binaries_path, "gpg")),
-           _convert_path_for_win(mail_dir))
+        fastcopy.copy(os.path.join(binaries_path, "gpg"), mail_dir)
         self.log("done.")
 
 
 class PLister(Action):
+    inputs = ("tree",)
+    outputs = ("plist",)
+    plannable = True
+
     plist = textwrap.dedent("""\
         <?xml version="1.0" encoding="UTF-8"?>
         <!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
@@ -425,36 +695,47 @@ class PLister(Action):
     @skippable
     def run(self):
         self.log("generating Info.plist file...")
-        file_util.write_file(os.path.join(self._basedir,
-                                          "Bitmask",
-                                          "Bitmask.app",
-                                          "Contents",
-                                          "Info.plist"),
-                             self.plist)
+        fastcopy.write_file(os.path.join(self._basedir,
+                                         "Bitmask",
+                                         "Bitmask.app",
+                                         "Contents",
+                                         "Info.plist"),
+                            _lines(self.plist))
         self.log("generating qt.conf file...")
-        file_util.write_file(os.path.join(self._basedir,
-                                          "Bitmask",
-                                          "Bitmask.app",
-                                          "Contents",
-                                          "Resources",
-                                          "qt.conf"),
-                             self.qtconf)
+        fastcopy.write_file(os.path.join(self._basedir,
+                                         "Bitmask",
+                                         "Bitmask.app",
+                                         "Contents",
+                                         "Resources",
+                                         "qt.conf"),
+                            self.qtconf + "\n")
         self.log("done.")
 
 
 class SeededConfig(Action):
+    inputs = ("tree",)
+    outputs = ("config",)
+    plannable = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "seededconfig", basedir, skip, do)
 
+    def fingerprint(self, seeded_config):
+        return self._digest(_tree_digest(seeded_config))
+
     @skippable
     def run(self, seeded_config):
         self.log("copying seeded config...")
-        dir_util.copy_tree(seeded_config,
+        fastcopy.copy_tree(seeded_config,
                            platform_dir(self._basedir, "config"))
         self.log("done.")
 
 
 class DarwinLauncher(Action):
+    inputs = ("tree",)
+    outputs = ("launcher",)
+    plannable = True
+
     launcher = textwrap.dedent(
         """\
         #!/bin/bash
@@ -482,14 +763,18 @@ class DarwinLauncher(Action):
                                      "Contents",
                                      "MacOS",
                                      "bitmask-launcher")
-        file_util.write_file(launcher_path, self.launcher)
-        os.chmod(launcher_path, stat.S_IRGRP | stat.S_IROTH | stat.S_IRUSR
-                 | stat.S_IWGRP | stat.S_IWOTH | stat.S_IWUSR
-                 | stat.S_IXGRP | stat.S_IXOTH | stat.S_IXUSR)
+        fastcopy.write_file(launcher_path, _lines(self.launcher),
+                            stat.S_IRGRP | stat.S_IROTH | stat.S_IRUSR
+                            | stat.S_IWGRP | stat.S_IWOTH | stat.S_IWUSR
+                            | stat.S_IXGRP | stat.S_IXOTH | stat.S_IXUSR)
         self.log("done.")
 
 
 class CopyAssets(Action):
+    inputs = ("repos", "tree")
+    outputs = ("assets",)
+    plannable = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "copyassets", basedir, skip, do)
 
@@ -501,14 +786,20 @@ class CopyAssets(Action):
                                      "Bitmask.app",
                                      "Contents",
                                      "Resources")
-        cp(os.path.join(self._basedir, "leap_assets", "mac", "bitmask.icns"),
-           resources_dir)
-        cp(os.path.join(self._basedir, "leap_assets", "mac", "bitmask.tiff"),
-           resources_dir)
+        fastcopy.copy(os.path.join(self._basedir, "leap_assets", "mac",
+                                   "bitmask.icns"),
+                      resources_dir)
+        fastcopy.copy(os.path.join(self._basedir, "leap_assets", "mac",
+                                   "bitmask.tiff"),
+                      resources_dir)
         self.log("done.")
 
 
 class CopyMisc(Action):
+    inputs = ("setup", "tree", "lib")
+    outputs = ("misc",)
+    plannable = True
+
     TUF_CONFIG = textwrap.dedent("""\
         [General]
         updater_delay = 60
@@ -521,42 +812,33 @@ class CopyMisc(Action):
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "copymisc", basedir, skip, do)
 
+    def fingerprint(self, binary_path, tuf_repo):
+        return self._digest(_tree_digest(binary_path), tuf_repo)
+
     @skippable
     def run(self, binary_path, tuf_repo):
-        self.log("downloading thunderbird extension...")
-        ext_path = platform_dir(self._basedir, "apps",
-                                "bitmask-thunderbird-latest.xpi")
-        urllib.urlretrieve(
-            "https://downloads.leap.se/thunderbird_extension/"
-            "bitmask-thunderbird-latest.xpi",
-            ext_path)
-        self.log("done")
         self.log("copying misc files...")
-        apps_dir = _convert_path_for_win(platform_dir(self._basedir, "apps"))
-        cp(_convert_path_for_win(
-            os.path.join(self._basedir, "bitmask_launcher", "src",
-                         "launcher.py")),
-           apps_dir)
-        cp("-r",
-           _convert_path_for_win(os.path.join(self._basedir, "bitmask_client",
-                                              "src", "leap")),
-           apps_dir)
-        lib_dir = _convert_path_for_win(platform_dir(self._basedir, "lib"))
-        cp(_convert_path_for_win(
-            os.path.join(self._basedir,
-                         "leap_pycommon",
-                         "src", "leap", "common", "cacert.pem")),
-           _convert_path_for_win(os.path.join(lib_dir, "leap", "common")))
-        cp(_convert_path_for_win(glob(os.path.join(self._basedir,
-                                                   "bitmask_client", "build",
-                                                   "lib*", "leap", "bitmask",
-                                                   "_version.py"))[0]),
-           os.path.join(apps_dir, "leap", "bitmask"))
-
-        cp(_convert_path_for_win(
-            os.path.join(self._basedir,
-                         "bitmask_client", "release-notes.rst")),
-           _convert_path_for_win(os.path.join(self._basedir, "Bitmask")))
+        apps_dir = platform_dir(self._basedir, "apps")
+        fastcopy.copy(os.path.join(self._basedir, "bitmask_launcher", "src",
+                                   "launcher.py"),
+                      apps_dir)
+        fastcopy.copy(os.path.join(self._basedir, "bitmask_client",
+                                   "src", "leap"),
+                      apps_dir, recursive=True)
+        lib_dir = platform_dir(self._basedir, "lib")
+        fastcopy.copy(os.path.join(self._basedir,
+                                   "leap_pycommon",
+                                   "src", "leap", "common", "cacert.pem"),
+                      os.path.join(lib_dir, "leap", "common"))
+        fastcopy.copy_glob(os.path.join(self._basedir,
+                                        "bitmask_client", "build",
+                                        "lib*", "leap", "bitmask",
+                                        "_version.py"),
+                           os.path.join(apps_dir, "leap", "bitmask"))
+
+        fastcopy.copy(os.path.join(self._basedir,
+                                   "bitmask_client", "release-notes.rst"),
+                      os.path.join(self._basedir, "Bitmask"))
 
         launcher_path = os.path.join(self._basedir, "Bitmask", "launcher.conf")
 
@@ -570,28 +852,68 @@ class CopyMisc(Action):
             tuf_config = None
 
         if tuf_config is not None:
-            with open(launcher_path, "w") as f:
-                f.write(tuf_config)
+            fastcopy.write_file(launcher_path, tuf_config)
 
         metadata = os.path.join(self._basedir, "Bitmask", "repo", "metadata")
-        mkdir("-p", os.path.join(metadata, "current"))
-        mkdir("-p", os.path.join(metadata, "previous"))
-        cp(os.path.join(binary_path, "root.json"),
-           os.path.join(metadata, "current"))
+        fileops.mkdir_p(os.path.join(metadata, "current"),
+                        os.path.join(metadata, "previous"))
+        fastcopy.copy(os.path.join(binary_path, "root.json"),
+                      os.path.join(metadata, "current"))
 
         self.log("done")
 
 
+class ThunderbirdExtension(Action):
+    inputs = ("tree",)
+    outputs = ("extension",)
+
+    def __init__(self, basedir, skip, do):
+        # this is part of the 'copymisc' step, it is split from CopyMisc
+        # since the download does not depend on the collected files
+        Action.__init__(self, "copymisc", basedir, skip, do)
+
+    URL = ("https://downloads.leap.se/thunderbird_extension/"
+           "bitmask-thunderbird-latest.xpi")
+
+    # always download the latest, the actions after it notice if it changed
+    stamped = False
+
+    def _ext_path(self):
+        return platform_dir(self._basedir, "apps",
+                            "bitmask-thunderbird-latest.xpi")
+
+    def fingerprint(self):
+        path = self._ext_path()
+        return self._digest(_file_digest(path) if os.path.isfile(path)
+                            else None)
+
+    def plan(self):
+        # the size is only known once downloaded
+        fastcopy.current_plan().add(self.URL, self._ext_path(), None)
+
+    @skippable
+    def run(self):
+        self.log("downloading thunderbird extension...")
+        urllib.urlretrieve(self.URL, self._ext_path())
+        self.log("done")
+
+
 class FixDylibs(Action):
+    inputs = ("lib", "binaries")
+    outputs = ("lib", "binaries")
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "fixdylibs", basedir, skip, do)
 
     @skippable
-    def run(self):
-        fix_all_dylibs(platform_dir(self._basedir))
+    def run(self, jobs=4):
+        fix_all_dylibs(platform_dir(self._basedir), jobs)
 
 
 class DmgIt(Action):
+    inputs = BUNDLE + ("repos",)
+    outputs = ("tree", "package", "cwd")
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "dmgit", basedir, skip, do)
 
@@ -602,14 +924,17 @@ class DmgIt(Action):
         version = get_version(repos, nightly)
         dmg_dir = os.path.join(self._basedir, "dmg")
         template_dir = os.path.join(self._basedir, "Bitmask")
-        mkdir("-p", dmg_dir)
-        cp("-R", os.path.join(template_dir, "Applications"), dmg_dir)
-        cp("-R", os.path.join(template_dir, "release-notes.rst"), dmg_dir)
-        cp("-R", os.path.join(template_dir, "Bitmask.app"), dmg_dir)
-        cp(os.path.join(self._basedir,
-                        "leap_assets",
-                        "mac", "bitmask.icns"),
-           os.path.join(dmg_dir, ".VolumeIcon.icns"))
+        fileops.mkdir_p(dmg_dir)
+        fileops.cp(os.path.join(template_dir, "Applications"), dmg_dir,
+                   recursive=True)
+        fileops.cp(os.path.join(template_dir, "release-notes.rst"), dmg_dir,
+                   recursive=True)
+        fileops.cp(os.path.join(template_dir, "Bitmask.app"), dmg_dir,
+                   recursive=True)
+        fileops.cp(os.path.join(self._basedir,
+                                "leap_assets",
+                                "mac", "bitmask.icns"),
+                   os.path.join(dmg_dir, ".VolumeIcon.icns"))
         SetFile("-c", "icnC", os.path.join(dmg_dir, ".VolumeIcon.icns"))
 
         vol_name = "Bitmask"
@@ -621,58 +946,174 @@ class DmgIt(Action):
                 "-fsargs", "-c c=64,a=16,e=16", "-fs", "HFS+",
                 "-format", "UDRW", "-ov", "-size", "500000k",
                 raw_dmg_path)
-        rm("-rf", dmg_dir)
-        mkdir(dmg_dir)
+        fileops.rm_rf(dmg_dir)
+        os.mkdir(dmg_dir)
         hdiutil("attach", raw_dmg_path, "-mountpoint", dmg_dir)
         SetFile("-a", "C", dmg_dir)
         hdiutil("detach", dmg_dir)
 
-        rm("-rf", dmg_dir)
+        fileops.rm_rf(dmg_dir)
         hdiutil("convert", raw_dmg_path, "-format", "UDZO",
                 "-imagekey", "zlib-level=9", "-o",
                 dmg_path)
-        rm("-f", raw_dmg_path)
+        fileops.rm_rf(raw_dmg_path)
         self.log("Done")
 
 
 class TarballIt(Action):
+    inputs = BUNDLE + ("repos",)
+    outputs = ("package", "cwd")
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "tarballit", basedir, skip, do)
 
     @skippable
-    def run(self, repos, nightly):
+    def run(self, repos, nightly, codec="bz2", jobs=None, dedup_files=False):
         self.log("Tarballing it...")
         cd(self._basedir)
         version = get_version(repos, nightly)
         import platform
         bits = platform.architecture()[0][:2]
         bundle_name = "Bitmask-linux%s-%s" % (bits, version)
-        mv("Bitmask", bundle_name)
-        tar("cjf", bundle_name+".tar.bz2", bundle_name)
+        bundle_dir = os.path.join(self._basedir, "Bitmask")
+        duplicates = None
+        if dedup_files:
+            duplicates = dedup.find_duplicates(bundle_dir)
+            dedup.report(duplicates, bundle_dir, self.log)
+            self.log("storing each of them once, the other copies are "
+                     "hardlinks")
+        tarball = os.path.join(self._basedir,
+                               bundle_name + archiver.extension(codec))
+        size, compressed = archiver.write_tarball(
+            bundle_dir, bundle_name, tarball, codec, jobs=jobs,
+            duplicates=duplicates)
+        self.log("{0}: {1} bytes compressed to {2} ({3:.1%})".format(
+            os.path.basename(tarball), size, compressed,
+            float(compressed) / max(size, 1)))
+        self.log("Done")
+
+
+class CleanBundle(Action):
+    """
+    Trim PySide, remove the .pyc files and the tests and strip the
+    libraries of the bundle in a single walk.
+
+    Each group of rules keeps the name of the action it used to be, so
+    `--skip` and `--do` choose which rules are applied.
+    """
+    inputs = BUNDLE
+    outputs = BUNDLE
+    plannable = True
+
+    def __init__(self, basedir, skip, do, remove_tests=False):
+        Action.__init__(self, "cleanbundle", basedir, skip, do)
+        # PySide used to be trimmed by CollectAllDeps
+        self._parts = ["collectdeps", "removepyc"]
+        if remove_tests:
+            self._parts.append("rmunused")
+
+    def _part_enabled(self, part):
+        if self._name in self._skip or part in self._skip:
+            return False
+        return (len(self._do) == 0 or self._name in self._do or
+                part in self._do)
+
+    @property
+    def skip(self):
+        return not any(self._part_enabled(p) for p in self._parts)
+
+    @property
+    def do(self):
+        return not self.skip
+
+    def _pyside_keep(self):
+        if IS_WIN:
+            return ["QtCore4.dll",
+                    "QtGui4.dll",
+                    "__init__.py",
+                    "_utils.py",
+                    "PySide",
+                    "QtGui.pyd",
+                    "QtCore.pyd"]
+        return ["QtCore.so",
+                "QtGui.so",
+                "__init__.py",
+                "_utils.py",
+                "PySide"]
+
+    def rules(self):
+        """
+        Return the rules of the enabled parts, in the order they are tried
+        on each entry.
+        """
+        rules = []
+        if self._part_enabled("collectdeps"):
+            rules.append(KeepOnly("pyside", os.path.join("lib", "PySide"),
+                                  self._pyside_keep()))
+        if self._part_enabled("rmunused"):
+            # before strip, the libraries of the tests are just deleted
+            rules.append(Delete("tests", ["*test*"], dirs=True))
+            # twisted_used = ["aplication", "conch", "cred",
+            #                 "version", "internet", "mail"]
+            # twisted_files = find(self._basedir, "-name", "t
+        if self._part_enabled("removepyc"):
+            rules.extend([Delete("pyc", ["*.pyc"]),
+                          Strip("strip", ["*.so*"])])
+        return rules
+
+    def fingerprint(self):
+        return self._digest([p for p in self._parts
+                             if self._part_enabled(p)])
+
+    @skippable
+    def run(self):
+        self.log("Cleaning up the bundle...")
+        # only the bundle, the working copies of the repos must stay
+        # clean for the incremental builds
+        process_tree(os.path.join(self._basedir, "Bitmask"), self.rules(),
+                     self.log)
         self.log("Done")
 
 
-class PycRemover(Action):
+class ZipLib(Action):
+    inputs = BUNDLE
+    outputs = BUNDLE
+
     def __init__(self, basedir, skip, do):
-        Action.__init__(self, "removepyc", basedir, skip, do)
+        Action.__init__(self, "ziplib", basedir, skip, do)
 
     @skippable
     def run(self):
-        self.log("Removing .pyc files...")
-        files = find(self._basedir, "-name", "*.pyc").strip().splitlines()
-        for f in files:
-            rm(f)
-        files = find(self._basedir, "-name", "*\\.so*").strip().splitlines()
-        for f in files:
-            self.log("Stripping {0}".format(f))
-            try:
-                strip(f)
-            except:
-                pass
+        self.log("Zipping the pure python code...")
+        zipped, loose, size = ziplib.pack_lib(
+            platform_dir(self._basedir, "lib"), log=self.log)
+        self.log("{0} files zipped in {1} ({2} bytes), {3} left "
+                 "loose".format(zipped, ziplib.ZIP_NAME, size, loose))
+        self.log("Done")
+
+
+class WriteManifest(Action):
+    inputs = BUNDLE
+    outputs = ("manifest",)
+
+    def __init__(self, basedir, skip, do):
+        Action.__init__(self, "manifest", basedir, skip, do)
+
+    @skippable
+    def run(self):
+        self.log("Writing the manifest of the bundle...")
+        path = os.path.join(self._basedir, fastcopy.MANIFEST)
+        files, read = fastcopy.write_manifest(
+            os.path.join(self._basedir, "Bitmask"), path)
+        self.log("{0} files in {1}, {2} of them hashed again".format(
+            files, fastcopy.MANIFEST, read))
         self.log("Done")
 
 
 class MtEmAll(Action):
+    inputs = ("binaries",)
+    outputs = ("binaries", "cwd")
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "mtemall", basedir, skip, do)
 
@@ -693,29 +1134,37 @@ class MtEmAll(Action):
 
 
 class ZipIt(Action):
+    inputs = BUNDLE + ("repos",)
+    outputs = ("package", "cwd")
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "zipit", basedir, skip, do)
 
-    def _zipdir(self, path, zf):
-        for root, dirs, files in os.walk(path):
-            for f in files:
-                zf.write(os.path.join(root, f))
-
     @skippable
-    def run(self, repos, nightly):
+    def run(self, repos, nightly, jobs=None, dedup_files=False):
         self.log("Ziping it...")
         cd(self._basedir)
         version = get_version(repos, nightly)
         name = "Bitmask-win32-{0}".format(version)
-        mv(_convert_path_for_win(os.path.join(self._basedir, "Bitmask")),
-           _convert_path_for_win(os.path.join(self._basedir, name)))
-        zf = zipfile.ZipFile("{0}.zip".format(name), "w", zipfile.ZIP_DEFLATED)
-        self._zipdir(name, zf)
-        zf.close()
+        bundle_dir = os.path.join(self._basedir, "Bitmask")
+        if dedup_files:
+            # zip has no links, they can only be reported
+            dedup.report(dedup.find_duplicates(bundle_dir), bundle_dir,
+                         self.log)
+        zip_path = os.path.join(self._basedir, "{0}.zip".format(name))
+        size, compressed, stored = archiver.write_zip(
+            bundle_dir, name, zip_path, jobs)
+        self.log("{0}: {1} bytes compressed to {2} ({3:.1%}), "
+                 "{4} files stored".format(
+                     os.path.basename(zip_path), size, compressed,
+                     float(compressed) / max(size, 1), stored))
         self.log("Done")
 
 
 class SignIt(Action):
+    inputs = BUNDLE
+    outputs = BUNDLE
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "signit", basedir, skip, do)
 
@@ -749,20 +1198,3 @@ class SignIt(Action):
         self.log(codesign("-s", identity, "--force",
                           "--deep", "--verbose", main_app))
         self.log("Done")
-
-
-class RemoveUnused(Action):
-    def __init__(self, basedir, skip, do):
-        Action.__init__(self, "rmunused", basedir, skip, do)
-
-    @skippable
-    def run(self):
-        self.log("Removing unused python code...")
-        test_dirs = find(self._basedir, "-name", "*test*").strip().splitlines()
-        for td in test_dirs:
-            rm("-rf", os.path.join(self._basedir, td))
-
-        # twisted_used = ["aplication", "conch", "cred",
-        #                 "version", "internet", "mail"]
-        # twisted_files = find(self._basedir, "-name", "t
-        self.log("Done")
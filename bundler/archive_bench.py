@@ -0,0 +1,62 @@
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import archiver
+
+
+def _bench_tar(src_dir, out_dir):
+    """
+    Time the `tar cjf` that we used before, as a baseline.
+    """
+    out = os.path.join(out_dir, "baseline.tar.bz2")
+    parent, name = os.path.split(os.path.abspath(src_dir))
+    start = time.time()
+    subprocess.check_call(["tar", "cjf", out, "-C", parent, name])
+    return time.time() - start, os.path.getsize(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the tarball codecs on a bundle.')
+    parser.add_argument('bundle', help="the bundle directory to compress")
+    parser.add_argument('--codecs', nargs="*",
+                        default=sorted(archiver.CODECS))
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="worker processes, defaults to all the cores")
+    parser.add_argument('--no-baseline', action="store_true",
+                        help="don't time `tar cjf`")
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp(prefix="bundler-bench-")
+    results = []
+    try:
+        if not args.no_baseline:
+            wall, size = _bench_tar(args.bundle, out_dir)
+            results.append(("tar cjf", wall, size))
+
+        for codec in args.codecs:
+            try:
+                archiver.check_codec(codec)
+            except ValueError as e:
+                print "Skipping {0}: {1}".format(codec, e)
+                continue
+            out = os.path.join(out_dir, "bench" + archiver.extension(codec))
+            start = time.time()
+            _, size = archiver.write_tarball(args.bundle, "Bitmask", out,
+                                             codec, jobs=args.jobs)
+            results.append((codec, time.time() - start, size))
+            os.remove(out)
+    finally:
+        shutil.rmtree(out_dir)
+
+    print "{0:<10} {1:>10} {2:>14}".format("codec", "wall (s)", "size (bytes)")
+    for name, wall, size in results:
+        print "{0:<10} {1:>10.1f} {2:>14}".format(name, wall, size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+Tarball and zip writers that compress in parallel.
+
+The tar stream is cut in blocks that are compressed on their own by a pool
+of processes and written in order. Each block is a complete stream of the
+codec, and all of bzip2, xz and zstd decompress concatenated streams as a
+single one (this is what pbzip2 does for bz2).
+
+Zip members are compressed on their own anyway, so each file is deflated
+by the pool and the finished members are written in order, then the
+central directory.
+"""
+import bz2
+import collections
+import multiprocessing
+import os
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# codec -> (tarball extension, block size, default level), the levels are
+# the defaults of the bzip2, xz and zstd tools
+CODECS = {
+    "bz2": (".tar.bz2", 900 * 1000, 9),
+    "xz": (".tar.xz", 8 * 1024 * 1024, 6),
+    "zstd": (".tar.zst", 8 * 1024 * 1024, 3),
+}
+
+
+def extension(codec):
+    """
+    Return the file extension of a tarball compressed with codec.
+    """
+    return CODECS[codec][0]
+
+
+def check_codec(codec):
+    """
+    Raise a ValueError if the codec is unknown or can't be used here.
+    """
+    if codec not in CODECS:
+        raise ValueError("Unknown codec {0!r}, use one of: {1}".format(
+            codec, ", ".join(sorted(CODECS))))
+    if codec == "xz" and lzma is None:
+        raise ValueError("The xz codec needs the lzma module "
+                         "(backports.lzma on python 2)")
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("The zstd codec needs the zstandard module")
+
+
+def _compress(args):
+    codec, level, data = args
+    if codec == "bz2":
+        return bz2.compress(data, level)
+    if codec == "xz":
+        return lzma.compress(data, preset=level)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class ParallelWriter(object):
+    """
+    File like object that compresses what is written to it in blocks, using
+    a pool of processes, and writes them in order to fileobj.
+    """
+
+    def __init__(self, fileobj, codec="bz2", level=None, jobs=None):
+        check_codec(codec)
+        _, self._block_size, default_level = CODECS[codec]
+        self._codec = codec
+        self._level = default_level if level is None else level
+        self._fileobj = fileobj
+        self._jobs = jobs or multiprocessing.cpu_count()
+        self._pool = multiprocessing.Pool(self._jobs)
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.bytes_in += len(data)
+        if self._buffered >= self._block_size:
+            self._submit()
+
+    def _submit(self):
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        for start in range(0, len(data), self._block_size):
+            block = data[start:start + self._block_size]
+            self._pending.append(self._pool.apply_async(
+                _compress, ((self._codec, self._level, block),)))
+
+        # don't keep more than a couple of blocks per worker in memory
+        while len(self._pending) > self._jobs * 2:
+            self._write_next()
+
+    def _write_next(self):
+        compressed = self._pending.popleft().get()
+        self._fileobj.write(compressed)
+        self.bytes_out += len(compressed)
+
+    def close(self):
+        try:
+            if self._buffered:
+                self._submit()
+            while self._pending:
+                self._write_next()
+        finally:
+            self._pool.terminate()
+            self._pool.join()
+
+
+def _walk(root):
+    """
+    Yield the paths under root, root included, in a stable order.
+    """
+    yield root
+    for dirpath, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            yield os.path.join(dirpath, name)
+
+
+def write_tarball(src_dir, arcname, out_path, codec="bz2", level=None,
+                  jobs=None, duplicates=None):
+    """
+    Write the directory src_dir, named arcname inside the tarball, to
+    out_path compressed with codec.
+
+    :param duplicates: groups of files with the same contents, as returned
+                       by dedup.find_duplicates, they are stored once and
+                       hardlinked from the other paths with the same mode
+    :type duplicates: list
+    :return: the uncompressed and compressed sizes
+    :rtype: tuple(int, int)
+    """
+    groups = {}
+    for _, paths in duplicates or []:
+        for path in paths:
+            groups[path] = paths[0]
+    stored = {}
+
+    with open(out_path, 'wb') as f:
+        writer = ParallelWriter(f, codec, level, jobs)
+        try:
+            tar = tarfile.open(fileobj=writer, mode="w|",
+                               format=tarfile.GNU_FORMAT)
+            for path in _walk(src_dir):
+                name = os.path.normpath(
+                    os.path.join(arcname, os.path.relpath(path, src_dir)))
+                if path in groups:
+                    info = tar.gettarinfo(path, name)
+                    key = (groups[path], info.mode)
+                    if info.isreg() and key in stored:
+                        info.type = tarfile.LNKTYPE
+                        info.linkname = stored[key]
+                        info.size = 0
+                        tar.addfile(info)
+                        continue
+                    stored.setdefault(key, name)
+                tar.add(path, name, recursive=False)
+            tar.close()
+        finally:
+            writer.close()
+    return writer.bytes_in, writer.bytes_out
+
+
+# sizes and offsets from which zip needs the zip64 records
+ZIP64_LIMIT = 0xffffffff
+
+# files that are compressed already, deflating them is a waste of time
+STORED_EXTENSIONS = (".zip", ".xpi", ".jar", ".gz", ".tgz", ".bz2", ".xz",
+                     ".zst", ".png", ".jpg", ".jpeg", ".gif", ".ico",
+                     ".icns", ".mp3", ".ogg")
+
+# how much of a file is deflated to guess if it is worth compressing
+PROBE_SIZE = 64 * 1024
+# files that don't shrink below this ratio are stored
+MIN_RATIO = 0.95
+
+
+def _deflate_member(path):
+    """
+    Read the file at path and return its crc, size, the zip method it
+    should use and the data for the member.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    crc = zlib.crc32(data) & 0xffffffff
+    method = zipfile.ZIP_DEFLATED
+
+    if path.lower().endswith(STORED_EXTENSIONS):
+        method = zipfile.ZIP_STORED
+    elif len(data) > PROBE_SIZE:
+        sample = data[:PROBE_SIZE]
+        probe = zlib.compressobj(1, zlib.DEFLATED, -15)
+        probed = probe.compress(sample) + probe.flush()
+        if len(probed) > len(sample) * MIN_RATIO:
+            method = zipfile.ZIP_STORED
+
+    compressed = data
+    if method == zipfile.ZIP_DEFLATED:
+        # raw deflate stream, as zipfile writes it
+        deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                    zlib.DEFLATED, -15)
+        compressed = deflater.compress(data) + deflater.flush()
+        if len(compressed) >= len(data):
+            method = zipfile.ZIP_STORED
+            compressed = data
+    return crc, len(data), method, compressed
+
+
+def _dos_time(mtime):
+    """
+    Return the MS-DOS date and time of mtime, as zip headers keep them.
+    """
+    t = time.localtime(mtime)
+    year = min(max(t.tm_year, 1980), 2107)
+    date = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    return date, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+
+class ZipWriter(object):
+    """
+    Write a zip file member by member from data that is compressed
+    already, then its central directory. zipfile only writes members that
+    it compresses itself.
+
+    Zip64 records are added for the members and the directory that don't
+    fit in the classic ones.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._entries = []
+
+    def add(self, arcname, st, crc, size, method, data):
+        """
+        Append a member named arcname with the mode and mtime of st, data
+        is its contents compressed with method.
+        """
+        name = arcname.replace(os.sep, "/")
+        flags = 0
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+            flags |= 0x800
+        date, dos_time = _dos_time(st.st_mtime)
+        offset = self._fileobj.tell()
+
+        zip64 = size >= ZIP64_LIMIT or len(data) >= ZIP64_LIMIT
+        extra = ""
+        sizes = (len(data), size)
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, size, len(data))
+            sizes = (0xffffffff, 0xffffffff)
+        self._fileobj.write(struct.pack(
+            "<IHHHHHIIIHH", 0x04034b50, 45 if zip64 else 20, flags, method,
+            dos_time, date, crc, sizes[0], sizes[1], len(name), len(extra)))
+        self._fileobj.write(name)
+        self._fileobj.write(extra)
+        self._fileobj.write(data)
+        self._entries.append((name, flags, method, dos_time, date, crc,
+                              len(data), size, (st.st_mode & 0xffff) << 16,
+                              offset))
+
+    def _central_entry(self, entry):
+        (name, flags, method, dos_time, date, crc, compressed, size,
+         attributes, offset) = entry
+        fields = []
+        if size >= ZIP64_LIMIT:
+            fields.append(size)
+            size = 0xffffffff
+        if compressed >= ZIP64_LIMIT:
+            fields.append(compressed)
+            compressed = 0xffffffff
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = 0xffffffff
+        extra = ""
+        if fields:
+            extra = struct.pack("<HH", 1, 8 * len(fields))
+            extra += struct.pack("<" + "Q" * len(fields), *fields)
+        version = 45 if fields else 20
+        # made by unix, so the high bytes of the attributes are the mode
+        return struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014b50, 3 << 8 | version, version,
+            flags, method, dos_time, date, crc, compressed, size, len(name),
+            len(extra), 0, 0, 0, attributes, offset) + name + extra
+
+    def close(self):
+        """
+        Write the central directory, the zip is complete after it.
+        """
+        start = self._fileobj.tell()
+        for entry in self._entries:
+            self._fileobj.write(self._central_entry(entry))
+        end = self._fileobj.tell()
+        count = len(self._entries)
+        size = end - start
+
+        if (count >= 0xffff or size >= ZIP64_LIMIT or
+                start >= ZIP64_LIMIT):
+            self._fileobj.write(struct.pack(
+                "<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count,
+                size, start))
+            self._fileobj.write(struct.pack("<IIQI", 0x07064b50, 0, end, 1))
+            count = min(count, 0xffff)
+            size = min(size, 0xffffffff)
+            start = min(start, 0xffffffff)
+        self._fileobj.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0,
+                                        count, count, size, start, 0))
+
+
+def write_zip(src_dir, arcname, out_path, jobs=None):
+    """
+    Write the files under src_dir, in a directory named arcname inside the
+    zip, to out_path.
+
+    :return: the uncompressed and compressed sizes, and how many files
+             were stored without compression
+    :rtype: tuple(int, int, int)
+    """
+    paths = [p for p in _walk(src_dir) if os.path.isfile(p)]
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+    size, compressed, stored = 0, 0, 0
+    try:
+        with open(out_path, 'wb') as f:
+            zf = ZipWriter(f)
+            members = pool.imap(_deflate_member, paths)
+            for path, member in zip(paths, members):
+                name = os.path.join(arcname, os.path.relpath(path, src_dir))
+                zf.add(name, os.stat(path), *member)
+                size += member[1]
+                compressed += len(member[3])
+                if member[2] == zipfile.ZIP_STORED:
+                    stored += 1
+            zf.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return size, compressed, stored
@@ -0,0 +1,206 @@
+"""
+Where the bytes of a bundle go.
+
+Each file of a bundle dir or tarball is read once and deflated on the fly
+to estimate what it adds to the compressed archive, then its raw and
+compressed sizes are added to the item it belongs to: a top level package
+or module of lib, a dir of apps or a binary.
+"""
+import json
+import os
+import subprocess
+import tarfile
+import zlib
+
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+
+# zlib level used to estimate the compressed size, the real codecs do
+# better but the proportions hold
+LEVEL = 6
+
+BUFFER_SIZE = 1024 * 1024
+
+# the tarballs that python can't open by itself, and the commands that
+# decompress them, the first one installed is used. The bz2 module of
+# python 2 stops after the first stream of the parallel bz2 tarballs.
+DECOMPRESSORS = {
+    ".tar.bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]],
+    ".tar.xz": [["xz", "-dc"]],
+    ".tar.zst": [["zstd", "-dc"]],
+}
+
+MAC_ROOT = os.path.join("Bitmask.app", "Contents", "MacOS")
+
+PYTHON_EXTENSIONS = (".py", ".pyc", ".pyo", ".so", ".pyd")
+LIBRARY_EXTENSIONS = (".dylib", ".dll")
+
+
+def item_name(relpath):
+    """
+    Return the item that the file at relpath, inside the bundle, counts
+    for.
+    """
+    if relpath.startswith(MAC_ROOT + os.sep):
+        relpath = relpath[len(MAC_ROOT) + 1:]
+    parts = relpath.split(os.sep)
+    if len(parts) == 1:
+        return "binary: " + parts[0]
+    if parts[0] == "lib":
+        name = parts[1]
+        if len(parts) > 2:
+            return "lib/" + name
+        if (name.endswith(LIBRARY_EXTENSIONS) or
+                (name.startswith("lib") and ".so" in name) or
+                not name.endswith(PYTHON_EXTENSIONS)):
+            return "binary: lib/" + name
+        return "lib/" + name.split(".")[0]
+    if parts[0] == "apps" and len(parts) > 2:
+        return "apps/" + parts[1]
+    return parts[0]
+
+
+def _compressed_size(chunks):
+    """
+    Return the size of the chunks and what they take deflated.
+    """
+    deflater = zlib.compressobj(LEVEL)
+    raw = compressed = 0
+    for chunk in chunks:
+        raw += len(chunk)
+        compressed += len(deflater.compress(chunk))
+    compressed += len(deflater.flush())
+    return raw, compressed
+
+
+def _read_chunks(fileobj):
+    return iter(lambda: fileobj.read(BUFFER_SIZE), '')
+
+
+def _scan_dir(path):
+    for dirpath, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(dirpath, name)
+            if os.path.islink(file_path):
+                continue
+            with open(file_path, 'rb') as f:
+                yield (os.path.relpath(file_path, path),
+                       _compressed_size(_read_chunks(f)))
+
+
+@contextmanager
+def _open_tarball(path):
+    command = None
+    for extension, candidates in DECOMPRESSORS.items():
+        if path.endswith(extension):
+            command = next((c for c in candidates
+                            if find_executable(c[0]) is not None),
+                           candidates[-1])
+    if command is None:
+        tar = tarfile.open(path, "r|*")
+        try:
+            yield tar
+        finally:
+            tar.close()
+        return
+
+    with open(path, 'rb') as f:
+        proc = subprocess.Popen(command, stdin=f, stdout=subprocess.PIPE)
+        try:
+            yield tarfile.open(fileobj=proc.stdout, mode="r|")
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+
+def _scan_tarball(path):
+    with _open_tarball(path) as tar:
+        for member in tar:
+            # links take no room in the tarball
+            if not member.isfile():
+                continue
+            # the top folder is the name of the bundle
+            relpath = os.path.normpath(member.name.split("/", 1)[-1])
+            yield relpath, _compressed_size(
+                _read_chunks(tar.extractfile(member)))
+
+
+def analyze(path):
+    """
+    Return the sizes of the items of the bundle dir, tarball or saved
+    analysis at path.
+
+    :rtype: dict
+    """
+    if path.endswith(".json"):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    if os.path.isdir(path):
+        files = _scan_dir(path)
+    else:
+        files = _scan_tarball(path)
+
+    items = {}
+    for relpath, (raw, compressed) in files:
+        item = items.setdefault(item_name(relpath),
+                                {"raw": 0, "compressed": 0, "files": 0})
+        item["raw"] += raw
+        item["compressed"] += compressed
+        item["files"] += 1
+    return {
+        "source": path,
+        "raw": sum(i["raw"] for i in items.values()),
+        "compressed": sum(i["compressed"] for i in items.values()),
+        "items": items,
+    }
+
+
+def compare(old, new):
+    """
+    Return the changes of each item from the analysis old to new, the
+    biggest growth in compressed size first.
+
+    :rtype: list of tuple(str, dict)
+    """
+    empty = {"raw": 0, "compressed": 0, "files": 0}
+    changes = []
+    for name in set(old["items"]) | set(new["items"]):
+        before = old["items"].get(name, empty)
+        after = new["items"].get(name, empty)
+        delta = dict((k, after[k] - before[k]) for k in empty)
+        if any(delta.values()):
+            changes.append((name, delta))
+    return sorted(changes, key=lambda c: (-c[1]["compressed"], c[0]))
+
+
+def _mb(size):
+    return size / (1024.0 * 1024)
+
+
+def print_table(analysis, limit=None):
+    rows = sorted(analysis["items"].items(),
+                  key=lambda i: (-i[1]["compressed"], i[0]))
+    total = max(analysis["compressed"], 1)
+    print "{0}: {1:.1f} MB, about {2:.1f} MB compressed".format(
+        analysis["source"], _mb(analysis["raw"]),
+        _mb(analysis["compressed"]))
+    print "{0:<40} {1:>7} {2:>10} {3:>10} {4:>7}".format(
+        "item", "files", "raw MB", "comp MB", "share")
+    for name, item in rows[:limit]:
+        print "{0:<40} {1:>7} {2:>10.2f} {3:>10.2f} {4:>7.1%}".format(
+            name, item["files"], _mb(item["raw"]), _mb(item["compressed"]),
+            float(item["compressed"]) / total)
+
+
+def print_changes(old, new, changes, limit=None):
+    print "{0} -> {1}: {2:+.2f} MB, about {3:+.2f} MB compressed".format(
+        old["source"], new["source"], _mb(new["raw"] - old["raw"]),
+        _mb(new["compressed"] - old["compressed"]))
+    print "{0:<40} {1:>7} {2:>10} {3:>10}".format(
+        "item", "files", "raw MB", "comp MB")
+    for name, delta in changes[:limit]:
+        print "{0:<40} {1:>+7} {2:>+10.2f} {3:>+10.2f}".format(
+            name, delta["files"], _mb(delta["raw"]),
+            _mb(delta["compressed"]))
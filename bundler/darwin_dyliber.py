@@ -1,59 +1,101 @@
 import os
 
-from sh import otool, install_name_tool, find
-
-def parse_otool_output(output):
-    lines = output.splitlines()[1:]
-    libs = []
-    for line in lines:
-        line = line.strip()
-        if len(line) == 0:
-            continue
-        line = line.split("(")[0].strip()
-        lib = os.path.split(line)[-1]
-        libs.append((lib, line))
+from macho import read_dylibs, MachOError
+from workers import run_parallel
+
+
+def index_files(executable_path):
+    files = []
+    for root, dirs, names in os.walk(executable_path):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append(path)
+
+    # the first file found with a name is the one that we link to
+    index = {}
+    for path in files:
+        index.setdefault(os.path.basename(path), path)
+    return files, index
+
 
-    return libs
+def _relative_name(executable_path, location):
+    return os.path.join("@executable_path",
+                        os.path.relpath(location, executable_path))
 
-def locate_lib(executable_path, lib):
-    return find(executable_path, "-name", lib, "-type", "f").strip()
 
-def install_name_tooler(executable_path, lib_path):
-    out = otool("-L", lib_path)
+def plan_file(executable_path, index, lib_path):
+    """
+    Return the arguments for install_name_tool that fix lib_path, or an
+    empty list if there is nothing to change.
+    """
+    try:
+        macho = read_dylibs(lib_path)
+    except (MachOError, IOError) as e:
+        print "ERROR Reading", lib_path
+        print e
+        return []
+    if macho is None:
+        return []
+
     _, lib_name = os.path.split(lib_path)
-    libs = parse_otool_output(out)
-    updated_any = False
-    for lib, original in libs:
-        do_id = lib == lib_name
+    new_id = None
+    changes = []
+
+    libs = macho.dylibs
+    if macho.id is not None:
+        libs = [macho.id] + libs
 
+    for original in libs:
+        lib = os.path.basename(original)
         if original.find("Carbon") > 0:
             continue
-        location = locate_lib(executable_path, lib)
-        if location is None or len(location) == 0:
+        location = index.get(lib)
+        if location is None:
             continue
+        name = _relative_name(executable_path, location)
+        if lib == lib_name:
+            new_id = name
+        elif original != name:
+            changes.append((original, name))
+
+    args = []
+    if new_id is not None and new_id != macho.id:
+        args += ["-id", new_id]
+    for original, name in changes:
+        args += ["-change", original, name]
+    return args
+
+
+def plan_all(executable_path):
+    """
+    Return the install_name_tool arguments for every file that needs
+    fixing, by file.
+    """
+    files, index = index_files(executable_path)
+    plan = {}
+    for f in files:
+        args = plan_file(executable_path, index, f)
+        if args:
+            plan[f] = args
+    return plan
+
+
+def fix_all_dylibs(executable_path, jobs=4):
+    # only on OSX, the planning above works anywhere
+    from sh import install_name_tool
+
+    print "Fixing all dylibs..."
+    plan = plan_all(executable_path)
+
+    def fix(lib_path, log):
         try:
-            if do_id:
-                install_name_tool("-id",
-                                  os.path.join("@executable_path",
-                                               os.path.relpath(location,
-                                                               executable_path)),
-                                  lib_path)
-            else:
-                install_name_tool("-change", original,
-                                  os.path.join("@executable_path",
-                                               os.path.relpath(location,
-                                                               executable_path)),
-                                  lib_path)
-            updated_any = True
+            install_name_tool(*(plan[lib_path] + [lib_path]))
+            log("Fixed {0}".format(lib_path))
         except Exception as e:
-            print "ERROR Fixing", lib
-            print e
-    if updated_any:
-        print "Fixed", lib_path
-
-def fix_all_dylibs(executable_path):
-    print "Fixing all dylibs, this might take a while..."
-    files = find(executable_path, "-type", "f").strip().splitlines()
-    for f in files:
-        install_name_tooler(executable_path, f)
+            log("ERROR Fixing {0}".format(lib_path))
+            log(str(e))
+
+    run_parallel(fix, sorted(plan), jobs)
     print "Done"
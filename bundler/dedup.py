@@ -0,0 +1,86 @@
+"""
+Find the files of the bundle that have the same contents.
+
+Only the files that share their size with another one are read, first the
+beginning of each of them and then, if that matches too, the whole file.
+"""
+import collections
+import hashlib
+import os
+
+# files smaller than this are not worth reporting nor linking
+MIN_SIZE = 1
+
+HEAD_SIZE = 4096
+
+
+def _digest(path, size=None):
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if size is not None:
+            m.update(f.read(size))
+        else:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                m.update(chunk)
+    return m.hexdigest()
+
+
+def _regroup(groups, key):
+    """
+    Split each group of paths by key and keep the parts with more than one
+    path.
+    """
+    result = []
+    for paths in groups:
+        parts = collections.defaultdict(list)
+        for path in paths:
+            parts[key(path)].append(path)
+        result.extend(p for p in parts.values() if len(p) > 1)
+    return result
+
+
+def find_duplicates(root, min_size=MIN_SIZE):
+    """
+    Return the groups of regular files under root with the same contents,
+    biggest first, each of them sorted by path.
+
+    :rtype: list of tuple(int, list of str)
+    """
+    by_size = collections.defaultdict(list)
+    for dirpath, dirs, files in os.walk(root):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                continue
+            size = os.path.getsize(path)
+            if size >= min_size:
+                by_size[size].append(path)
+
+    groups = [paths for paths in by_size.values() if len(paths) > 1]
+    groups = _regroup(groups, lambda p: _digest(p, HEAD_SIZE))
+    groups = _regroup(groups, lambda p: (_digest(p)
+                                         if os.path.getsize(p) > HEAD_SIZE
+                                         else None))
+    return sorted(((os.path.getsize(g[0]), sorted(g)) for g in groups),
+                  key=lambda g: (-g[0] * (len(g[1]) - 1), g[1]))
+
+
+def wasted(groups):
+    """
+    Return the bytes taken by the extra copies in groups.
+    """
+    return sum(size * (len(paths) - 1) for size, paths in groups)
+
+
+def report(groups, root, log, limit=10):
+    """
+    Log how much space the duplicates under root take and the groups that
+    take the most.
+    """
+    log("{0} files with duplicates in {1} groups, {2} bytes in extra "
+        "copies".format(sum(len(p) for _, p in groups), len(groups),
+                        wasted(groups)))
+    for size, paths in groups[:limit]:
+        log("  {0} x {1} bytes: {2}".format(
+            len(paths), size,
+            ", ".join(os.path.relpath(p, root) for p in paths)))
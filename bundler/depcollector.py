@@ -1,63 +1,251 @@
 import sys
 import os
-import errno
+import hashlib
+import json
 
-from distutils import dir_util, file_util
 from modulegraph import modulegraph
 
+import fastcopy
 
-def mkdir_p(path):
-    try:
-        os.makedirs(path)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
-
+from fileops import mkdir_p
 
-def collect_deps(root, dest_lib_dir, path_file):
-    mg = modulegraph.ModuleGraph(
-        [sys.path[0]] +
-        [x.strip() for x in open(path_file, 'r').readlines()] +
-        sys.path[1:])  # , debug=3)
-
-    mg.import_hook("distutils")
-    mg.import_hook("site")
-    mg.import_hook("jsonschema")
-    mg.import_hook("scrypt")
-    mg.import_hook("_scrypt")
-    mg.import_hook("ConfigParser")
-    mg.import_hook("encodings.idna")
-    mg.import_hook("leap.soledad.client")
-    mg.import_hook("leap.mail")
-    mg.import_hook("leap.keymanager")
-    mg.import_hook("argparse")
-    mg.import_hook("srp")
-    mg.import_hook("pkgutil")
-    mg.import_hook("pkg_resources")
-    mg.import_hook("_sre")
-    mg.import_hook("zope.proxy")
-    mg.import_hook("tuf")
-    mg.import_hook("timeit")
-    mg.import_hook("daemon")  # for leap/bitmask/util/polkit_agent.py
-    mg.import_hook("functools32")  # jsonschema dep
+# Modules that we need but are not imported explicitly by the app
+IMPORT_HOOKS = [
+    "distutils",
+    "site",
+    "jsonschema",
+    "scrypt",
+    "_scrypt",
+    "ConfigParser",
+    "encodings.idna",
+    "leap.soledad.client",
+    "leap.mail",
+    "leap.keymanager",
+    "argparse",
+    "srp",
+    "pkgutil",
+    "pkg_resources",
+    "_sre",
+    "zope.proxy",
+    "tuf",
+    "timeit",
+    "daemon",  # for leap/bitmask/util/polkit_agent.py
+    "functools32",  # jsonschema dep
 
     # this import ensures the inclusion of the 'service-identity' dependency
     # since we don't import it implicitly anywhere
-    mg.import_hook("service_identity")
+    "service_identity",
     # this wasn't included in the bundle, there's no explicit import for it
-    mg.import_hook("pyasn1_modules")
+    "pyasn1_modules",
+]
+
+# Packages that are copied as a whole, their members are not looked at
+ROOT_PACKAGES = ["leap.common", "leap.keymanager", "leap.mail",
+                 "leap.soledad.client", "leap.soledad.common", "jsonschema"]
+
+# Modules that are imported in ways ModuleGraph can't see. When pruning they
+# are copied, with their submodules, even if they were not reached.
+PRUNE_KEEP = [
+    "encodings",  # looked up by name when a codec is used
+    "twisted.plugins",  # loaded by twisted.plugin.getPlugins
+    "PySide",  # trimmed on its own by CollectAllDeps
+]
+
+MODULE_EXTENSIONS = (".py", ".pyc", ".pyo", ".so", ".pyd")
+
+# The parts the lib is collected in, each one is a stage of its own: the
+# leap packages come from the repositories, the third party ones from the
+# virtualenv.
+LEAP = "leap"
+THIRD_PARTY = "third-party"
+
+
+class _Node(object):
+    """
+    What we keep of a modulegraph node, it can be rebuilt from the cache.
+    """
+
+    def __init__(self, identifier, kind, filename, refs, stamp):
+        self.identifier = identifier
+        self.kind = kind
+        self.filename = filename
+        self.refs = refs
+        self.stamp = stamp
+
+    def isa(self, cls):
+        kind = getattr(modulegraph, self.kind, None)
+        return kind is not None and issubclass(kind, cls)
+
+    def to_json(self):
+        return [self.kind, self.filename, self.refs, self.stamp]
+
+    @classmethod
+    def from_json(cls, identifier, data):
+        return cls(identifier, *data)
+
+
+def _file_stamp(filename):
+    """
+    Return what we use to notice that a scanned file changed, None if it is
+    not a file.
+    """
+    if filename is None or not os.path.isfile(filename):
+        return None
+    st = os.stat(filename)
+    return [st.st_mtime, st.st_size]
+
+
+def _scan(search_path, root, modules=None, missing=()):
+    """
+    Scan the given modules (the script and all the import hooks if None)
+    and everything they import. The ones in missing may still not be
+    found, they are left out of the result then.
+
+    :return: the nodes found, by identifier, and the identifiers of the
+             scanned modules.
+    :rtype: tuple(dict, list)
+    """
+    mg = modulegraph.ModuleGraph(search_path)  # , debug=3)
+
+    roots = []
+    if modules is None:
+        for name in IMPORT_HOOKS:
+            roots.extend(m.identifier for m in mg.import_hook(name))
+        roots.append(mg.run_script(root).identifier)
+    else:
+        for name in modules:
+            if name == os.path.realpath(root):
+                mg.run_script(root)
+            elif name in missing:
+                try:
+                    mg.import_hook(name)
+                except ImportError:
+                    pass
+            else:
+                mg.import_hook(name)
+        roots = modules
+
+    nodes = {}
+    for m in mg.flatten():
+        refs = [r.identifier for r in mg.getReferences(m) if r is not None]
+        nodes[m.identifier] = _Node(m.identifier, type(m).__name__,
+                                    m.filename, refs,
+                                    _file_stamp(m.filename))
+    return nodes, roots
+
+
+def _reachable(nodes, roots):
+    seen = set()
+    stack = [r for r in roots if r in nodes]
+    while stack:
+        ident = stack.pop()
+        if ident in seen:
+            continue
+        seen.add(ident)
+        stack.extend(r for r in nodes[ident].refs if r in nodes)
+    return seen
+
+
+def _cache_key(search_path, root):
+    m = hashlib.sha256()
+    m.update(json.dumps([search_path, os.path.realpath(root),
+                         IMPORT_HOOKS]))
+    return m.hexdigest()
+
+
+def _load_cache(cache_file, key):
+    try:
+        with open(cache_file, 'r') as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if data.get("key") != key:
+        return None
+    nodes = dict((ident, _Node.from_json(ident, n))
+                 for ident, n in data["nodes"].items())
+    return nodes, data["roots"]
+
+
+def _save_cache(cache_file, key, nodes, roots):
+    data = {
+        "key": key,
+        "roots": roots,
+        "nodes": dict((ident, n.to_json()) for ident, n in nodes.items()),
+    }
+    with open(cache_file, 'w') as f:
+        json.dump(data, f)
+
+
+def build_graph(root, search_path, cache_file=None):
+    """
+    Return the nodes of the module graph of the app and its roots.
+
+    If a cache file is given only the modules whose files changed since the
+    cached scan, and what they import, are scanned again. The modules that
+    were missing are always looked for again, they may have been installed
+    since.
+
+    :rtype: tuple(dict, list)
+    """
+    key = _cache_key(search_path, root)
+    cached = None
+    if cache_file is not None:
+        cached = _load_cache(cache_file, key)
+
+    if cached is None:
+        print "Scanning all the modules..."
+        nodes, roots = _scan(search_path, root)
+    else:
+        nodes, roots = cached
+        changed = [ident for ident, n in sorted(nodes.items())
+                   if n.stamp != _file_stamp(n.filename)]
+        missing = [ident for ident, n in sorted(nodes.items())
+                   if n.isa(modulegraph.MissingModule)]
+        print "Modules changed since the last scan:", len(changed)
+        print "Missing modules looked for again:", len(missing)
+        if changed or missing:
+            try:
+                rescanned, _ = _scan(search_path, root,
+                                     sorted(set(changed) | set(missing)),
+                                     set(missing))
+                nodes.update(rescanned)
+            except Exception as e:
+                print "Problem rescanning, scanning everything: {0!r}".format(
+                    e)
+                nodes, roots = _scan(search_path, root)
+
+    # forget what is not imported anymore
+    reachable = _reachable(nodes, roots)
+    nodes = dict((i, n) for i, n in nodes.items() if i in reachable)
 
-    mg.run_script(root)
+    if cache_file is not None:
+        _save_cache(cache_file, key, nodes, roots)
 
-    packages = [mg.findNode(i) for i in ["leap.common", "leap.keymanager",
-                                         "leap.mail", "leap.soledad.client",
-                                         "leap.soledad.common", "jsonschema"]]
+    return nodes, roots
+
+
+def _in_part(identifier, part):
+    """
+    Return whether the module named identifier belongs to part, every
+    module does if part is None.
+    """
+    if part is None:
+        return True
+    is_leap = identifier == "leap" or identifier.startswith("leap.")
+    return is_leap == (part == LEAP)
+
+
+def _select(nodes, part=None):
+    """
+    Split the nodes of part in the packages that are copied as a whole and
+    the other modules that are copied as a single file.
+    """
+    packages = [nodes[i] for i in ROOT_PACKAGES]
     other = []
 
-    sorted_pkg = [(os.path.basename(m.identifier), m) for m in mg.flatten()]
-    sorted_pkg.sort()
+    sorted_pkg = [(os.path.basename(m.identifier), m)
+                  for m in nodes.values()]
+    sorted_pkg.sort(key=lambda x: (x[0], x[1].identifier))
 
     for (name, pkg) in sorted_pkg:
         # skip namespace packages
@@ -65,63 +253,198 @@ def collect_deps(root, dest_lib_dir, path_file):
                 name.endswith("leap/bitmask/app.py"):
             continue
 
-        # print pkg
-        if isinstance(pkg, modulegraph.MissingModule):
-            # print "ignoring", pkg.identifier
+        if pkg.isa(modulegraph.MissingModule):
             continue
-        elif isinstance(pkg, modulegraph.Package):
-            foundpackage = False
-            for i in packages:
-                if pkg.identifier.startswith(i.identifier):
-                    # print "skipping", pkg.identifier, "member of", i.identifier
-                    # print "  found in", i.filename
-                    foundpackage = True
-                    break
-            if foundpackage:
-                continue
-            if pkg.filename is None:
-                continue
+
+        foundpackage = False
+        for i in packages:
+            if pkg.identifier.startswith(i.identifier):
+                foundpackage = True
+                break
+        if foundpackage:
+            continue
+        if pkg.filename is None:
+            continue
+
+        if pkg.isa(modulegraph.Package):
             if pkg not in packages:
                 packages.append(pkg)
-        else:  # if isinstance(pkg, modulegraph.Extension):
-            foundpackage = False
-            for i in packages:
-                if pkg.identifier.startswith(i.identifier):
-                    # print "skipping", pkg.identifier, "member of", i.identifier
-                    # print "  found in", i.filename
-                    foundpackage = True
-                    break
-            if foundpackage:
-                continue
-            if pkg.filename is None:
-                continue
+        else:
             other.append(pkg)
-            # print pkg.identifier
+
+    key = lambda m: m.identifier
+    return (sorted([p for p in packages if _in_part(p.identifier, part)],
+                   key=key),
+            sorted([o for o in other if _in_part(o.identifier, part)],
+                   key=key))
+
+
+def _module_name(package, relpath):
+    """
+    Return the dotted name of the module at relpath inside package.
+    """
+    parts = os.path.normpath(relpath).split(os.sep)
+    name = parts.pop().split(".")[0]
+    if name != "__init__":
+        parts.append(name)
+    return ".".join([package] + [p for p in parts if p != "."])
+
+
+def _pruned_files(package, pkg_dir, reached, keep):
+    """
+    Return the files of the package at pkg_dir that are needed: the modules
+    that were reached or are kept, and the package data.
+
+    :return: the needed files and all the files, by path relative to
+             pkg_dir
+    :rtype: tuple(list, list)
+    """
+    def kept(name):
+        return any(name == k or name.startswith(k + ".") for k in keep)
+
+    def wanted_package(name):
+        # a package is walked if something in it may be needed
+        return (name in reached or kept(name) or
+                any(k.startswith(name + ".") for k in keep))
+
+    needed, everything = [], []
+    for root, dirs, names in os.walk(pkg_dir):
+        rel = os.path.relpath(root, pkg_dir)
+        for d in list(dirs):
+            init_py = os.path.join(rel, d, "__init__.py")
+            if (os.path.isfile(os.path.join(pkg_dir, init_py)) and
+                    not wanted_package(_module_name(package, init_py))):
+                dirs.remove(d)
+                for sub_root, _, sub_names in os.walk(os.path.join(root, d)):
+                    everything.extend(
+                        os.path.relpath(os.path.join(sub_root, n), pkg_dir)
+                        for n in sub_names)
+
+        for name in names:
+            relpath = os.path.normpath(os.path.join(rel, name))
+            everything.append(relpath)
+            if name.endswith((".pyc", ".pyo")):
+                continue
+            if name.endswith(MODULE_EXTENSIONS):
+                module = _module_name(package, relpath)
+                if module not in reached and not kept(module):
+                    continue
+            needed.append(relpath)
+    return needed, everything
+
+
+def _search_path(path_file):
+    return (
+        [sys.path[0]] +
+        [x.strip() for x in open(path_file, 'r').readlines()] +
+        sys.path[1:])
+
+
+def _file_key(path, by_contents):
+    if by_contents:
+        return fastcopy.digest(path)
+    return _file_stamp(path)
+
+
+def sources_digest(root, path_file, cache_file=None, part=None):
+    """
+    Return a digest of what collect_deps would copy for part: the modules
+    of it that are reached and every file of the packages and modules it
+    copies from.
+
+    The files of the leap packages are digested by contents, they are
+    rewritten each time the repositories are cloned, the ones of the
+    virtualenv by path, size and modification time.
+
+    :rtype: str
+    """
+    nodes, roots = build_graph(root, _search_path(path_file), cache_file)
+    packages, other = _select(nodes, part)
+    by_contents = part == LEAP
+    m = hashlib.sha256()
+    m.update(json.dumps(sorted(i for i in nodes if _in_part(i, part))))
+    for pkg in packages:
+        if pkg.identifier == "leap.bitmask":
+            continue
+        pkg_dir = os.path.dirname(pkg.filename)
+        for dirpath, dirs, files in os.walk(pkg_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(dirpath, name)
+                relpath = path
+                if by_contents:
+                    relpath = [pkg.identifier,
+                               os.path.relpath(path, pkg_dir)]
+                m.update(json.dumps([relpath, _file_key(path, by_contents)]))
+    for node in other:
+        m.update(json.dumps([node.identifier,
+                             _file_key(node.filename, by_contents)]))
+    return m.hexdigest()
+
+
+def collect_deps(root, dest_lib_dir, path_file, cache_file=None,
+                 prune=False, keep=(), part=None):
+    """
+    Copy the modules that the app at root imports to dest_lib_dir, only
+    the ones of part (LEAP or THIRD_PARTY) if given.
+
+    :param prune: copy only the modules of the packages that are imported,
+                  plus the package data, instead of whole packages
+    :type prune: bool
+    :param keep: names of the modules to copy when pruning even if they are
+                 not imported, added to PRUNE_KEEP
+    :type keep: list of str
+    """
+    nodes, roots = build_graph(root, _search_path(path_file), cache_file)
+    packages, other = _select(nodes, part)
+    reached = set(i for i, n in nodes.items()
+                  if not n.isa(modulegraph.MissingModule))
+    keep = PRUNE_KEEP + list(keep)
+    total, total_size, copied, copied_size = 0, 0, 0, 0
 
     print "Packages", len(packages)
-    for i in sorted(packages):
-        # if i.identifier == "distutils":
-        #     i.filename = distutils.__file__
+    for i in packages:
         print i.identifier, i.filename
         if i.identifier == "leap.bitmask":
             continue
         parts = i.identifier.split(".")
         destdir = os.path.join(*([dest_lib_dir]+parts))
         mkdir_p(destdir)
-        dir_util.copy_tree(os.path.dirname(i.filename), destdir)
+        pkg_dir = os.path.dirname(i.filename)
+        if not prune or i.identifier in ROOT_PACKAGES:
+            fastcopy.copy_tree(pkg_dir, destdir)
+        else:
+            needed, everything = _pruned_files(i.identifier, pkg_dir,
+                                               reached, keep)
+            for relpath in needed:
+                dest = os.path.join(destdir, relpath)
+                mkdir_p(os.path.dirname(dest))
+                fastcopy.copy_file(os.path.join(pkg_dir, relpath), dest)
+            total += len(everything)
+            total_size += sum(os.lstat(os.path.join(pkg_dir, f)).st_size
+                              for f in everything)
+            copied += len(needed)
+            copied_size += sum(os.lstat(os.path.join(pkg_dir, f)).st_size
+                               for f in needed)
         before = []
         for part in parts:
             before.append(part)
             current = before + ["__init__.py"]
+            init_py = os.path.join(dest_lib_dir, *current)
             try:
-                with open(os.path.join(dest_lib_dir, *current), 'a'):
-                    pass
+                if not fastcopy.exists(init_py):
+                    fastcopy.write_file(init_py, "")
+                fastcopy.record(init_py)
             except Exception:
                 pass
 
     print "Other", len(other)
-    for i in sorted(other):
-        # if i.identifier == "site":
-        #     i.filename = site.__file__
+    for i in other:
         print i.identifier, i.filename
-        file_util.copy_file(i.filename, dest_lib_dir)
+        fastcopy.copy(i.filename, dest_lib_dir)
+
+    if prune:
+        print "Pruned packages: copied {0} of {1} files, {2} of {3} " \
+              "bytes ({4} bytes saved)".format(copied, total, copied_size,
+                                               total_size,
+                                               total_size - copied_size)
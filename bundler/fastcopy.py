@@ -0,0 +1,427 @@
+"""
+Copy helpers used to assemble the bundle.
+
+Each file is copied with the cheapest method that is safe for it:
+  - hardlink: when source and destination are on the same filesystem and
+    nothing will modify the file in place later,
+  - reflink: copy on write clone, on filesystems that support it (btrfs,
+    xfs),
+  - a plain buffered copy otherwise.
+
+While planning nothing is copied, the files that would be are added to
+the plan instead and the directories that would be created are seen as
+existing, so the same code can say what a build would put in the bundle.
+
+The sha256 of each file is computed while it is copied and kept by path,
+with the size and modification time it had then, so the manifest of the
+bundle doesn't need to read again the files that didn't change since.
+"""
+import errno
+import fnmatch
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import threading
+
+from contextlib import contextmanager
+
+from utils import IS_MAC, IS_WIN
+
+IS_LINUX = sys.platform.startswith("linux")
+
+if IS_LINUX:
+    import fcntl
+
+# ioctl to clone a file, from linux/fs.h
+FICLONE = 0x40049409
+
+BUFFER_SIZE = 1024 * 1024
+
+# the files created by the current thread, when recording
+_journal = threading.local()
+
+# what the current thread would copy, when planning
+_planning = threading.local()
+
+# (size, mtime) and sha256 of the files whose contents are known, by path
+_digests = {}
+_digests_lock = threading.Lock()
+
+# name of the manifest of the bundle, in the build dir
+MANIFEST = "MANIFEST.sha256"
+
+# Files that are modified in place later on (e.g. `strip` in CleanBundle), if
+# they were hardlinked the source would be modified too.
+MUTABLE_PATTERNS = ["*.so", "*.so.*", "*.dylib", "*.pyd", "*.dll", "*.exe"]
+
+
+def can_link(src):
+    """
+    Return True if src can be hardlinked instead of copied.
+
+    On OSX the binaries are changed by install_name_tool and codesign,
+    and Windows has no hardlinks, so we never link there.
+    """
+    if IS_MAC or IS_WIN:
+        return False
+    name = os.path.basename(src)
+    return not any(fnmatch.fnmatch(name, p) for p in MUTABLE_PATTERNS)
+
+
+@contextmanager
+def recording():
+    """
+    Record the paths of the files created by this thread while in the
+    context, the recorded paths are in the yielded set.
+    """
+    previous = getattr(_journal, "paths", None)
+    _journal.paths = set()
+    try:
+        yield _journal.paths
+    finally:
+        _journal.paths = previous
+
+
+def record(path):
+    """
+    Add path to the files being recorded, for the ones that are created
+    without the functions of this module.
+    """
+    paths = getattr(_journal, "paths", None)
+    if paths is not None:
+        paths.add(os.path.abspath(path))
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+
+def remember_digest(path, digest):
+    """
+    Keep digest as the sha256 of the file at path, as it is now.
+    """
+    stamp = _stamp(path)
+    with _digests_lock:
+        _digests[os.path.abspath(path)] = (stamp, digest)
+
+
+def known_digest(path):
+    """
+    Return the sha256 of the file at path if it is known and the file
+    didn't change since, None otherwise.
+    """
+    with _digests_lock:
+        entry = _digests.get(os.path.abspath(path))
+    if entry is None or entry[0] != _stamp(path):
+        return None
+    return entry[1]
+
+
+def digest(path):
+    """
+    Return the sha256 of the file at path, it is only read if the digest
+    is not known.
+    """
+    known = known_digest(path)
+    if known is not None:
+        return known
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), ''):
+            m.update(chunk)
+    remember_digest(path, m.hexdigest())
+    return m.hexdigest()
+
+
+def write_manifest(root, path):
+    """
+    Write the manifest of the files under root to path: a line with the
+    sha256, size, mode and path relative to root of each regular file,
+    sorted by path. Symlinks are left out.
+
+    :return: the amount of files listed and how many of them were read
+    :rtype: tuple(int, int)
+    """
+    lines = []
+    read = 0
+    for dirpath, dirs, files in os.walk(root):
+        for name in files:
+            file_path = os.path.join(dirpath, name)
+            if os.path.islink(file_path):
+                continue
+            if known_digest(file_path) is None:
+                read += 1
+            st = os.stat(file_path)
+            relpath = os.path.relpath(file_path, root).replace(os.sep, "/")
+            lines.append((relpath, "{0} {1} {2:04o} {3}\n".format(
+                digest(file_path), st.st_size, st.st_mode & 07777,
+                relpath)))
+
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        for _, line in sorted(lines):
+            f.write(line)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+    return len(lines), read
+
+
+class Plan(object):
+    """
+    The files that would be in the bundle, by destination path, and the
+    bytes that each action would copy.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.dirs = set()
+        self.copied = {}
+        self.action = None
+
+    def add(self, src, dst, size, link=None):
+        """
+        Add the file that would be written at dst, src is where it comes
+        from (None if it is generated) and link its target if a symlink.
+        """
+        dst = os.path.abspath(dst)
+        self.files[dst] = {"source": src, "size": size, "link": link}
+        self.dirs.update(_parents(dst))
+        if self.action is not None:
+            self.copied[self.action] = (self.copied.get(self.action, 0) +
+                                        (size or 0))
+
+    def add_dir(self, path):
+        path = os.path.abspath(path)
+        self.dirs.add(path)
+        self.dirs.update(_parents(path))
+
+    def remove(self, path):
+        """
+        Remove path, and everything under it, from the plan.
+        """
+        path = os.path.abspath(path)
+        prefix = path + os.sep
+        for name in [f for f in self.files
+                     if f == path or f.startswith(prefix)]:
+            del self.files[name]
+        self.dirs = set(d for d in self.dirs
+                        if d != path and not d.startswith(prefix))
+
+    def under(self, root):
+        """
+        Return the planned files under root.
+        """
+        prefix = os.path.abspath(root) + os.sep
+        return sorted(f for f in self.files if f.startswith(prefix))
+
+
+def _parents(path):
+    parent = os.path.dirname(path)
+    while parent and parent != path:
+        yield parent
+        path, parent = parent, os.path.dirname(parent)
+
+
+@contextmanager
+def planning():
+    """
+    Plan the copies done by this thread while in the context instead of
+    doing them, the yielded Plan gets what would be copied.
+    """
+    previous = getattr(_planning, "plan", None)
+    _planning.plan = Plan()
+    try:
+        yield _planning.plan
+    finally:
+        _planning.plan = previous
+
+
+def current_plan():
+    """
+    Return the Plan of this thread, None if it is not planning.
+    """
+    return getattr(_planning, "plan", None)
+
+
+def isdir(path):
+    """
+    Like os.path.isdir, counting the directories that would be created.
+    """
+    plan = current_plan()
+    if plan is not None and os.path.abspath(path) in plan.dirs:
+        return True
+    return os.path.isdir(path)
+
+
+def exists(path):
+    """
+    Like os.path.exists, counting the files that would be created.
+    """
+    plan = current_plan()
+    if plan is not None and os.path.abspath(path) in plan.files:
+        return True
+    return isdir(path) or os.path.exists(path)
+
+
+def write_file(path, data, mode=None):
+    """
+    Write data to the file at path, and set its mode if given.
+    """
+    plan = current_plan()
+    if plan is not None:
+        plan.add(None, path, len(data))
+        return
+    with open(path, 'w') as f:
+        f.write(data)
+    if mode is not None:
+        os.chmod(path, mode)
+    remember_digest(path, hashlib.sha256(data).hexdigest())
+    record(path)
+
+
+def copy_file(src, dst, link=True):
+    """
+    Copy the file src to the path dst, overwriting it.
+
+    :param link: whether hardlinking is allowed for this file
+    :type link: bool
+    :return: the method used, 'hardlink', 'reflink' or 'copy', or
+             'planned' when planning
+    :rtype: str
+    """
+    plan = current_plan()
+    if plan is not None:
+        plan.add(src, dst, os.path.getsize(src))
+        return "planned"
+
+    if os.path.lexists(dst):
+        # never write through an existing hardlink
+        os.remove(dst)
+
+    # hardlinks and reflinks don't read the file, the digest of the source
+    # is only passed on if it is known
+    src_digest = known_digest(src)
+
+    if link and can_link(src):
+        try:
+            os.link(os.path.realpath(src), dst)
+            if src_digest is not None:
+                remember_digest(dst, src_digest)
+            record(dst)
+            return "hardlink"
+        except OSError:  # e.g. EXDEV, different filesystems
+            pass
+
+    method = "copy"
+    m = hashlib.sha256()
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            cloned = False
+            if IS_LINUX:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    cloned = True
+                    method = "reflink"
+                except IOError:  # EOPNOTSUPP, EXDEV, EINVAL, ...
+                    pass
+            if not cloned:
+                for chunk in iter(lambda: fsrc.read(BUFFER_SIZE), ''):
+                    fdst.write(chunk)
+                    m.update(chunk)
+                src_digest = m.hexdigest()
+    shutil.copystat(src, dst)
+    if src_digest is not None:
+        remember_digest(dst, src_digest)
+    record(dst)
+    return method
+
+
+def copy_tree(src, dst, symlinks=False, link=True):
+    """
+    Copy the contents of the directory src into dst, creating it if needed.
+
+    :param symlinks: copy symlinks as symlinks instead of following them
+    :type symlinks: bool
+    :return: the copied files, on the destination
+    :rtype: list of str
+    """
+    copied = []
+    for root, dirs, files in os.walk(src, followlinks=not symlinks):
+        dest_root = os.path.normpath(
+            os.path.join(dst, os.path.relpath(root, src)))
+        _mkdir_p(dest_root)
+
+        for name in list(dirs):
+            path = os.path.join(root, name)
+            if symlinks and os.path.islink(path):
+                # os.walk doesn't follow it, copy it as a link
+                _copy_symlink(path, os.path.join(dest_root, name))
+                copied.append(os.path.join(dest_root, name))
+
+        for name in files:
+            path = os.path.join(root, name)
+            target = os.path.join(dest_root, name)
+            if symlinks and os.path.islink(path):
+                _copy_symlink(path, target)
+            else:
+                copy_file(path, target, link)
+            copied.append(target)
+    return copied
+
+
+def copy(src, dst, recursive=False, link=True):
+    """
+    Copy src like `cp` would, into dst if it is a directory or as dst
+    otherwise. Directories need recursive, their symlinks are kept.
+    """
+    if isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src.rstrip("/\\")))
+
+    if os.path.isdir(src):
+        if not recursive:
+            raise IOError(errno.EISDIR, "Is a directory, omitting", src)
+        return copy_tree(src, dst, symlinks=True, link=link)
+
+    copy_file(src, dst, link)
+    return [dst]
+
+
+def copy_glob(pattern, dst, recursive=False, link=True):
+    """
+    Copy everything that matches pattern like `cp pattern dst` would.
+    """
+    matches = sorted(glob.glob(pattern))
+    if not matches:
+        raise IOError(errno.ENOENT, "No such file or directory", pattern)
+
+    copied = []
+    for src in matches:
+        copied.extend(copy(src, dst, recursive, link))
+    return copied
+
+
+def _copy_symlink(src, dst):
+    plan = current_plan()
+    if plan is not None:
+        plan.add(None, dst, 0, os.readlink(src))
+        return
+    if os.path.lexists(dst):
+        os.remove(dst)
+    os.symlink(os.readlink(src), dst)
+    record(dst)
+
+
+def _mkdir_p(path):
+    plan = current_plan()
+    if plan is not None:
+        plan.add_dir(path)
+        return
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
@@ -0,0 +1,136 @@
+"""
+The file operations of the actions, done in-process.
+
+They behave like the commands they replace (`mkdir -p`, `rm -rf`, `mv`,
+`ln -s`, `cp -R` and `find -name`) on every platform, without spawning
+a process for each call. On Windows that used to mean going through the
+Git-bash binaries, which also needed the paths with forward slashes.
+
+Like fastcopy, they only change the plan when fastcopy is planning.
+"""
+import errno
+import fnmatch
+import glob
+import os
+import shutil
+import stat
+
+import fastcopy
+
+
+def mkdir_p(*paths):
+    """
+    Create each of paths and their parents, like `mkdir -p`.
+    """
+    plan = fastcopy.current_plan()
+    for path in paths:
+        if plan is not None:
+            plan.add_dir(path)
+            continue
+        try:
+            os.makedirs(path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
+
+
+def _remove_readonly(func, path, exc_info):
+    """
+    Make path writable and try again, `rm -rf` removes read-only files too
+    (e.g. git objects on Windows).
+    """
+    if not os.path.lexists(path):
+        return
+    os.chmod(path, stat.S_IWRITE | stat.S_IREAD | stat.S_IEXEC)
+    func(path)
+
+
+def rm_rf(*paths):
+    """
+    Remove each of paths, files or whole trees, like `rm -rf`. The ones
+    that don't exist are ignored.
+    """
+    plan = fastcopy.current_plan()
+    for path in paths:
+        if plan is not None:
+            plan.remove(path)
+        elif os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, onerror=_remove_readonly)
+        elif os.path.lexists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                _remove_readonly(os.remove, path, None)
+
+
+def mv(src, dst):
+    """
+    Move src into dst if it is a directory or to dst otherwise, like `mv`.
+    """
+    if fastcopy.isdir(dst) and not os.path.islink(dst):
+        dst = os.path.join(dst, os.path.basename(src.rstrip("/\\")))
+    plan = fastcopy.current_plan()
+    if plan is not None:
+        src, dst = os.path.abspath(src), os.path.abspath(dst)
+        for path in plan.under(src) + [src]:
+            if path in plan.files:
+                plan.files[dst + path[len(src):]] = plan.files.pop(path)
+        return dst
+    if os.path.lexists(dst) and not os.path.isdir(dst):
+        os.remove(dst)
+    shutil.move(src, dst)
+    return dst
+
+
+def symlink(target, link_name):
+    """
+    Create link_name pointing to target, like `ln -s`. Where there are no
+    symlinks (python 2 on Windows) target is copied, as Git-bash's ln does.
+    """
+    if fastcopy.isdir(link_name) and not os.path.islink(link_name):
+        link_name = os.path.join(link_name,
+                                 os.path.basename(target.rstrip("/\\")))
+    plan = fastcopy.current_plan()
+    if plan is not None:
+        plan.add(None, link_name, 0, target)
+        return link_name
+    if not hasattr(os, "symlink"):
+        fastcopy.copy(target, link_name, recursive=True, link=False)
+        return link_name
+    os.symlink(target, link_name)
+    fastcopy.record(link_name)
+    return link_name
+
+
+def cp(src, dst, recursive=False):
+    """
+    Copy src, which may be a glob, like `cp [-R] src dst`.
+    """
+    matches = sorted(glob.glob(src))
+    if not matches:
+        raise IOError(errno.ENOENT, "No such file or directory", src)
+
+    copied = []
+    for path in matches:
+        if recursive and os.path.islink(path):
+            # -R copies the link itself, not what it points to
+            target = dst
+            if fastcopy.isdir(dst) and not os.path.islink(dst):
+                target = os.path.join(dst, os.path.basename(path))
+            rm_rf(target)
+            copied.append(symlink(os.readlink(path), target))
+        else:
+            copied.extend(fastcopy.copy(path, dst, recursive))
+    return copied
+
+
+def find(root, pattern, dirs=False):
+    """
+    Yield the paths under root whose name matches pattern, like
+    `find root -name pattern`, only the files unless dirs.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        names = filenames + dirnames if dirs else filenames
+        for name in sorted(names):
+            if fnmatch.fnmatch(name, pattern):
+                yield os.path.join(dirpath, name)
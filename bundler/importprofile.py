@@ -0,0 +1,315 @@
+"""
+Profile the imports done when a built bundle starts.
+
+The bundle's modules are imported by a python run with the lib and apps
+dirs of the bundle on sys.path and an __import__ hook that times every
+import that loads a module. The self time of a module is its cumulative
+time minus the one of the modules it imported.
+
+Where strace is available, a second run counts the stat and open calls
+made while each module was imported. The hook marks the start and end of
+each import with an access() call on a path that doesn't exist, so the
+calls in between can be attributed to it.
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+from distutils.spawn import find_executable
+
+MARKER = "/bundler-profile-startup/"
+
+# runs in the profiled python: only builtin modules are imported before the
+# hook is in place, anything else could come from the bundle
+_HOOK = r"""
+import __builtin__
+import sys
+import time
+
+_module, _output, _marker = sys.argv[1], sys.argv[2], sys.argv[3]
+sys.path[:0] = sys.argv[4:]
+
+if _marker:
+    import posix
+
+    def _mark(what, ident):
+        posix.access("%s%s/%d" % (_marker, what, ident), 0)
+else:
+    _mark = None
+
+_import = __builtin__.__import__
+_records = {}
+_aliases = {}
+_stack = [[0, 0.0]]  # ids and time spent in children of the open imports
+_next = [1]
+
+
+def _names(name, globals, fromlist, level):
+    names = [name]
+    if globals is not None and level != 0 and globals.get("__name__"):
+        package = globals["__name__"]
+        if "__path__" not in globals:
+            package = package.rpartition(".")[0]
+        for _ in range(max(level - 1, 0)):
+            package = package.rpartition(".")[0]
+        if package:
+            relative = package + "." + name if name else package
+            names = [relative] if level > 0 else [relative, name]
+    if fromlist:
+        names = [n + "." + f for n in names
+                 for f in fromlist if f != "*"] + names
+    return names
+
+
+def _hook(name, globals=None, locals=None, fromlist=None, level=-1):
+    names = _names(name, globals, fromlist, level)
+    missing = [n for n in names if sys.modules.get(n) is None]
+    if not missing:
+        return _import(name, globals, locals, fromlist, level)
+
+    ident = _next[0]
+    _next[0] += 1
+    parent = _stack[-1][0]
+    _stack.append([ident, 0.0])
+    if _mark:
+        _mark("B", ident)
+    start = time.time()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        cumulative = time.time() - start
+        if _mark:
+            _mark("E", ident)
+        _, children = _stack.pop()
+        loaded = [n for n in missing if sys.modules.get(n) is not None]
+        if loaded:
+            _records[ident] = {"module": loaded[0], "parent": parent,
+                               "cumulative": cumulative,
+                               "self": cumulative - children}
+            _stack[-1][1] += cumulative
+        else:
+            # nothing new, its time and calls go to the parent
+            _aliases[ident] = parent
+
+
+__builtin__.__import__ = _hook
+_start = time.time()
+try:
+    import site
+    __import__(_module)
+finally:
+    _total = time.time() - _start
+    __builtin__.__import__ = _import
+    import json
+    with open(_output, 'w') as f:
+        json.dump({"total": _total, "records": _records,
+                   "aliases": _aliases}, f)
+"""
+
+# the calls counted, by kind
+SYSCALLS = {
+    "stat": ["stat", "lstat", "fstat", "stat64", "lstat64", "fstat64",
+             "newfstatat", "fstatat64", "statx"],
+    "open": ["open", "openat"],
+}
+
+_SYSCALL_RE = re.compile(r'^(\w+)\((?:[^"]*?"([^"]*)")?')
+
+
+# where the interpreter of the bundle is looked for, relative to the dir
+# that holds lib. The launchers embed python and can't run a script, the
+# bundle needs a python executable built against the libpython it ships.
+PYTHON_NAMES = ["python", "python2.7", "python.exe",
+                os.path.join("lib", "python"),
+                os.path.join("lib", "python2.7")]
+
+
+def _base(bundle):
+    """
+    Return the dir of the bundle that holds lib and apps.
+    """
+    mac_base = os.path.join(bundle, "Bitmask.app", "Contents", "MacOS")
+    if not os.path.isdir(os.path.join(bundle, "lib")) and \
+            os.path.isdir(mac_base):
+        return mac_base
+    return bundle
+
+
+def find_paths(bundle):
+    """
+    Return the dirs of the bundle that go on sys.path: lib and apps.
+    """
+    base = _base(bundle)
+    paths = [os.path.join(base, name) for name in ("lib", "apps")]
+    return [p for p in paths if os.path.isdir(p)]
+
+
+def find_python(bundle):
+    """
+    Return the python executable shipped in the bundle, None if there is
+    none.
+    """
+    base = _base(bundle)
+    for name in PYTHON_NAMES:
+        path = os.path.join(base, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def _environ(paths):
+    """
+    Return the environment to run the bundle's python in: the shared
+    libraries are loaded from its lib dir first, as the launcher does.
+    """
+    env = dict(os.environ)
+    name = {"darwin": "DYLD_LIBRARY_PATH",
+            "win32": "PATH"}.get(sys.platform, "LD_LIBRARY_PATH")
+    env[name] = os.pathsep.join(paths[:1] + [p for p in [env.get(name)]
+                                             if p])
+    return env
+
+
+def _run(python, module, paths, strace=None):
+    """
+    Run the hooked import of module and return what the hook recorded and
+    the strace log, if strace is given.
+    """
+    fd, output = tempfile.mkstemp(prefix="bundler-profile-", suffix=".json")
+    os.close(fd)
+    trace = output + ".strace" if strace else None
+    cmd = [python, "-S", "-E", "-c", _HOOK, module, output,
+           MARKER if strace else ""] + paths
+    if strace:
+        calls = ["access"] + sum(SYSCALLS.values(), [])
+        cmd = [strace, "-s", "4096", "-o", trace,
+               "-e", "trace=" + ",".join(calls)] + cmd
+    try:
+        subprocess.check_call(cmd, env=_environ(paths))
+        with open(output, 'r') as f:
+            result = json.load(f)
+        log = None
+        if trace:
+            with open(trace, 'r') as f:
+                log = f.read()
+        return result, log
+    finally:
+        for path in (output, trace):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+def _owner(ident, records, aliases):
+    """
+    Return the id of the record that the calls made under ident count for.
+    """
+    while ident not in records and ident in aliases:
+        ident = str(aliases[ident])
+    return ident
+
+
+def count_syscalls(log, records, aliases):
+    """
+    Return the stat and open calls in the strace log made by the import of
+    each module, and by none of them.
+
+    :rtype: dict of module name to dict of kind to int
+    """
+    kinds = dict((call, kind) for kind, calls in SYSCALLS.items()
+                 for call in calls)
+    stack = ["0"]
+    counts = {}
+    for line in log.splitlines():
+        match = _SYSCALL_RE.match(line)
+        if match is None:
+            continue
+        call, path = match.groups()
+        if path is not None and path.startswith(MARKER):
+            what, ident = path[len(MARKER):].split("/")
+            if what == "B":
+                stack.append(ident)
+            elif stack[-1] == ident:
+                stack.pop()
+            continue
+        if call not in kinds:
+            continue
+        owner = _owner(stack[-1], records, aliases)
+        name = records[owner]["module"] if owner in records else None
+        module_counts = counts.setdefault(name, {"stat": 0, "open": 0})
+        module_counts[kinds[call]] += 1
+    return counts
+
+
+def profile(python, module, paths, strace=True):
+    """
+    Profile the import of module from paths.
+
+    :param strace: whether to count the stat and open calls, when strace
+                   is installed
+    :type strace: bool
+    :return: the total time and, by import, the module, its parent
+             import, the self and cumulative times and the counts
+    :rtype: tuple(float, dict of str to dict)
+    """
+    result, _ = _run(python, module, paths)
+    records = result["records"]
+    for record in records.values():
+        record["stat"] = record["open"] = None
+
+    strace = find_executable("strace") if strace else None
+    if strace is not None:
+        traced, log = _run(python, module, paths, strace)
+        counts = count_syscalls(log, traced["records"], traced["aliases"])
+        for record in records.values():
+            record.update(counts.get(record["module"],
+                                     {"stat": 0, "open": 0}))
+    return result["total"], records
+
+
+def _stack(ident, records):
+    names = []
+    while ident in records:
+        names.append(records[ident]["module"])
+        ident = str(records[ident]["parent"])
+    return list(reversed(names))
+
+
+def write_json(path, module, total, records):
+    data = {"module": module, "total": total, "imports": []}
+    for ident, record in sorted(records.items(), key=lambda i: int(i[0])):
+        entry = dict(record)
+        entry["stack"] = _stack(ident, records)
+        del entry["parent"]
+        data["imports"].append(entry)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def write_folded(path, records):
+    """
+    Write the self time of each import, in microseconds, in the folded
+    stacks format that flamegraph.pl and speedscope read.
+    """
+    with open(path, 'w') as f:
+        for ident, record in sorted(records.items(),
+                                    key=lambda i: int(i[0])):
+            f.write("{0} {1}\n".format(";".join(_stack(ident, records)),
+                                       int(record["self"] * 1000000)))
+
+
+def print_table(total, records, sort="cumulative", limit=None):
+    def fmt(value):
+        return "-" if value is None else str(value)
+
+    rows = sorted(records.values(), key=lambda r: r[sort], reverse=True)
+    print "Imported {0} modules in {1:.3f}s".format(len(rows), total)
+    print "{0:>10} {1:>10} {2:>7} {3:>7}  {4}".format(
+        "self ms", "cumul ms", "stat", "open", "module")
+    for r in rows[:limit]:
+        print "{0:>10.1f} {1:>10.1f} {2:>7} {3:>7}  {4}".format(
+            r["self"] * 1000, r["cumulative"] * 1000, fmt(r["stat"]),
+            fmt(r["open"]), r["module"])
+
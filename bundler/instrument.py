@@ -0,0 +1,254 @@
+"""
+Resource usage of each action of a build.
+
+Every action run by the scheduler is measured: wall and CPU time, peak RSS
+of the bundler and its children, subprocesses spawned and bytes read and
+written. The counters are for the whole process, so with more than one job
+the numbers of the actions that run at the same time overlap: the report
+labels the bytes read and written as process-wide then.
+
+Without psutil the peak RSS comes from getrusage, it is the high water
+mark of the bundler and of its largest child since the build started,
+not the one of each action.
+"""
+import json
+import subprocess
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+from utils import IS_MAC, IS_WIN
+
+if IS_WIN:
+    # pbs runs its commands through subprocess.Popen, counted below
+    sh = None
+else:
+    import sh
+
+
+class _Record(object):
+
+    FIELDS = ("name", "status", "wall", "cpu", "peak_rss", "spawns",
+              "read_bytes", "write_bytes")
+
+    def __init__(self, name):
+        self.name = name
+        self.status = None
+        self.wall = None
+        self.cpu = None
+        self.peak_rss = None
+        self.spawns = None
+        self.read_bytes = None
+        self.write_bytes = None
+
+    def to_json(self):
+        return dict((f, getattr(self, f)) for f in self.FIELDS)
+
+
+class Instrument(object):
+    """
+    Measure the actions of a build and report on them.
+    """
+
+    def __init__(self, interval=0.2, jobs=1):
+        """
+        Constructor
+
+        :param interval: seconds between two samples of the memory in use
+        :type interval: float
+        :param jobs: how many actions may run at the same time
+        :type jobs: int
+        """
+        self._interval = interval
+        self._process = psutil.Process() if psutil is not None else None
+        self._lock = threading.Lock()
+        self._records = []
+        self._running = {}
+        self._spawns = 0
+        self._originals = []
+        self._sampler = None
+        self._stopped = threading.Event()
+        self._start = None
+        self._end = None
+        # what the numbers of each action cover
+        self.scopes = {
+            "peak_rss": "action" if self._process is not None else "build",
+            "io": "action" if jobs <= 1 else "process",
+        }
+        if self._process is None and resource is None:
+            self.scopes["peak_rss"] = None
+
+    def start(self):
+        """
+        Start counting the subprocesses and sampling the memory in use.
+        """
+        self._start = time.time()
+        self._hook(subprocess.Popen, "__init__")
+        if sh is not None:
+            # every command run through sh, baked or not, ends up here
+            self._hook(sh.RunningCommand, "__init__")
+
+        if self._process is not None:
+            self._sampler = threading.Thread(target=self._sample)
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def stop(self):
+        self._end = time.time()
+        for cls, attr, original in self._originals:
+            setattr(cls, attr, original)
+        self._originals = []
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _hook(self, cls, attr):
+        original = getattr(cls, attr)
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self._spawns += 1
+            return original(*args, **kwargs)
+
+        self._originals.append((cls, attr, original))
+        setattr(cls, attr, counted)
+
+    def _rss(self):
+        """
+        Return the memory in use by the bundler and all its children.
+        """
+        total = 0
+        for p in [self._process] + self._process.children(recursive=True):
+            try:
+                total += p.memory_info().rss
+            except psutil.Error:  # the child finished meanwhile
+                pass
+        return total
+
+    def _max_rss(self):
+        """
+        Return the high water mark of the memory used by the bundler and
+        by its largest child, None if it can't be known.
+        """
+        if resource is None:
+            return None
+        peak = max(resource.getrusage(who).ru_maxrss
+                   for who in (resource.RUSAGE_SELF,
+                               resource.RUSAGE_CHILDREN))
+        # bytes on OSX, kilobytes everywhere else
+        return peak if IS_MAC else peak * 1024
+
+    def _sample(self):
+        while not self._stopped.wait(self._interval):
+            rss = self._rss()
+            with self._lock:
+                for record, _ in self._running.values():
+                    record.peak_rss = max(record.peak_rss, rss)
+
+    def _counters(self):
+        """
+        Return the cpu time, subprocesses spawned and bytes read and written
+        so far. Children are accounted for once they finish.
+        """
+        cpu, read_bytes, write_bytes = None, None, None
+        if self._process is not None:
+            times = self._process.cpu_times()
+            cpu = (times.user + times.system +
+                   getattr(times, "children_user", 0) +
+                   getattr(times, "children_system", 0))
+            if hasattr(self._process, "io_counters"):  # not on OSX
+                io = self._process.io_counters()
+                read_bytes, write_bytes = io.read_bytes, io.write_bytes
+        elif resource is not None:
+            cpu = 0
+            for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+                usage = resource.getrusage(who)
+                cpu += usage.ru_utime + usage.ru_stime
+        return time.time(), cpu, self._spawns, read_bytes, write_bytes
+
+    def begin(self, name):
+        """
+        Start measuring the action called name.
+        """
+        record = _Record(name)
+        if self._process is not None:
+            record.peak_rss = self._rss()
+        with self._lock:
+            self._records.append(record)
+            self._running[id(record)] = (record, self._counters())
+        return record
+
+    def end(self, record, status):
+        """
+        Finish measuring the action of record, status says what happened
+        to it: ran, cached, up to date, skipped or failed.
+        """
+        after = self._counters()
+        with self._lock:
+            _, before = self._running.pop(id(record))
+        record.status = status
+
+        def delta(i):
+            if before[i] is None or after[i] is None:
+                return None
+            return after[i] - before[i]
+
+        (record.wall, record.cpu, record.spawns,
+         record.read_bytes, record.write_bytes) = [delta(i) for i in
+                                                   range(len(after))]
+        if self._process is None:
+            record.peak_rss = self._max_rss()
+
+    def write_report(self, path, **info):
+        """
+        Write the measures as json to path, info is saved with them.
+        """
+        report = dict(info)
+        report["start"] = self._start
+        report["wall"] = (self._end or time.time()) - self._start
+        report["scopes"] = self.scopes
+        report["actions"] = [r.to_json() for r in self._records]
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    def print_summary(self):
+        def fmt(value, template):
+            return "-" if value is None else template.format(value)
+
+        def mb(value):
+            return None if value is None else value / (1024.0 * 1024)
+
+        rss_label, io_mark = "rss MB", ""
+        if self.scopes["peak_rss"] == "build":
+            rss_label = "max rss MB"
+        if self.scopes["io"] == "process":
+            io_mark = "*"
+
+        print "{0:<20} {1:<10} {2:>8} {3:>8} {4:>10} {5:>7} {6:>9} " \
+              "{7:>9}".format("action", "status", "wall", "cpu", rss_label,
+                              "spawns", "read MB" + io_mark,
+                              "write MB" + io_mark)
+        for r in self._records:
+            print "{0:<20} {1:<10} {2:>8} {3:>8} {4:>10} {5:>7} {6:>9} " \
+                  "{7:>9}".format(
+                      r.name, r.status,
+                      fmt(r.wall, "{0:.1f}s"), fmt(r.cpu, "{0:.1f}s"),
+                      fmt(mb(r.peak_rss), "{0:.0f}"),
+                      fmt(r.spawns, "{0}"),
+                      fmt(mb(r.read_bytes), "{0:.1f}"),
+                      fmt(mb(r.write_bytes), "{0:.1f}"))
+        if self.scopes["peak_rss"] == "build":
+            print "max rss: high water mark of the build until the action " \
+                  "finished"
+        if io_mark:
+            print "* bytes of the whole process, they include the actions " \
+                  "that ran at the same time"
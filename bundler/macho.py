@@ -0,0 +1,147 @@
+"""
+Minimal Mach-O reader, just enough to list the dylibs a binary links to
+and the rpaths it searches them in.
+
+It understands thin 32/64 bits binaries in both byte orders and universal
+(fat) binaries. It is pure python so it can be used (and tested) anywhere.
+"""
+import collections
+import os
+import struct
+
+FAT_MAGIC = 0xcafebabe
+MH_MAGIC = 0xfeedface
+MH_CIGAM = 0xcefaedfe
+MH_MAGIC_64 = 0xfeedfacf
+MH_CIGAM_64 = 0xcffaedfe
+
+LC_REQ_DYLD = 0x80000000
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+LC_RPATH = 0x1c | LC_REQ_DYLD
+
+LOAD_COMMANDS = (LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_LAZY_LOAD_DYLIB,
+                 LC_REEXPORT_DYLIB, LC_LOAD_UPWARD_DYLIB)
+
+# java class files share the fat magic, no real binary has that many archs
+MAX_FAT_ARCHS = 30
+
+MachO = collections.namedtuple("MachO", ["id", "dylibs", "rpaths"])
+
+
+class MachOError(Exception):
+    pass
+
+
+def _unpack_from(fmt, data, offset, what):
+    """
+    Like struct.unpack_from, but raise MachOError naming what was read if
+    data is too short for it.
+    """
+    if offset < 0 or offset + struct.calcsize(fmt) > len(data):
+        raise MachOError("truncated " + what)
+    return struct.unpack_from(fmt, data, offset)
+
+
+def _read_header(f, offset):
+    """
+    Return the endianness prefix, header size and number of load commands
+    of the thin binary at offset, None if it is not a Mach-O.
+    """
+    f.seek(offset)
+    raw = f.read(4)
+    if len(raw) < 4:
+        return None
+    magic = struct.unpack(">I", raw)[0]
+    if magic in (MH_MAGIC, MH_MAGIC_64):
+        endian = ">"
+    elif magic in (MH_CIGAM, MH_CIGAM_64):
+        endian = "<"
+    else:
+        return None
+    is_64 = magic in (MH_MAGIC_64, MH_CIGAM_64)
+
+    header = f.read(24)
+    _, _, _, ncmds, sizeofcmds, _ = _unpack_from(endian + "6I", header, 0,
+                                                 "header")
+    header_size = 32 if is_64 else 28
+    return endian, offset + header_size, ncmds, sizeofcmds
+
+
+def _read_commands(f, offset, result_id, dylibs, rpaths):
+    header = _read_header(f, offset)
+    if header is None:
+        return False
+    endian, position, ncmds, sizeofcmds = header
+
+    # checked before reading, a broken header could ask for gigabytes
+    if position + sizeofcmds > os.fstat(f.fileno()).st_size:
+        raise MachOError("truncated load commands")
+    if ncmds * 8 > sizeofcmds:
+        raise MachOError("more load commands than sizeofcmds holds")
+    f.seek(position)
+    commands = f.read(sizeofcmds)
+
+    cursor = 0
+    for i in xrange(ncmds):
+        cmd, cmdsize = _unpack_from(endian + "2I", commands, cursor,
+                                    "load commands")
+        if cmdsize < 8 or cursor + cmdsize > len(commands):
+            raise MachOError("bad load command size")
+        if cmd in (LC_ID_DYLIB, LC_RPATH) or cmd in LOAD_COMMANDS:
+            # the dylib and rpath commands start with the offset of their
+            # string, from the start of the command
+            if cmdsize < 12:
+                raise MachOError("bad load command size")
+            name_offset = struct.unpack_from(endian + "I", commands,
+                                             cursor + 8)[0]
+            if name_offset >= cmdsize:
+                raise MachOError("bad load command string offset")
+            raw = commands[cursor + name_offset:cursor + cmdsize]
+            name = raw.split("\0", 1)[0]
+            if cmd == LC_ID_DYLIB:
+                result_id.append(name)
+            elif cmd == LC_RPATH:
+                if name not in rpaths:
+                    rpaths.append(name)
+            elif name not in dylibs:
+                dylibs.append(name)
+        cursor += cmdsize
+    return True
+
+
+def read_dylibs(path):
+    """
+    Return the install name (LC_ID_DYLIB) of the binary at path, the
+    dylibs it loads and its rpaths, or None if it is not a Mach-O file.
+
+    :rtype: MachO or None
+    """
+    result_id = []
+    dylibs = []
+    rpaths = []
+    with open(path, 'rb') as f:
+        raw = f.read(8)
+        if len(raw) < 8:
+            return None
+        magic, nfat_arch = struct.unpack(">2I", raw)
+        if magic == FAT_MAGIC:
+            if nfat_arch > MAX_FAT_ARCHS:
+                return None
+            archs = f.read(20 * nfat_arch)
+            offsets = [_unpack_from(">5I", archs, 20 * i, "fat header")[2]
+                       for i in range(nfat_arch)]
+            found = False
+            for offset in offsets:
+                found = (_read_commands(f, offset, result_id, dylibs,
+                                        rpaths) or found)
+            if not found:
+                return None
+        elif not _read_commands(f, 0, result_id, dylibs, rpaths):
+            return None
+
+    return MachO(result_id[0] if result_id else None, dylibs, rpaths)
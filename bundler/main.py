@@ -4,20 +4,32 @@
 #  - Create complete bundle changelog
 
 import argparse
+import glob
 import json
 import os
+import sys
 import tempfile
+import time
 
 from contextlib import contextmanager
 from distutils import dir_util
 
 from actions import GitCloneAll, GitCheckout, PythonSetupAll
-from actions import CollectAllDeps, CopyBinaries, PLister, SeededConfig
+from actions import CollectAllDeps, CollectLeapDeps, CopyBinaries
+from actions import PLister, SeededConfig
 from actions import DarwinLauncher, CopyAssets, CopyMisc, FixDylibs
-from actions import DmgIt, PycRemover, TarballIt, MtEmAll, ZipIt, SignIt
-from actions import RemoveUnused, CreateDirStructure
-
-from utils import IS_MAC, IS_WIN
+from actions import DmgIt, CleanBundle, TarballIt, MtEmAll, ZipIt, SignIt
+from actions import CreateDirStructure, ThunderbirdExtension
+from actions import ZipLib, WriteManifest
+
+import actions
+import archiver
+import bundlesize
+import importprofile
+from instrument import Instrument
+from scheduler import Scheduler
+from stagecache import StageCache, DEFAULT_MAX_SIZE
+from utils import IS_MAC, IS_WIN, CACHE_DIR
 
 sorted_repos = [
     "leap_assets",
@@ -80,16 +92,187 @@ def get_tuf_repo(versions_file):
     return versions.get('tuf_repo')
 
 
+def _add_cache_args(parser):
+    parser.add_argument('--stage-cache',
+                        default=os.path.join(CACHE_DIR, "stages"),
+                        help="where to keep the outputs of the stages that "
+                             "are reused between builds")
+    parser.add_argument('--stage-cache-size', type=int,
+                        default=DEFAULT_MAX_SIZE,
+                        help="size in MB above which the least recently "
+                             "used outputs are removed from the stage cache")
+
+
+def cache_command(argv):
+    parser = argparse.ArgumentParser(prog="main.py cache",
+                                     description='Manage the stage cache.')
+    parser.add_argument('command', choices=["stats", "gc"])
+    _add_cache_args(parser)
+    args = parser.parse_args(argv)
+
+    cache = StageCache(os.path.realpath(args.stage_cache),
+                       args.stage_cache_size)
+    if args.command == "gc":
+        entries, size = cache.gc()
+        print "Removed {0} entries, {1} bytes".format(entries, size)
+        return
+
+    entries, size = cache.stats()
+    print "{0} entries, {1:.1f} MB in {2}".format(
+        len(entries), size / (1024.0 * 1024), args.stage_cache)
+    for e in entries:
+        print "  {0:<16} {1}  {2:>6} files {3:>8.1f} MB  {4}".format(
+            e["name"], e["key"][:12], len(e["files"]),
+            e["size"] / (1024.0 * 1024),
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(e["used"])))
+
+
+def profile_startup_command(argv):
+    parser = argparse.ArgumentParser(
+        prog="main.py profile-startup",
+        description='Profile the imports done when a bundle starts.')
+    parser.add_argument('bundle', help="the Bitmask dir of a built bundle")
+    parser.add_argument('--python',
+                        help="the python to run the bundle with, the one "
+                             "shipped in the bundle by default")
+    parser.add_argument('--module', default="leap.bitmask.app",
+                        help="the entry module to import")
+    parser.add_argument('--sort', default="cumulative",
+                        choices=["cumulative", "self", "stat", "open"])
+    parser.add_argument('--limit', type=int, default=40,
+                        help="how many modules to list, 0 for all")
+    parser.add_argument('--no-strace', action="store_true",
+                        help="don't count the stat and open calls")
+    parser.add_argument('--output', default="startup-profile.json",
+                        help="where to write the profile as json")
+    parser.add_argument('--folded', default="startup-profile.folded",
+                        help="where to write the folded stacks, for a "
+                             "flamegraph")
+    args = parser.parse_args(argv)
+
+    paths = importprofile.find_paths(os.path.realpath(args.bundle))
+    if not paths:
+        parser.error("There is no lib dir in {0}".format(args.bundle))
+
+    python = args.python
+    if python is None:
+        python = importprofile.find_python(os.path.realpath(args.bundle))
+    if python is None:
+        parser.error("There is no python in {0} (looked for {1}), give "
+                     "the one the bundle ships with --python".format(
+                         args.bundle,
+                         ", ".join(importprofile.PYTHON_NAMES)))
+
+    total, records = importprofile.profile(python, args.module, paths,
+                                           not args.no_strace)
+    if records and records.values()[0]["stat"] is None:
+        print "strace is not available, no stat and open counts"
+    importprofile.print_table(total, records, args.sort, args.limit or None)
+    importprofile.write_json(args.output, args.module, total, records)
+    importprofile.write_folded(args.folded, records)
+    print "Profile written to {0} and {1}".format(args.output, args.folded)
+
+
+def analyze_command(argv):
+    parser = argparse.ArgumentParser(
+        prog="main.py analyze",
+        description='Show what takes the room in a bundle.')
+    parser.add_argument('bundle',
+                        help="a Bitmask dir, a tarball or the json of an "
+                             "earlier analysis")
+    parser.add_argument('--compare', metavar="OLD",
+                        help="show what changed since this other bundle, "
+                             "tarball or json")
+    parser.add_argument('--limit', type=int, default=30,
+                        help="how many items to list, 0 for all")
+    parser.add_argument('--output',
+                        help="where to write the analysis as json")
+    args = parser.parse_args(argv)
+
+    analysis = bundlesize.analyze(args.bundle)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(analysis, f, indent=2, sort_keys=True)
+
+    if args.compare is None:
+        bundlesize.print_table(analysis, args.limit or None)
+        return
+
+    old = bundlesize.analyze(args.compare)
+    bundlesize.print_changes(old, analysis,
+                             bundlesize.compare(old, analysis),
+                             args.limit or None)
+
+
+# Commands other than the build, given as the first argument
+COMMANDS = {
+    "analyze": analyze_command,
+    "cache": cache_command,
+    "profile-startup": profile_startup_command,
+}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
     parser = argparse.ArgumentParser(description='Bundle creation tool.')
     parser.add_argument('--workon', help="")
     parser.add_argument('--skip', nargs="*", default=[], help="")
     parser.add_argument('--do', nargs="*", default=[], help="")
     parser.add_argument('--paths-file', help="")
-    parser.add_argument('--versions-file', help="")
+    parser.add_argument('--versions-file', nargs="+",
+                        help="one or more versions files (or globs), a "
+                             "bundle is built for each of them in its own "
+                             "dir inside the workon dir")
     parser.add_argument('--binaries', help="")
     parser.add_argument('--seeded-config', help="")
     parser.add_argument('--codesign', default="", help="")
+    parser.add_argument('--jobs', type=int, default=4,
+                        help="how many actions, and repositories to "
+                             "clone/checkout, to run at the same time")
+    parser.add_argument('--mirrors-dir',
+                        default=os.path.join(CACHE_DIR, "mirrors"),
+                        help="where to keep the local git mirrors that "
+                             "the repositories are cloned from")
+    parser.add_argument('--no-mirrors', action="store_true",
+                        help="clone straight from the remote repositories")
+    parser.add_argument('--compression', default="bz2",
+                        choices=sorted(archiver.CODECS),
+                        help="codec used to compress the linux tarball")
+    parser.add_argument('--force', action="store_true",
+                        help="run every action, even the ones that are "
+                             "up to date")
+    parser.add_argument('--report',
+                        help="where to write the json report of the "
+                             "resources used by each action, "
+                             "<workon>/build-report.json by default")
+    _add_cache_args(parser)
+    parser.add_argument('--no-stage-cache', action="store_true",
+                        help="don't reuse nor keep the outputs of the "
+                             "stages")
+    parser.add_argument('--prune-lib', action="store_true",
+                        help="copy only the modules that are imported from "
+                             "each package, and the package data, instead "
+                             "of whole packages")
+    parser.add_argument('--prune-keep', nargs="*", default=[],
+                        help="modules (with their submodules) to copy when "
+                             "pruning even if they are not imported")
+    parser.add_argument('--dedup', action="store_true",
+                        help="report the files of the bundle with the same "
+                             "contents and store them once in the tarball")
+    parser.add_argument('--zip-lib', action="store_true",
+                        help="ship the pure python code byte-compiled in a "
+                             "zip instead of as loose .py files. The first "
+                             "start is faster, the later ones a bit slower "
+                             "than with the .pyc files that python writes "
+                             "next to the loose ones (see "
+                             "startup_bench.py)")
+    parser.add_argument('--plan', nargs="?", const="", metavar="OUTPUT",
+                        help="don't build, write what the build would do "
+                             "and put in the bundle as json, to "
+                             "<workon>/build-plan.json by default. The "
+                             "repos are still cloned and set up")
 
     args = parser.parse_args()
 
@@ -106,81 +289,205 @@ def main():
     assert args.versions_file is not None, \
         "You need to specify a versions file with the versions to use " \
         "for each package."
-    versions_path = os.path.realpath(args.versions_file)
+    versions_paths = []
+    for pattern in args.versions_file:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        versions_paths.extend(os.path.realpath(m) for m in matches)
+
+    archiver.check_codec(args.compression)
+
+    mirrors_dir = None
+    if not args.no_mirrors:
+        mirrors_dir = os.path.realpath(args.mirrors_dir)
 
     seeded_config = None
     if args.seeded_config is not None:
         seeded_config = os.path.realpath(args.seeded_config)
 
-    with new_build_dir(os.path.realpath(args.workon)) as bd:
-        print "Doing it all in", bd
+    cache = None
+    if not args.no_stage_cache:
+        cache = StageCache(os.path.realpath(args.stage_cache),
+                           args.stage_cache_size)
+
+    with new_build_dir(os.path.realpath(args.workon)) as workon:
+        times = []
+        for versions_path in versions_paths:
+            bd = workon
+            name = os.path.splitext(os.path.basename(versions_path))[0]
+            if len(versions_paths) > 1:
+                bd = os.path.join(workon, name)
+                if not os.path.isdir(bd):
+                    os.makedirs(bd)
+
+            report_path = args.report
+            if report_path is not None and len(versions_paths) > 1:
+                root, ext = os.path.splitext(report_path)
+                report_path = "{0}-{1}{2}".format(root, name, ext)
+
+            plan_path = args.plan
+            if plan_path and len(versions_paths) > 1:
+                root, ext = os.path.splitext(plan_path)
+                plan_path = "{0}-{1}{2}".format(root, name, ext)
+
+            # the setup of the repos adds them to sys.path, each version
+            # needs to see its own
+            saved_path = list(sys.path)
+            start = time.time()
+            try:
+                build(args, bd, versions_path, paths_file, binaries_path,
+                      mirrors_dir, seeded_config, cache, report_path,
+                      plan_path)
+            finally:
+                sys.path[:] = saved_path
+            times.append((name, time.time() - start))
+
+        if len(versions_paths) > 1:
+            print_batch_summary(times)
+
+
+def build(args, bd, versions_path, paths_file, binaries_path, mirrors_dir,
+          seeded_config, cache, report_path=None, plan_path=None):
+    """
+    Build the bundle of the versions file given in the build dir bd, or
+    only plan it if plan_path is not None.
+    """
+    print "Doing it all in", bd
+
+    def init(t, bd=bd):
+        return t(bd, args.skip, args.do)
 
-        def init(t, bd=bd):
-            return t(bd, args.skip, args.do)
+    instrument = Instrument(jobs=args.jobs)
+    sched = Scheduler(args.jobs, os.path.join(bd, ".stamps"),
+                      args.force, instrument, cache)
+    sched.add(init(GitCloneAll), sorted_repos, args.jobs, mirrors_dir)
 
-        gc = init(GitCloneAll)
-        gc.run(sorted_repos)
+    # NOTE: NEW...
+    sched.add(init(GitCheckout), sorted_repos, versions_path, args.jobs)
 
-        # NOTE: NEW...
-        gco = init(GitCheckout)
-        gco.run(sorted_repos, versions_path)
+    sched.add(init(PythonSetupAll), sorted_repos, binaries_path)
 
-        ps = init(PythonSetupAll)
-        ps.run(sorted_repos, binaries_path)
+    sched.add(init(CreateDirStructure, os.path.join(bd, "Bitmask")))
 
-        cd = init(CreateDirStructure, os.path.join(bd, "Bitmask"))
-        cd.run()
+    # the third party modules and the leap packages are cached apart, a
+    # new version of the leap packages reuses the third party ones
+    sched.add(init(CollectAllDeps), paths_file, args.prune_lib,
+              args.prune_keep)
+    sched.add(init(CollectLeapDeps), paths_file, args.prune_lib,
+              args.prune_keep)
 
-        dp = init(CollectAllDeps)
-        dp.run(paths_file)
+    if binaries_path is not None:
+        sched.add(init(CopyBinaries), binaries_path)
 
-        if binaries_path is not None:
-            cb = init(CopyBinaries)
-            cb.run(binaries_path)
+    if IS_MAC:
+        sched.add(init(PLister))
+        sched.add(init(DarwinLauncher))
+        sched.add(init(CopyAssets))
+        sched.add(init(FixDylibs), args.jobs)
 
-        if IS_MAC:
-            pl = init(PLister)
-            pl.run()
-            dl = init(DarwinLauncher)
-            dl.run()
-            ca = init(CopyAssets)
-            ca.run()
-            fd = init(FixDylibs)
-            fd.run()
+    sched.add(init(ThunderbirdExtension))
+    sched.add(init(CopyMisc), binaries_path, get_tuf_repo(versions_path))
 
-        cm = init(CopyMisc)
-        cm.run(binaries_path, get_tuf_repo(versions_path))
+    # the tests are only removed from the linux bundle
+    sched.add(CleanBundle(bd, args.skip, args.do,
+                          remove_tests=not (IS_MAC or IS_WIN)))
 
-        pyc = init(PycRemover)
-        pyc.run()
+    if args.zip_lib:
+        # before the bundle is signed and manifested
+        sched.add(init(ZipLib))
 
-        if IS_WIN:
-            mt = init(MtEmAll)
-            mt.run()
+    if IS_WIN:
+        sched.add(init(MtEmAll))
 
-        if IS_MAC:
-            si = init(SignIt)
-            si.run(args.codesign)
+    if IS_MAC:
+        sched.add(init(SignIt), args.codesign)
 
-        if seeded_config is not None:
-            sc = init(SeededConfig)
-            sc.run(seeded_config)
+    if seeded_config is not None:
+        sched.add(init(SeededConfig), seeded_config)
 
-        version = get_version(versions_path)
+    version = get_version(versions_path)
 
-        if IS_MAC:
-            dm = init(DmgIt)
-            dm.run(sorted_repos, version)
-        elif IS_WIN:
-            zi = init(ZipIt)
-            zi.run(sorted_repos, version)
-        else:
-            ru = init(RemoveUnused)
-            ru.run()
-            ti = init(TarballIt)
-            ti.run(sorted_repos, version)
+    # once nothing changes the bundle anymore
+    sched.add(init(WriteManifest))
 
-        # do manifest on windows
+    if IS_MAC:
+        sched.add(init(DmgIt), sorted_repos, version)
+    elif IS_WIN:
+        sched.add(init(ZipIt), sorted_repos, version, None, args.dedup)
+    else:
+        sched.add(init(TarballIt), sorted_repos, version,
+                  args.compression, None, args.dedup)
+
+    if plan_path is not None:
+        statuses, plan = sched.plan()
+        write_plan(plan_path or os.path.join(bd, "build-plan.json"),
+                   os.path.join(bd, "Bitmask"), statuses, plan,
+                   version=version, versions_file=versions_path)
+        return
+
+    if report_path is None:
+        report_path = os.path.join(bd, "build-report.json")
+
+    instrument.start()
+    try:
+        sched.run()
+    finally:
+        instrument.stop()
+        instrument.write_report(report_path, version=version,
+                                versions_file=versions_path,
+                                jobs=args.jobs)
+        instrument.print_summary()
+        print "Build report written to", report_path
+    sched.print_critical_path()
+
+    if cache is not None:
+        # once per build, it walks the whole store
+        cache.gc()
+
+
+def write_plan(path, bundle, statuses, plan, **info):
+    """
+    Write the status of each action and the files the bundle would have,
+    relative to bundle, to path as json and print a summary.
+    """
+    data = dict(info)
+    data["actions"] = [{"action": task.label, "status": status,
+                        "bytes": plan.copied.get(task.label, 0)}
+                       for task, status in statuses]
+    data["files"] = [{"path": os.path.relpath(dst, bundle),
+                      "source": entry["source"], "size": entry["size"],
+                      "link": entry["link"]}
+                     for dst, entry in sorted(plan.files.items())]
+    data["total_files"] = len(plan.files)
+    data["total_size"] = sum(e["size"] or 0 for e in plan.files.values())
+    data["bytes_to_copy"] = sum(plan.copied.get(task.label, 0)
+                                for task, status in statuses
+                                if status in ("would run", "from cache"))
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+    print "{0:<24} {1:<12} {2:>10}".format("action", "status", "MB")
+    for entry in data["actions"]:
+        print "{0:<24} {1:<12} {2:>10.1f}".format(
+            entry["action"], entry["status"],
+            entry["bytes"] / (1024.0 * 1024))
+    print "{0} files, {1:.1f} MB, {2:.1f} MB to copy".format(
+        data["total_files"], data["total_size"] / (1024.0 * 1024),
+        data["bytes_to_copy"] / (1024.0 * 1024))
+    print "Build plan written to", path
+
+
+def print_batch_summary(times):
+    """
+    Print how long each version took and the time spent on the mirrors,
+    which is shared by all of them.
+    """
+    shared = sum(actions.fetched_mirrors.values())
+    print "Built {0} versions in {1:.1f}s".format(
+        len(times), sum(t for _, t in times))
+    print "  {0:<30} {1:>8.1f}s  ({2} mirrors fetched once)".format(
+        "shared", shared, len(actions.fetched_mirrors))
+    for name, seconds in times:
+        print "  {0:<30} {1:>8.1f}s".format(name, seconds)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,322 @@
+import os
+import sys
+import threading
+import time
+
+import fastcopy
+
+
+class Task(object):
+    """
+    An action together with the arguments to run it with.
+    """
+
+    def __init__(self, action, args):
+        self.action = action
+        self.args = args
+        self.deps = []
+        self.start = None
+        self.end = None
+        # whether the run of this task may have changed its outputs
+        self.changed = False
+        # what happened to it: ran, cached, up to date, skipped or failed
+        self.status = None
+
+    @property
+    def label(self):
+        return type(self.action).__name__
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    def depends_on(self, other):
+        """
+        Return True if this task needs to wait for `other`, which was added
+        before it.
+
+        That is the case if one of them writes something that the other
+        one reads or writes.
+        """
+        mine = set(self.action.inputs) | set(self.action.outputs)
+        if set(other.action.outputs) & mine:
+            return True
+        return bool(set(other.action.inputs) & set(self.action.outputs))
+
+
+class Scheduler(object):
+    """
+    Run actions concurrently, respecting the dependencies given by the
+    inputs and outputs that each action declares.
+
+    Actions are added in the order a sequential build would run them, an
+    action only waits for the earlier ones it shares a resource with.
+    """
+
+    def __init__(self, jobs=1, stamps_dir=None, force=False,
+                 instrument=None, cache=None):
+        """
+        Constructor
+
+        :param jobs: maximum amount of actions running at the same time
+        :type jobs: int
+        :param stamps_dir: where to keep the fingerprints of the finished
+                           actions, None disables the incremental builds
+        :type stamps_dir: str
+        :param force: run every action even if it is up to date
+        :type force: bool
+        :param instrument: measures the resources used by each action
+        :type instrument: Instrument or None
+        :param cache: where the outputs of the cached actions are kept
+        :type cache: StageCache or None
+        """
+        self._jobs = max(1, jobs)
+        self._stamps_dir = stamps_dir
+        self._force = force
+        self._instrument = instrument
+        self._cache = cache
+        self._tasks = []
+        self._start = None
+        self._end = None
+
+    def add(self, action, *args):
+        """
+        Add an action to the build, it will be run with the given args.
+        """
+        task = Task(action, args)
+        task.deps = [t for t in self._tasks if task.depends_on(t)]
+        self._tasks.append(task)
+        return task
+
+    def run(self):
+        """
+        Run all the added actions. If one of them fails no new actions are
+        started and the error is re-raised once the running ones finish.
+        """
+        pending = list(self._tasks)
+        running = []
+        done = set()
+        errors = []
+        cond = threading.Condition()
+
+        def execute(task):
+            record = None
+            if self._instrument is not None:
+                record = self._instrument.begin(task.label)
+            try:
+                self._execute(task)
+            except Exception:
+                task.status = "failed"
+                errors.append(sys.exc_info())
+            finally:
+                task.end = time.time()
+                if record is not None:
+                    self._instrument.end(record, task.status)
+                with cond:
+                    running.remove(task)
+                    done.add(task)
+                    cond.notify()
+
+        self._start = time.time()
+        with cond:
+            while pending or running:
+                if not errors:
+                    for task in list(pending):
+                        if len(running) >= self._jobs:
+                            break
+                        if all(d in done for d in task.deps):
+                            pending.remove(task)
+                            running.append(task)
+                            task.start = time.time()
+                            t = threading.Thread(target=execute,
+                                                 args=(task,))
+                            t.daemon = True
+                            t.start()
+                elif not running:
+                    break
+                # wait with a timeout so a Ctrl+C reaches the main thread
+                cond.wait(0.5)
+        self._end = time.time()
+
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+
+    def plan(self):
+        """
+        Say what running the added actions would do, without touching the
+        bundle. The actions that prepare the sources are run for real, the
+        bundle is made from them, the others are planned in order.
+
+        :return: the status each action would have, 'would run', 'up to
+                 date', 'from cache' or 'skipped', and the plan of the
+                 whole bundle
+        :rtype: tuple(list of tuple(Task, str), fastcopy.Plan)
+        """
+        ran = set()
+        for task in self._tasks:
+            if task.action.prepares_sources:
+                self._execute(task)
+                if task.changed:
+                    ran.add(task)
+
+        statuses = []
+        with fastcopy.planning() as plan:
+            for task in self._tasks:
+                action = task.action
+                if action.prepares_sources:
+                    statuses.append((task, task.status))
+                    continue
+                status = self._plan_status(task, ran)
+                # a skipped action passes on the changes of the ones
+                # before it
+                if (status in ("would run", "from cache") or
+                        (status == "skipped" and
+                         any(d in ran for d in task.deps))):
+                    ran.add(task)
+                statuses.append((task, status))
+                if action.enabled:
+                    plan.action = task.label
+                    action.plan(*task.args)
+                    plan.action = None
+        return statuses, plan
+
+    def _plan_status(self, task, ran):
+        """
+        Return what _execute would do with task, given the tasks that ran
+        before it.
+        """
+        action = task.action
+        if not action.enabled:
+            return "skipped"
+        if self._stamps_dir is None or not action.stamped:
+            return "would run"
+        fingerprint = action.fingerprint(*task.args)
+        if (not self._force and not any(d in ran for d in task.deps) and
+                self._read_stamp(task) == fingerprint):
+            return "up to date"
+        if (not self._force and self._cache is not None and action.cached
+                and self._cache.contains(fingerprint)):
+            return "from cache"
+        return "would run"
+
+    def _stamp_path(self, task):
+        return os.path.join(self._stamps_dir, task.label)
+
+    def _read_stamp(self, task):
+        try:
+            with open(self._stamp_path(task), 'r') as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    def _write_stamp(self, task, fingerprint):
+        if not os.path.isdir(self._stamps_dir):
+            os.makedirs(self._stamps_dir)
+        with open(self._stamp_path(task), 'w') as f:
+            f.write(fingerprint)
+
+    def _remove_stamp(self, task):
+        if os.path.isfile(self._stamp_path(task)):
+            os.remove(self._stamp_path(task))
+
+    def _execute(self, task):
+        """
+        Run the task unless it is up to date. An action is up to date if
+        nothing it depends on ran and its fingerprint matches the stamp of
+        its last successful run.
+        """
+        action = task.action
+        upstream_changed = any(d.changed for d in task.deps)
+
+        if not action.enabled or self._stamps_dir is None:
+            action.run(*task.args)
+            task.status = "ran" if action.enabled else "skipped"
+            # a skipped action passes on the changes of the ones before it
+            task.changed = action.enabled or upstream_changed
+            return
+
+        fingerprint = action.fingerprint(*task.args)
+
+        if not action.stamped:
+            action.run(*task.args)
+            task.status = "ran"
+            task.changed = action.fingerprint(*task.args) != fingerprint
+            return
+
+        if (not self._force and not upstream_changed and
+                self._read_stamp(task) == fingerprint):
+            print "UP TO DATE: {0}...".format(action.name)
+            task.status = "up to date"
+            return
+
+        self._remove_stamp(task)
+        if self._cache is not None and action.cached:
+            self._run_cached(task, fingerprint)
+        else:
+            action.run(*task.args)
+            task.status = "ran"
+        if action.stamps_after_run:
+            fingerprint = action.fingerprint(*task.args)
+        self._write_stamp(task, fingerprint)
+        task.changed = True
+
+    def _run_cached(self, task, fingerprint):
+        """
+        Restore the outputs of the task from the stage cache, or run it and
+        keep the files it creates there.
+        """
+        action = task.action
+        if not self._force and self._cache.restore(fingerprint,
+                                                   action.basedir):
+            print "FROM CACHE: {0}...".format(action.name)
+            task.status = "cached"
+            return
+
+        with fastcopy.recording() as created:
+            action.run(*task.args)
+        task.status = "ran"
+        self._cache.store(fingerprint, task.label, action.basedir, created)
+
+    def critical_path(self):
+        """
+        Return the chain of finished tasks that bounds the total build time.
+
+        :rtype: list of Task
+        """
+        longest = {}
+        previous = {}
+        for task in self._tasks:
+            best = None
+            for dep in task.deps:
+                if best is None or longest[dep] > longest[best]:
+                    best = dep
+            previous[task] = best
+            longest[task] = task.duration
+            if best is not None:
+                longest[task] += longest[best]
+
+        if not longest:
+            return []
+
+        last = max(self._tasks, key=lambda t: longest[t])
+        path = []
+        while last is not None:
+            path.append(last)
+            last = previous[last]
+        path.reverse()
+        return path
+
+    def print_critical_path(self):
+        path = self.critical_path()
+        total = sum(t.duration for t in path)
+        wall = 0.0
+        if self._start is not None and self._end is not None:
+            wall = self._end - self._start
+
+        print "Critical path: {0:.1f}s of {1:.1f}s wall time".format(
+            total, wall)
+        for task in path:
+            print "  {0:<20} {1:>8.1f}s".format(task.label, task.duration)
@@ -0,0 +1,237 @@
+"""
+Content addressed store for the outputs of the build stages.
+
+An entry is kept for each fingerprint of a cached action, listing the
+files it created relative to the build dir. The contents of the files are
+kept once, named by their hash, so builds of different versions share
+everything that didn't change between them.
+
+The objects are copies of their own, never hardlinks, and read-only: an
+object sharing its inode with a file of the build dir, the virtualenv or
+a repository would change, keeping its name, whenever that file is edited
+in place. For the same reason restoring an entry copies the objects into
+the build dir, as reflinks where the filesystem supports them, with the
+mode each file had.
+
+Layout of the store:
+  objects/<xx>/<sha256>-<mode>  the contents of the files
+  entries/<fingerprint>.json    the files of each stage output
+"""
+import errno
+import json
+import os
+import tempfile
+import time
+
+import fastcopy
+
+# default maximum size of the store, in MB
+DEFAULT_MAX_SIZE = 10 * 1024
+
+# objects changed less than this many seconds ago are never collected
+RECENT = 60 * 60
+
+# the permission bits an object is kept with, whatever the file's mode
+READ_ONLY = 0555
+
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def _write_json(path, data):
+    """
+    Write data to path atomically, so concurrent builds never read half
+    an entry.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
+class StageCache(object):
+
+    def __init__(self, root, max_size=DEFAULT_MAX_SIZE):
+        """
+        Constructor
+
+        :param root: directory of the store
+        :type root: str
+        :param max_size: size in MB above which the least recently used
+                         entries are removed
+        :type max_size: int
+        """
+        self._root = root
+        self._objects_dir = os.path.join(root, "objects")
+        self._entries_dir = os.path.join(root, "entries")
+        self._max_size = max_size * 1024 * 1024
+        _mkdir_p(self._objects_dir)
+        _mkdir_p(self._entries_dir)
+
+    def _entry_path(self, key):
+        return os.path.join(self._entries_dir, key + ".json")
+
+    def _object_path(self, name):
+        return os.path.join(self._objects_dir, name[:2], name)
+
+    def _is_stored(self, obj):
+        """
+        Return whether the object at obj is there and read-only, the ones
+        kept writable by older versions of the store may be hardlinks and
+        are stored again.
+        """
+        try:
+            return not os.stat(obj).st_mode & 0222
+        except OSError:
+            return False
+
+    def _load(self, key):
+        try:
+            with open(self._entry_path(key), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _entries_by_key(self):
+        entries = {}
+        for name in os.listdir(self._entries_dir):
+            if name.endswith(".json"):
+                entry = self._load(name[:-len(".json")])
+                if entry is not None:
+                    entries[entry["key"]] = entry
+        return entries
+
+    def contains(self, key):
+        """
+        Return whether there is a complete entry for key.
+
+        :rtype: bool
+        """
+        entry = self._load(key)
+        if entry is None:
+            return False
+        return all(os.path.isfile(self._object_path(name))
+                   for _, name in entry["files"])
+
+    def restore(self, key, basedir):
+        """
+        Materialize the files stored for key under basedir.
+
+        :return: whether there was a complete entry for key
+        :rtype: bool
+        """
+        entry = self._load(key)
+        if entry is None:
+            return False
+        objects = [self._object_path(name) for _, name in entry["files"]]
+        if not all(os.path.isfile(o) for o in objects):
+            return False
+
+        for (relpath, name), obj in zip(entry["files"], objects):
+            dest = os.path.join(basedir, relpath)
+            _mkdir_p(os.path.dirname(dest))
+            digest, mode = name.rsplit("-", 1)
+            fastcopy.copy_file(obj, dest, link=False)
+            os.chmod(dest, int(mode, 8))
+            fastcopy.remember_digest(dest, digest)
+        for relpath, target in entry["links"]:
+            dest = os.path.join(basedir, relpath)
+            _mkdir_p(os.path.dirname(dest))
+            if os.path.lexists(dest):
+                os.remove(dest)
+            os.symlink(target, dest)
+
+        entry["used"] = time.time()
+        _write_json(self._entry_path(key), entry)
+        return True
+
+    def store(self, key, name, basedir, paths):
+        """
+        Keep the files in paths, all of them under basedir, as the entry
+        for key. Paths that don't exist anymore are ignored.
+        """
+        files, links = [], []
+        size = 0
+        for path in sorted(paths):
+            relpath = os.path.relpath(path, basedir)
+            if os.path.islink(path):
+                links.append([relpath, os.readlink(path)])
+                continue
+            if not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            obj_name = "{0}-{1:o}".format(fastcopy.digest(path),
+                                          st.st_mode & 0777)
+            obj = self._object_path(obj_name)
+            if not self._is_stored(obj):
+                _mkdir_p(os.path.dirname(obj))
+                tmp = "{0}.{1}.tmp".format(obj, os.getpid())
+                fastcopy.copy_file(path, tmp, link=False)
+                os.chmod(tmp, st.st_mode & READ_ONLY)
+                os.rename(tmp, obj)
+            files.append([relpath, obj_name])
+            size += st.st_size
+
+        now = time.time()
+        _write_json(self._entry_path(key), {
+            "key": key, "name": name, "created": now, "used": now,
+            "size": size, "files": files, "links": links})
+
+    def stats(self):
+        """
+        Return the entries, sorted by last use, and the size of the store.
+
+        :rtype: tuple(list of dict, int)
+        """
+        entries = sorted(self._entries_by_key().values(),
+                         key=lambda e: e["used"], reverse=True)
+        return entries, self._objects_size()
+
+    def _objects(self):
+        for dirpath, dirs, files in os.walk(self._objects_dir):
+            for name in files:
+                if not name.endswith(".tmp"):
+                    yield name, os.path.join(dirpath, name)
+
+    def _objects_size(self):
+        return sum(os.path.getsize(path) for _, path in self._objects())
+
+    def gc(self, max_size=None):
+        """
+        Remove the least recently used entries until the objects that are
+        left fit in max_size bytes, then the objects no entry uses.
+
+        :return: the amount of entries and bytes removed
+        :rtype: tuple(int, int)
+        """
+        if max_size is None:
+            max_size = self._max_size
+
+        sizes = dict((name, os.path.getsize(path))
+                     for name, path in self._objects())
+        entries = sorted(self._entries_by_key().values(),
+                         key=lambda e: e["used"])
+
+        def used_size():
+            names = set(name for e in entries for _, name in e["files"])
+            return sum(sizes.get(name, 0) for name in names)
+
+        removed_entries = 0
+        while entries and used_size() > max_size:
+            os.remove(self._entry_path(entries.pop(0)["key"]))
+            removed_entries += 1
+
+        used = set(name for e in entries for _, name in e["files"])
+        removed_bytes = 0
+        recent = time.time() - RECENT
+        for name, path in list(self._objects()):
+            # a build may be storing it and not have written its entry yet
+            if name not in used and os.stat(path).st_ctime < recent:
+                removed_bytes += sizes.get(name, 0)
+                os.remove(path)
+        return removed_entries, removed_bytes
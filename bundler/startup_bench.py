@@ -0,0 +1,104 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import ziplib
+
+from treeprocess import process_tree, Delete
+
+# what the launcher does, more or less: the lib dir first on sys.path and
+# site imported from there
+STARTUP = "import sys; sys.path.insert(0, {0!r}); import site; import {1}"
+
+
+def _remove_pyc(lib_dir):
+    process_tree(lib_dir, [Delete("pyc", ["*.pyc", "*.pyo"])],
+                 lambda msg: None)
+
+
+def _drop_caches():
+    """
+    Empty the page cache, so the files are read from disk again. Only
+    root can do it.
+    """
+    subprocess.check_call(["sync"])
+    with open("/proc/sys/vm/drop_caches", 'w') as f:
+        f.write("3\n")
+
+
+def _time_import(python, lib_dir, module):
+    start = time.time()
+    subprocess.check_call([python, "-S", "-E", "-c",
+                           STARTUP.format(lib_dir, module)])
+    return time.time() - start
+
+
+def _bench(name, python, lib_dir, module, runs, drop_caches, prepare):
+    """
+    Time runs cold starts, each after calling prepare, and then runs warm
+    ones.
+    """
+    cold = []
+    for _ in range(runs):
+        prepare()
+        if drop_caches:
+            _drop_caches()
+        cold.append(_time_import(python, lib_dir, module))
+    _time_import(python, lib_dir, module)
+    warm = [_time_import(python, lib_dir, module) for _ in range(runs)]
+    return name, cold, warm
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the startup time with loose and zipped libs.')
+    parser.add_argument('lib', help="the lib dir of a bundle")
+    parser.add_argument('--python', default=sys.executable,
+                        help="the interpreter of the bundle")
+    parser.add_argument('--module', default="leap.bitmask.app",
+                        help="the module to import")
+    parser.add_argument('--runs', type=int, default=5,
+                        help="how many cold and warm starts to time")
+    parser.add_argument('--drop-caches', action="store_true",
+                        help="empty the page cache before each cold start, "
+                             "needs root")
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp(prefix="bundler-bench-")
+    results = []
+    try:
+        # as it is shipped now, without the .pyc files
+        loose = os.path.join(out_dir, "loose", "lib")
+        shutil.copytree(args.lib, loose, symlinks=True)
+        _remove_pyc(loose)
+        results.append(_bench("loose", args.python, loose, args.module,
+                              args.runs, args.drop_caches,
+                              lambda: _remove_pyc(loose)))
+
+        zipped = os.path.join(out_dir, "zipped", "lib")
+        shutil.copytree(args.lib, zipped, symlinks=True)
+        zipped_files, loose_files, size = ziplib.pack_lib(zipped,
+                                                          args.python)
+        print "zipped {0} files ({1} bytes), {2} left loose".format(
+            zipped_files, size, loose_files)
+        results.append(_bench("zipped", args.python, zipped, args.module,
+                              args.runs, args.drop_caches, lambda: None))
+    finally:
+        shutil.rmtree(out_dir)
+
+    def median(values):
+        return sorted(values)[len(values) / 2]
+
+    print "{0:<10} {1:>10} {2:>10} {3:>10} {4:>10}".format(
+        "layout", "cold min", "cold med", "warm min", "warm med")
+    for name, cold, warm in results:
+        print "{0:<10} {1:>10.3f} {2:>10.3f} {3:>10.3f} {4:>10.3f}".format(
+            name, min(cold), median(cold), min(warm), median(warm))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Tests for the planning of the install_name_tool changes, on a fixture
+bundle of Mach-O files.
+
+Run them with `python -m unittest discover -s bundler`.
+"""
+import os
+import unittest
+
+from darwin_dyliber import plan_all, plan_file
+from test_macho import FixtureTestCase, make_fat, make_macho
+
+
+class PlanAllTest(FixtureTestCase):
+
+    def setUp(self):
+        FixtureTestCase.setUp(self)
+        self.fixture("Bitmask", make_macho(
+            dylibs=["/usr/local/lib/libfoo.1.dylib", "@rpath/QtCore",
+                    "/usr/lib/libSystem.B.dylib",
+                    "/System/Library/Frameworks/Carbon.framework/Carbon"],
+            rpaths=["/usr/local/lib"]))
+        self.fixture(os.path.join("lib", "libfoo.1.dylib"), make_macho(
+            id="/usr/local/lib/libfoo.1.dylib",
+            dylibs=["/usr/lib/libSystem.B.dylib"]))
+        self.fixture(os.path.join("lib", "QtCore"), make_fat(
+            make_macho(id="QtCore", is_64=False, endian="<"),
+            make_macho(id="QtCore")))
+        self.fixture(os.path.join("lib", "site.py"), "import os\n")
+
+    def test_plan(self):
+        lib = os.path.join(self.tmp, "lib")
+        self.assertEqual(plan_all(self.tmp), {
+            os.path.join(self.tmp, "Bitmask"): [
+                "-change", "/usr/local/lib/libfoo.1.dylib",
+                "@executable_path/lib/libfoo.1.dylib",
+                "-change", "@rpath/QtCore", "@executable_path/lib/QtCore"],
+            os.path.join(lib, "libfoo.1.dylib"): [
+                "-id", "@executable_path/lib/libfoo.1.dylib"],
+            os.path.join(lib, "QtCore"): [
+                "-id", "@executable_path/lib/QtCore"],
+        })
+
+    def test_fixed_files_are_left_alone(self):
+        self.fixture(os.path.join("lib", "libfoo.1.dylib"), make_macho(
+            id="@executable_path/lib/libfoo.1.dylib",
+            dylibs=["@executable_path/lib/QtCore"]))
+        plan = plan_all(self.tmp)
+        self.assertNotIn(os.path.join(self.tmp, "lib", "libfoo.1.dylib"),
+                         plan)
+
+    def test_first_file_with_a_name_is_linked(self):
+        self.fixture(os.path.join("lib", "zzz", "libfoo.1.dylib"),
+                     make_macho(id="libfoo.1.dylib"))
+        plan = plan_all(self.tmp)
+        self.assertEqual(plan[os.path.join(self.tmp, "lib", "zzz",
+                                           "libfoo.1.dylib")],
+                         ["-id", "@executable_path/lib/libfoo.1.dylib"])
+
+    def test_malformed_file_is_left_alone(self):
+        data = make_macho(id="libbad.dylib")
+        path = self.fixture(os.path.join("lib", "libbad.dylib"),
+                            data[:16])
+        self.assertEqual(plan_file(self.tmp, {}, path), [])
+        self.assertNotIn(path, plan_all(self.tmp))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Tests for the Mach-O reader, on fixture binaries written by make_macho and
+make_fat.
+
+Run them with `python -m unittest discover -s bundler`.
+"""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from macho import read_dylibs, MachOError
+from macho import FAT_MAGIC, MH_MAGIC, MH_MAGIC_64
+from macho import LC_ID_DYLIB, LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_RPATH
+
+CPU_TYPE_X86 = 7
+CPU_TYPE_X86_64 = CPU_TYPE_X86 | 0x01000000
+MH_EXECUTE = 2
+
+
+def _string_command(endian, cmd, fields, string, align):
+    """
+    Return a load command that ends with string, after the offset of the
+    string and the other fields.
+    """
+    fixed = 12 + 4 * len(fields)
+    data = string + "\0"
+    data += "\0" * (-(fixed + len(data)) % align)
+    return struct.pack(endian + "3I" + "I" * len(fields), cmd,
+                       fixed + len(data), fixed, *fields) + data
+
+
+def make_macho(id=None, dylibs=(), rpaths=(), is_64=True, endian=">",
+               weak=()):
+    """
+    Return a thin Mach-O with the given install name, dylibs (loaded weak
+    if they are in weak) and rpaths.
+    """
+    align = 8 if is_64 else 4
+    commands = []
+    if id is not None:
+        commands.append(_string_command(endian, LC_ID_DYLIB, [2, 0, 0], id,
+                                        align))
+    for dylib in dylibs:
+        cmd = LC_LOAD_WEAK_DYLIB if dylib in weak else LC_LOAD_DYLIB
+        commands.append(_string_command(endian, cmd, [2, 0, 0], dylib,
+                                        align))
+    for rpath in rpaths:
+        commands.append(_string_command(endian, LC_RPATH, [], rpath, align))
+
+    magic = MH_MAGIC_64 if is_64 else MH_MAGIC
+    cputype = CPU_TYPE_X86_64 if is_64 else CPU_TYPE_X86
+    header = struct.pack(endian + "7I", magic, cputype, 3, MH_EXECUTE,
+                         len(commands), sum(len(c) for c in commands), 0)
+    if is_64:
+        header += struct.pack(endian + "I", 0)
+    return header + "".join(commands)
+
+
+def make_fat(*thins):
+    """
+    Return a universal binary with the given thin ones.
+    """
+    offset = 8 + 20 * len(thins)
+    archs, body = [], ""
+    for thin in thins:
+        padding = "\0" * (-(offset + len(body)) % 64)
+        body += padding
+        archs.append(struct.pack(">5I", CPU_TYPE_X86, 3, offset + len(body),
+                                 len(thin), 6))
+        body += thin
+    return struct.pack(">2I", FAT_MAGIC, len(thins)) + "".join(archs) + body
+
+
+class FixtureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="bundler-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def fixture(self, relpath, data):
+        path = os.path.join(self.tmp, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+class ReadDylibsTest(FixtureTestCase):
+
+    def test_thin_64_big_endian(self):
+        path = self.fixture("libfoo.dylib", make_macho(
+            id="/usr/local/lib/libfoo.dylib",
+            dylibs=["/usr/lib/libSystem.B.dylib", "@rpath/QtCore"],
+            rpaths=["@loader_path/../lib"]))
+        macho = read_dylibs(path)
+        self.assertEqual(macho.id, "/usr/local/lib/libfoo.dylib")
+        self.assertEqual(macho.dylibs,
+                         ["/usr/lib/libSystem.B.dylib", "@rpath/QtCore"])
+        self.assertEqual(macho.rpaths, ["@loader_path/../lib"])
+
+    def test_thin_32_little_endian(self):
+        path = self.fixture("Bitmask", make_macho(
+            dylibs=["libbar.dylib", "libweak.dylib"], weak=["libweak.dylib"],
+            rpaths=["@executable_path/lib", "/opt/lib"], is_64=False,
+            endian="<"))
+        macho = read_dylibs(path)
+        self.assertIsNone(macho.id)
+        self.assertEqual(macho.dylibs, ["libbar.dylib", "libweak.dylib"])
+        self.assertEqual(macho.rpaths, ["@executable_path/lib", "/opt/lib"])
+
+    def test_fat_merges_the_archs(self):
+        path = self.fixture("libfat.dylib", make_fat(
+            make_macho(id="libfat.dylib", dylibs=["libA.dylib"],
+                       rpaths=["@loader_path"], is_64=False, endian="<"),
+            make_macho(id="libfat.dylib",
+                       dylibs=["libA.dylib", "libB.dylib"],
+                       rpaths=["@loader_path"])))
+        macho = read_dylibs(path)
+        self.assertEqual(macho.id, "libfat.dylib")
+        self.assertEqual(macho.dylibs, ["libA.dylib", "libB.dylib"])
+        self.assertEqual(macho.rpaths, ["@loader_path"])
+
+    def test_not_macho(self):
+        self.assertIsNone(read_dylibs(self.fixture("a.py", "import os\n")))
+        self.assertIsNone(read_dylibs(self.fixture("short", "\xfe")))
+
+    def test_java_class_is_not_fat(self):
+        # same magic as a fat binary, then the class file version
+        path = self.fixture("A.class", struct.pack(">2I", FAT_MAGIC, 50))
+        self.assertIsNone(read_dylibs(path))
+
+    def test_truncated_commands(self):
+        data = make_macho(dylibs=["libfoo.dylib"])
+        path = self.fixture("truncated", data[:-8])
+        self.assertRaises(MachOError, read_dylibs, path)
+
+    def test_truncated_header(self):
+        data = make_macho(dylibs=["libfoo.dylib"])
+        path = self.fixture("truncated", data[:16])
+        self.assertRaises(MachOError, read_dylibs, path)
+
+    def test_truncated_fat_archs(self):
+        data = make_fat(make_macho(id="a.dylib"), make_macho(id="b.dylib"))
+        path = self.fixture("truncated", data[:8 + 20 + 10])
+        self.assertRaises(MachOError, read_dylibs, path)
+
+    def test_too_many_commands(self):
+        data = make_macho(dylibs=["libfoo.dylib"])
+        # ncmds says there is one more command than sizeofcmds holds
+        data = data[:16] + struct.pack(">I", 2) + data[20:]
+        path = self.fixture("ncmds", data)
+        self.assertRaises(MachOError, read_dylibs, path)
+
+    def test_command_larger_than_commands(self):
+        data = make_macho(dylibs=["libfoo.dylib"], rpaths=["/opt/lib"])
+        # the cmdsize of the first command, right after the header
+        data = data[:36] + struct.pack(">I", 0x1000) + data[40:]
+        path = self.fixture("cmdsize", data)
+        self.assertRaises(MachOError, read_dylibs, path)
+
+    def test_sizeofcmds_past_the_end(self):
+        data = make_macho(dylibs=["libfoo.dylib"])
+        data = data[:20] + struct.pack(">I", 0x7fffffff) + data[24:]
+        path = self.fixture("sizeofcmds", data)
+        self.assertRaises(MachOError, read_dylibs, path)
+
+
+if __name__ == "__main__":
+    unittest.main()
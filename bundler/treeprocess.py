@@ -0,0 +1,215 @@
+"""
+Post-processing of a tree in a single traversal.
+
+A list of rules is applied to every entry of the tree while walking it
+once, the first rule that matches an entry handles it. Deletions happen
+in-process and the files to `strip` are handled in batches. When fastcopy
+is planning, the rules are applied to the planned files instead and only
+the deletions change them.
+"""
+import fnmatch
+import os
+import shutil
+import subprocess
+
+from abc import ABCMeta, abstractmethod
+
+try:
+    from scandir import walk
+except ImportError:
+    from os import walk
+
+import fastcopy
+
+# how many files are given to each `strip` call
+STRIP_BATCH = 200
+
+
+def _tree_size(path):
+    """
+    Return the amount of files and bytes under path (or of path itself).
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return 1, os.lstat(path).st_size
+    count, size = 0, 0
+    for root, dirs, files in walk(path):
+        for name in files:
+            count += 1
+            size += os.lstat(os.path.join(root, name)).st_size
+    return count, size
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+class Rule(object):
+    """
+    Base rule, it matches the entries whose name matches any of patterns.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, name, patterns, dirs=False, files=True):
+        self.name = name
+        self.patterns = patterns
+        self.dirs = dirs
+        self.files = files
+        self.count = 0
+        self.bytes = 0
+
+    def matches(self, path, name, is_dir):
+        if is_dir and not self.dirs or not is_dir and not self.files:
+            return False
+        return any(fnmatch.fnmatch(name, p) for p in self.patterns)
+
+    @abstractmethod
+    def apply(self, path, is_dir, log):
+        """
+        Handle the entry, return True if it does not exist anymore.
+        """
+
+    def finish(self, log):
+        pass
+
+
+class Skip(Rule):
+    """
+    Leave the matching entries (and what is inside them) untouched.
+    """
+
+    def __init__(self, patterns):
+        Rule.__init__(self, "skip", patterns, dirs=True)
+
+    def apply(self, path, is_dir, log):
+        return True
+
+
+class Delete(Rule):
+    """
+    Delete the matching entries, directories are removed with their
+    contents.
+    """
+
+    def __init__(self, name, patterns, dirs=False):
+        Rule.__init__(self, name, patterns, dirs=dirs)
+
+    def apply(self, path, is_dir, log):
+        count, size = _tree_size(path)
+        _remove(path)
+        self.count += count
+        self.bytes += size
+        return True
+
+
+class KeepOnly(Delete):
+    """
+    Delete everything that has scope in its path, except the entries named
+    as one of keep.
+    """
+
+    def __init__(self, name, scope, keep):
+        Delete.__init__(self, name, [], dirs=True)
+        self.scope = scope
+        self.keep = keep
+
+    def matches(self, path, name, is_dir):
+        return path.find(self.scope) > 0 and name not in self.keep
+
+
+class Strip(Rule):
+    """
+    Run `strip` on the matching files, in batches once the walk is done.
+    """
+
+    def __init__(self, name, patterns, strip="strip"):
+        Rule.__init__(self, name, patterns)
+        self._strip = strip
+        self._pending = []
+
+    def apply(self, path, is_dir, log):
+        if not os.path.islink(path):
+            self._pending.append(path)
+        return False
+
+    def finish(self, log):
+        pending, self._pending = self._pending, []
+        for start in range(0, len(pending), STRIP_BATCH):
+            batch = pending[start:start + STRIP_BATCH]
+            before = sum(os.path.getsize(p) for p in batch)
+            # strip goes on with the rest of the files if one of them is
+            # not an object file, we don't care about those errors
+            try:
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.call([self._strip] + batch, stderr=devnull)
+            except OSError as e:  # no strip available, e.g. on windows
+                log("{0}: can't run {1}: {2}".format(self.name, self._strip,
+                                                     e))
+                return
+            after = sum(os.path.getsize(p) for p in batch)
+            self.count += len(batch)
+            self.bytes += before - after
+
+
+def _first_match(rules, path, name, is_dir):
+    for rule in rules:
+        if rule.matches(path, name, is_dir):
+            return rule
+    return None
+
+
+def _plan_tree(root, rules, plan):
+    """
+    Remove from plan the files under root that the rules would delete.
+    """
+    root = os.path.abspath(root)
+    for path in plan.under(root):
+        parts = os.path.relpath(path, root).split(os.sep)
+        current = root
+        rule = None
+        for i, name in enumerate(parts):
+            current = os.path.join(current, name)
+            is_dir = i < len(parts) - 1
+            rule = _first_match(rules, current, name, is_dir)
+            # only skipped and deleted dirs are not walked into
+            if not is_dir or isinstance(rule, (Skip, Delete)):
+                break
+        if isinstance(rule, Delete):
+            rule.count += 1
+            rule.bytes += plan.files.pop(path)["size"] or 0
+
+
+def _walk_tree(root, rules, log):
+    for dirpath, dirs, files in walk(root):
+        for name in list(dirs):
+            path = os.path.join(dirpath, name)
+            rule = _first_match(rules, path, name, True)
+            if rule is not None and rule.apply(path, True, log):
+                dirs.remove(name)
+
+        for name in files:
+            path = os.path.join(dirpath, name)
+            rule = _first_match(rules, path, name, False)
+            if rule is not None:
+                rule.apply(path, False, log)
+
+
+def process_tree(root, rules, log):
+    """
+    Walk root once applying rules to each entry, then report what each
+    rule did through log.
+    """
+    plan = fastcopy.current_plan()
+    if plan is not None:
+        _plan_tree(root, rules, plan)
+    else:
+        _walk_tree(root, rules, log)
+
+    for rule in rules:
+        rule.finish(log)
+        if isinstance(rule, Skip):
+            continue
+        log("{0}: {1} files, {2} bytes reclaimed".format(
+            rule.name, rule.count, rule.bytes))
@@ -1,4 +1,8 @@
+import os
 import sys
 
 IS_MAC = sys.platform == "darwin"
 IS_WIN = sys.platform == "win32"
+
+# Where the bundler keeps data that is reused between builds
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bundler")
@@ -0,0 +1,74 @@
+import Queue
+import sys
+import threading
+
+# Serializes the output of the different workers so the lines from one item
+# never get mixed with the lines from another one.
+_output_lock = threading.Lock()
+
+
+def run_parallel(func, items, jobs=1, printer=None):
+    """
+    Run `func(item, log)` for every item using a bounded pool of threads.
+
+    The messages given to `log` are buffered for each item and printed
+    together, through `printer`, once that item is done. After the first
+    failure no new items are started, the running ones are waited for and
+    the original exception is re-raised.
+
+    :param func: callable that processes one item
+    :type func: callable
+    :param items: the items to process
+    :type items: iterable
+    :param jobs: maximum amount of items processed at the same time
+    :type jobs: int
+    :param printer: callable used to output each buffered message
+    :type printer: callable
+    """
+    if printer is None:
+        printer = _print
+
+    items = list(items)
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            output = []
+            try:
+                func(item, output.append)
+            except Exception as e:
+                output.append("ERROR: {0!r}".format(e))
+                errors.append(sys.exc_info())
+            finally:
+                with _output_lock:
+                    for line in output:
+                        printer(line)
+
+    threads = []
+    for i in range(max(1, min(jobs, len(items)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        # join with a timeout so a Ctrl+C reaches the main thread
+        while t.is_alive():
+            t.join(0.5)
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+
+
+def _print(msg):
+    print msg
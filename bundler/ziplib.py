@@ -0,0 +1,273 @@
+"""
+Pack the pure python code of the bundled lib dir in a zip.
+
+Everything in lib is byte-compiled at bundle time, then the packages and
+modules that only have python code are moved into a zip, so importing them
+needs no compiling nor stat calls on loose files. What needs real files on
+disk stays loose: extension modules, packages with data files and the
+modules imported before sitecustomize puts the zip on sys.path.
+
+A package that has to stay loose, like leap for the certificates in
+leap.common, can still have pure subpackages: those are zipped under the
+same path and the zip is added to the __path__ of the loose package.
+"""
+import ast
+import compileall
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+ZIP_NAME = "python-lib.zip"
+
+MARKER = "# added by the bundler"
+
+# puts the zip before the loose lib dir
+SITECUSTOMIZE = MARKER + """: the zipped lib goes before the loose one
+import os as _os
+import sys as _sys
+_lib = _os.path.dirname(_os.path.abspath(__file__))
+_sys.path.insert(_sys.path.index(_lib) if _lib in _sys.path else 0,
+                 _os.path.join(_lib, {0!r}))
+"""
+
+# makes a loose package find its zipped subpackages
+PACKAGE_PATH = MARKER + """: the pure subpackages are zipped
+import os as _os
+__path__.append(_os.path.normpath(_os.path.join(
+    _os.path.dirname(_os.path.abspath(__file__)),
+    *{0!r})))
+
+"""
+
+PURE_EXTENSIONS = (".py", ".pyc", ".pyo")
+
+# imported by the interpreter itself, before sys.path is set up
+STARTUP_MODULES = ["encodings", "codecs", "site", "sitecustomize",
+                   "zipimport"]
+
+# nothing but sys is imported before site, to see only what it needs
+_BOOTSTRAP = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import site
+print " ".join(set(m.split(".")[0] for m, v in sys.modules.items() if v))
+"""
+
+
+def bootstrap_modules(lib_dir, python=sys.executable):
+    """
+    Return the top level modules that are imported before sitecustomize
+    can put the zip on sys.path, they have to stay loose.
+
+    :rtype: set of str
+    """
+    out = subprocess.check_output([python, "-S", "-E", "-c", _BOOTSTRAP,
+                                   lib_dir])
+    return set(out.split()) | set(STARTUP_MODULES)
+
+
+def _is_package(path):
+    return (os.path.isdir(path) and not os.path.islink(path) and
+            os.path.isfile(os.path.join(path, "__init__.py")))
+
+
+def _is_pure(path):
+    """
+    Return True if everything in the package at path is python code.
+    """
+    for root, dirs, files in os.walk(path):
+        if not all(name.endswith(PURE_EXTENSIONS) for name in files):
+            return False
+        if not all(_is_package(os.path.join(root, name)) for name in dirs):
+            return False
+    return True
+
+
+def _zippable(lib_dir, relpath=""):
+    """
+    Return the entries under relpath that can go in the zip, and the loose
+    packages that need the zip in their __path__.
+
+    :rtype: tuple(list of str, list of str)
+    """
+    entries, packages = [], []
+    path = os.path.join(lib_dir, relpath)
+    for name in sorted(os.listdir(path)):
+        child = os.path.join(relpath, name)
+        if _is_package(os.path.join(lib_dir, child)):
+            if _is_pure(os.path.join(lib_dir, child)):
+                entries.append(child)
+            else:
+                sub_entries, sub_packages = _zippable(lib_dir, child)
+                entries.extend(sub_entries)
+                packages.extend(sub_packages)
+        elif not relpath and name.endswith(PURE_EXTENSIONS):
+            # the modules inside loose packages may look for data files
+            # next to them
+            entries.append(child)
+
+    if relpath and any(os.path.dirname(e) == relpath for e in entries):
+        packages.append(relpath)
+    return entries, packages
+
+
+def _entry_files(lib_dir, relpath):
+    path = os.path.join(lib_dir, relpath)
+    if not os.path.isdir(path):
+        return [relpath]
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            files.append(os.path.relpath(os.path.join(root, name), lib_dir))
+    return files
+
+
+def _already_added(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'r') as f:
+        return MARKER in f.read()
+
+
+def _replace(path, data):
+    """
+    Write data to a new file that takes the place of the one at path. The
+    file may be a hardlink to the virtualenv or the stage cache, those must
+    not change.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    if os.path.exists(path):
+        shutil.copymode(path, tmp)
+        os.remove(path)
+    else:
+        os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+
+
+def _append(path, text):
+    """
+    Append text to the file at path unless it was already added.
+    """
+    if _already_added(path):
+        return
+    source = ""
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            source = f.read()
+    _replace(path, source + "\n" + text)
+
+
+def _insert(path, text):
+    """
+    Insert text in the module at path before its first statement that is
+    not the docstring or a __future__ import, unless it was already added.
+    The package may import its subpackages, they have to be found then.
+    """
+    if _already_added(path):
+        return
+    with open(path, 'r') as f:
+        source = f.read()
+    lines = source.splitlines(True)
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+
+    body = ast.parse(source).body
+    if (body and isinstance(body[0], ast.Expr) and
+            isinstance(body[0].value, ast.Str)):
+        body = body[1:]
+    while (body and isinstance(body[0], ast.ImportFrom) and
+           body[0].module == "__future__"):
+        body = body[1:]
+    index = body[0].lineno - 1 if body else len(lines)
+
+    _replace(path, "".join(lines[:index] + [text] + lines[index:]))
+
+
+def _copied_again(lib_dir, relpath):
+    """
+    Return True if the module of the file at relpath is loose in lib_dir.
+    """
+    stem = os.path.splitext(os.path.join(lib_dir, relpath))[0]
+    return any(os.path.isfile(stem + ext) for ext in PURE_EXTENSIONS)
+
+
+def _unpack(lib_dir, zip_path):
+    """
+    Put back in lib_dir what an earlier run moved to the zip at zip_path
+    and was not copied again since, then remove the zip.
+    """
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        for name in zf.namelist():
+            if not _copied_again(lib_dir, os.path.normpath(name)):
+                zf.extract(name, lib_dir)
+    os.remove(zip_path)
+
+
+def pack_lib(lib_dir, python=sys.executable, log=None):
+    """
+    Byte-compile lib_dir and move its pure python code to ZIP_NAME in it.
+
+    :param python: interpreter used to find the modules needed at startup
+    :type python: str
+    :return: the amount of files zipped, the amount left loose and the
+             size of the zip
+    :rtype: tuple(int, int, int)
+    """
+    if log is None:
+        log = lambda msg: None
+
+    # the zip is made again from scratch, with the loose files copied
+    # since an earlier run instead of their old versions
+    zip_path = os.path.join(lib_dir, ZIP_NAME)
+    if os.path.isfile(zip_path):
+        log("unpacking the zip of an earlier run...")
+        _unpack(lib_dir, zip_path)
+
+    log("byte-compiling {0}...".format(lib_dir))
+    compileall.compile_dir(lib_dir, maxlevels=100, quiet=1)
+
+    loose = bootstrap_modules(lib_dir, python)
+    entries, packages = _zippable(lib_dir)
+    entries = [e for e in entries if e.split(os.sep)[0].split(".")[0]
+               not in loose]
+    packages = [p for p in packages
+                if any(os.path.dirname(e) == p for e in entries)]
+    log("zipping {0} packages and modules...".format(len(entries)))
+
+    zipped = 0
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for entry in entries:
+            for relpath in _entry_files(lib_dir, entry):
+                zf.write(os.path.join(lib_dir, relpath),
+                         relpath.replace(os.sep, "/"))
+                zipped += 1
+
+    for entry in entries:
+        path = os.path.join(lib_dir, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    changed = [os.path.join(lib_dir, "sitecustomize.py")]
+    _append(changed[0], SITECUSTOMIZE.format(ZIP_NAME))
+    for package in packages:
+        depth = len(package.split(os.sep))
+        parts = [os.pardir] * depth + [ZIP_NAME] + package.split(os.sep)
+        changed.append(os.path.join(lib_dir, package, "__init__.py"))
+        _insert(changed[-1], PACKAGE_PATH.format(parts))
+    for path in changed:
+        # py_compile writes in place, the old ones could be links too
+        for compiled in (path + "c", path + "o"):
+            if os.path.exists(compiled):
+                os.remove(compiled)
+        compileall.compile_file(path, force=True, quiet=1)
+
+    left = sum(len(files) for _, _, files in os.walk(lib_dir)) - 1
+    return zipped, left, os.path.getsize(zip_path)
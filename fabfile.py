@@ -3,7 +3,9 @@
 import json
 import os
 
-from fabric.api import task, cd, env, require, run, put
+from fabric.api import task, cd, env, require, run, put, settings
+
+import tufsync
 
 
 @task
@@ -42,6 +44,13 @@ def update():
     path = os.path.join(env.tuf_path, arch)
     print arch, env.repo_file, path
 
+    with settings(warn_only=True):
+        synced = run('test -L {0}'.format(
+            os.path.join(path, tufsync.CURRENT))).succeeded
+    if synced:
+        print "Error: this repo is updated with 'fab sync' now, use it."
+        return
+
     put(env.repo_file, path)
 
     with cd(path):
@@ -60,6 +69,37 @@ def update():
         # Note: the timestamp is updated by cron
 
 
+@task
+def sync(keep=2, release_id=None, manifest=None):
+    """
+    Update the TUF repo uploading only the changed targets, and switch to
+    them at once. The previous releases are kept on the server.
+    """
+    require('tuf_path', 'tuf_arch', 'hosts', 'port', 'user', 'repo_file')
+
+    if env.tuf_arch not in ['32', '64']:
+        print "Error: invalid parameter, use 32 or 64."
+        return
+
+    if not os.path.isfile(env.repo_file):
+        print "Error: the file does not exist."
+        return
+
+    if env.tuf_arch == '32':
+        arch = 'linux-i386'
+    else:
+        arch = 'linux-x86_64'
+
+    path = os.path.join(env.tuf_path, arch)
+    print arch, env.repo_file, path
+
+    with tufsync.extracted_repo(env.repo_file) as repo_dir:
+        release = tufsync.sync(repo_dir, tufsync.FabricBackend(path),
+                               release_id, int(keep), manifest)
+    # Note: the timestamp is updated by cron
+    print "Switched to", release
+
+
 @task(default=True)
 def help():
     print 'This script is meant to be used to update a TUF remote remository.'
@@ -69,6 +109,9 @@ def help():
     print 'Note: this assumes that you authenticate using the ssh-agent.'
     print
     print 'You should use this as follows:'
+    print '  fab sync[:keep=2]'
+    print 'which uploads only the targets that changed. Once a repo is'
+    print 'updated with sync, the old way of updating it refuses to run:'
     print '  fab update'
 
 
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# delta.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tool to generate binary deltas of the targets against a previous release
+
+For each target that changed since the previous release a delta is written
+to 'targets/deltas/<previous version>/<target>.<method>', if it is small
+enough to be worth it. They are regular targets, so release.py signs them
+with the rest. The 'index.json' in the same folder lists, for each delta,
+the hashes of the file it applies to and of the file it produces. A client
+that can't use a delta downloads the full target as usual.
+
+The deltas are made with bsdiff4 if it is installed, with xdelta3
+otherwise.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+"""
+Targets smaller than this are not worth a delta.
+"""
+MIN_SIZE = 64 * 1024
+
+"""
+A delta is only kept if it is smaller than this fraction of the target.
+"""
+MAX_RATIO = 0.5
+
+DELTAS_DIR = "deltas"
+
+
+def usage():
+    print "Usage:  %s previous_targets targets previous_version" % (
+        sys.argv[0],)
+
+
+def main():
+    if len(sys.argv) < 4:
+        usage()
+        return
+
+    previous_path = sys.argv[1]
+    targets_path = sys.argv[2]
+    previous_version = sys.argv[3]
+    deltas = Deltas(previous_path, targets_path, previous_version)
+    deltas.build()
+    deltas.report()
+
+
+def _sha256(path):
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def _make_delta(args):
+    """
+    Write the delta from old to new at delta_path (without extension) and
+    return the method used and the path written.
+    """
+    old, new, delta_path = args
+    if bsdiff4 is not None:
+        delta_path += ".bsdiff"
+        bsdiff4.file_diff(old, new, delta_path)
+        return "bsdiff", delta_path
+
+    delta_path += ".xdelta"
+    subprocess.check_call(["xdelta3", "-e", "-9", "-f", "-s", old, new,
+                           delta_path])
+    return "xdelta", delta_path
+
+
+class Deltas(object):
+    """
+    Deltas builder class
+    """
+
+    def __init__(self, previous_path, targets_path, previous_version):
+        """
+        Constructor
+
+        :param previous_path: path of the targets of the previous release
+        :type previous_path: str
+        :param targets_path: path of the targets of this release
+        :type targets_path: str
+        :param previous_version: version of the previous release
+        :type previous_version: str
+        """
+        self._previous_path = previous_path
+        self._targets_path = targets_path
+        self._deltas_path = os.path.join(targets_path, DELTAS_DIR,
+                                         previous_version)
+        self._previous_version = previous_version
+        self._index = {}
+
+    def _changed(self):
+        """
+        Return the paths, relative to the targets, of the files that are
+        in both releases and changed between them, with the sha256 of
+        their new and old versions. The index needs both digests, so each
+        file is read once, here.
+
+        :rtype: list of tuple(str, str, str)
+        """
+        changed = []
+        for root, dirs, files in os.walk(self._targets_path):
+            if root == self._targets_path and DELTAS_DIR in dirs:
+                dirs.remove(DELTAS_DIR)
+            dirs.sort()
+            for name in sorted(files):
+                new = os.path.join(root, name)
+                relpath = os.path.relpath(new, self._targets_path)
+                old = os.path.join(self._previous_path, relpath)
+                if (os.path.islink(new) or not os.path.isfile(old) or
+                        os.path.getsize(new) < MIN_SIZE):
+                    continue
+                new_sha256, old_sha256 = _sha256(new), _sha256(old)
+                if new_sha256 != old_sha256:
+                    changed.append((relpath, new_sha256, old_sha256))
+        return changed
+
+    def build(self):
+        """
+        Write the deltas of the changed targets and their index.
+        """
+        changed = self._changed()
+        print "Computing deltas for %d changed targets..." % (len(changed),)
+
+        jobs = []
+        for relpath, _, _ in changed:
+            delta_path = os.path.join(self._deltas_path, relpath)
+            if not os.path.isdir(os.path.dirname(delta_path)):
+                os.makedirs(os.path.dirname(delta_path))
+            jobs.append((os.path.join(self._previous_path, relpath),
+                         os.path.join(self._targets_path, relpath),
+                         delta_path))
+
+        pool = multiprocessing.Pool()
+        try:
+            results = pool.map(_make_delta, jobs)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        for ((relpath, new_sha256, old_sha256), (old, new, _),
+                (method, delta)) in zip(changed, jobs, results):
+            size = os.path.getsize(new)
+            delta_size = os.path.getsize(delta)
+            if delta_size > size * MAX_RATIO:
+                os.remove(delta)
+                delta = None
+
+            self._index[relpath] = {
+                "size": size,
+                "sha256": new_sha256,
+                "from_sha256": old_sha256,
+                "delta": delta and os.path.relpath(delta, self._deltas_path),
+                "method": delta and method,
+                "delta_size": delta and delta_size,
+            }
+
+        if not os.path.isdir(self._deltas_path):
+            os.makedirs(self._deltas_path)
+        with open(os.path.join(self._deltas_path, "index.json"), 'w') as f:
+            json.dump({"from": self._previous_version,
+                       "targets": self._index}, f, indent=2, sort_keys=True)
+
+    def report(self):
+        """
+        Print the bytes that a client updating from the previous release
+        saves by using the deltas.
+        """
+        full = sum(t["size"] for t in self._index.values())
+        with_deltas = sum(t["delta_size"] or t["size"]
+                          for t in self._index.values())
+        print "Update from %s: %d changed targets" % (
+            self._previous_version, len(self._index))
+        for relpath, t in sorted(self._index.items(),
+                                 key=lambda i: -i[1]["size"]):
+            print "  %-50s %10d -> %10s" % (relpath, t["size"],
+                                           t["delta_size"] or "full")
+        print "Full: %d bytes, with deltas: %d bytes, saved %d bytes" % (
+            full, with_deltas, full - with_deltas)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+# pipeline.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The whole TUF release of a bundle, run as `release.py release`
+
+The bundle tarball is read once: each member is written to the targets
+folder and hashed while it goes by, those hashes are given to TUF so the
+targets are not read again. The resulting repo is compressed on the way
+out by a parallel bzip2 when there is one.
+
+Needed files, in the current directory:
+  Bitmask-linux64-0.7.0.tar.bz2  # fresh bundled bundle (or .tar.xz/.zst)
+  tuf_private_key.pem            # private key
+
+Output:
+  workdir/            <-- repo, hash cache
+  +-- output/         <-- here you'll find the resulting compressed repo
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+import urllib2
+
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+
+import tuf.conf
+
+from delta import Deltas
+from release import HashCache, Targets
+
+TUF_ARCHS = {"32": "linux-i386", "64": "linux-x86_64"}
+
+TUF_URLS = {
+    "S": "https://dl.bitmask.net/tuf/{0}/metadata/",
+    "U": "https://dl.bitmask.net/tuf-unstable/{0}/metadata/",
+}
+
+METADATA_FILES = ["root.json", "targets.json", "targets.json.gz",
+                  "snapshot.json", "snapshot.json.gz", "timestamp.json"]
+
+"""
+Bundle extensions and the commands to decompress them, the first one
+available is used.
+"""
+DECOMPRESSORS = [
+    (".tar.bz2", [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]]),
+    (".tar.xz", [["xz", "-T0", "-dc"]]),
+    (".tar.zst", [["zstd", "-dc"]]),
+]
+
+COMPRESSORS = [["lbzip2", "-c"], ["pbzip2", "-c"], ["bzip2", "-c"]]
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def _command(candidates):
+    for command in candidates:
+        if find_executable(command[0]) is not None:
+            return command
+    raise RuntimeError("None of %s is installed" % (
+        ", ".join(c[0] for c in candidates),))
+
+
+def _find_bundle(base, name):
+    """
+    Return the path of the tarball of the bundle called name and the
+    command to decompress it.
+    """
+    for extension, decompressors in DECOMPRESSORS:
+        path = os.path.join(base, name + extension)
+        if os.path.isfile(path):
+            return path, _command(decompressors)
+    raise IOError("There is no tarball for %s in %s" % (name, base))
+
+
+@contextmanager
+def _open_tarball(path, decompressor):
+    """
+    Open the tarball at path as a stream, decompressed by another process.
+    """
+    with open(path, 'rb') as f:
+        proc = subprocess.Popen(decompressor, stdin=f,
+                                stdout=subprocess.PIPE)
+        try:
+            yield tarfile.open(fileobj=proc.stdout, mode="r|")
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise RuntimeError("%s failed on %s" % (decompressor[0],
+                                                         path))
+
+
+def _extract(path, decompressor, dest, algorithms=(), exclude=()):
+    """
+    Extract what is inside the top folder of the tarball at path to dest,
+    hashing the files while they are written.
+
+    :param exclude: names of the entries of the top folder to leave out
+    :type exclude: tuple of str
+    :return: the hashes of each file written, by algorithm
+    :rtype: dict
+    """
+    hashes = {}
+    dirs = []
+    with _open_tarball(path, decompressor) as tar:
+        for member in tar:
+            parts = member.name.split("/", 1)
+            if len(parts) < 2 or not parts[1]:
+                continue  # the top folder itself
+            name = os.path.normpath(parts[1])
+            if name.startswith("..") or os.path.isabs(name):
+                raise ValueError("Bad path in tarball: %s" % (member.name,))
+            if name.split(os.sep)[0] in exclude:
+                continue
+
+            target = os.path.join(dest, name)
+            if member.isdir():
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                dirs.append((target, member))
+                continue
+
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if os.path.lexists(target):
+                os.remove(target)
+
+            if member.issym():
+                os.symlink(member.linkname, target)
+                continue
+            if member.islnk():
+                source = os.path.join(
+                    dest, os.path.normpath(member.linkname.split("/", 1)[1]))
+                os.link(source, target)
+                if source in hashes:
+                    hashes[target] = hashes[source]
+                continue
+            if not member.isfile():
+                continue
+
+            digests = [hashlib.new(a) for a in algorithms]
+            fileobj = tar.extractfile(member)
+            with open(target, 'wb') as f:
+                for chunk in iter(lambda: fileobj.read(BUFFER_SIZE), ''):
+                    f.write(chunk)
+                    for d in digests:
+                        d.update(chunk)
+            os.chmod(target, member.mode)
+            os.utime(target, (member.mtime, member.mtime))
+            hashes[target] = dict((a, d.hexdigest())
+                                  for a, d in zip(algorithms, digests))
+
+    # the times of the folders, once nothing else is written in them
+    for target, member in reversed(dirs):
+        os.chmod(target, member.mode)
+        os.utime(target, (member.mtime, member.mtime))
+    return hashes
+
+
+def _fetch_metadata(url, dest):
+    """
+    Download the metadata of the published repo at url.
+    """
+    for name in METADATA_FILES:
+        try:
+            response = urllib2.urlopen(url + name)
+        except urllib2.HTTPError as e:
+            if e.code == 404 and name.endswith(".gz"):
+                continue
+            raise
+        with open(os.path.join(dest, name), 'wb') as f:
+            shutil.copyfileobj(response, f)
+
+
+def _extract_metadata(repo_file, dest):
+    """
+    Extract the metadata.staged folder of a repo .tar.gz file.
+    """
+    tar = tarfile.open(repo_file, "r:gz")
+    try:
+        for member in tar:
+            if (member.isfile() and
+                    member.name.startswith("repo/metadata.staged/")):
+                fileobj = tar.extractfile(member)
+                with open(os.path.join(dest, os.path.basename(member.name)),
+                          'wb') as f:
+                    shutil.copyfileobj(fileobj, f, BUFFER_SIZE)
+    finally:
+        tar.close()
+
+
+def _compress_repo(repo_path, out_path):
+    """
+    Write the repo to out_path as a .tar.bz2, compressed by another
+    process.
+    """
+    with open(out_path, 'wb') as f:
+        proc = subprocess.Popen(_command(COMPRESSORS), stdin=subprocess.PIPE,
+                                stdout=f)
+        try:
+            tar = tarfile.open(fileobj=proc.stdin, mode="w|")
+            tar.add(repo_path, "repo")
+            tar.close()
+        finally:
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise RuntimeError("Could not compress %s" % (out_path,))
+
+
+def _sha256(path):
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), ''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="release.py release",
+        description="Do the TUF release of a bundle.")
+    parser.add_argument('-a', dest="arch", choices=sorted(TUF_ARCHS),
+                        default="64", help="do the release for that arch")
+    parser.add_argument('-v', dest="version", required=True,
+                        help="version of the bundle to release")
+    parser.add_argument('-k', dest="key_file", required=True,
+                        help="use this key file to sign the release")
+    parser.add_argument('-R', dest="web_repo", choices=sorted(TUF_URLS),
+                        required=True,
+                        help="use the (S)table or (U)nstable TUF web repo")
+    parser.add_argument('-r', dest="repo_file",
+                        help="take the metadata from this repo .tar.gz "
+                             "instead of the web repo")
+    parser.add_argument('-p', dest="previous",
+                        help="add binary deltas from this previous version, "
+                             "its bundle must be here too")
+    parser.add_argument('-m', dest="manifest",
+                        help="don't hash the bundle while it is extracted, "
+                             "check this MANIFEST.sha256 of its build "
+                             "against the cached hashes and hash the "
+                             "targets that don't match them")
+    parser.add_argument('--workdir', default="workdir",
+                        help="where the repo is built")
+    args = parser.parse_args(argv)
+
+    base = os.getcwd()
+    workdir = os.path.realpath(args.workdir)
+    key_file = os.path.realpath(args.key_file)
+    bitmask = "Bitmask-linux%s-%s" % (args.arch, args.version)
+    bundle, decompressor = _find_bundle(base, bitmask)
+
+    print "---------- settings ----------"
+    print "Arch: %s" % (args.arch,)
+    print "Key: %s" % (key_file,)
+    print "Repo: %s" % (args.repo_file or "",)
+    print "Version: %s" % (args.version,)
+    print "Web repo: %s" % (args.web_repo,)
+    print "Deltas from: %s" % (args.previous or "",)
+    print "Manifest: %s" % (args.manifest or "",)
+    print "--------------------"
+
+    repo = os.path.join(workdir, "repo")
+    metadata = os.path.join(repo, "metadata.staged")
+    targets = os.path.join(repo, "targets")
+    if os.path.isdir(repo):
+        shutil.rmtree(repo)
+    os.makedirs(metadata)
+
+    if args.repo_file is None:
+        print "-> Downloading metadata files from the old bundle..."
+        url = TUF_URLS[args.web_repo].format(TUF_ARCHS[args.arch])
+        _fetch_metadata(url, metadata)
+    else:
+        print "-> Extracting metadata files from the repo file..."
+        _extract_metadata(os.path.realpath(args.repo_file), metadata)
+
+    algorithms = tuf.conf.REPOSITORY_HASH_ALGORITHMS
+    if args.manifest is not None and list(algorithms) == ['sha256']:
+        print "-> Extracting the bundle..."
+        algorithms = ()
+    else:
+        print "-> Extracting and hashing the bundle..."
+    # we must not add the repo/ folder of the bundle to the tuf repo
+    hashes = _extract(bundle, decompressor, targets, algorithms, ("repo",))
+    cache_path = os.path.join(workdir, "target-hashes-%s.json" % (args.arch,))
+    cache = HashCache(cache_path, targets)
+    if not algorithms:
+        print "%d targets of the manifest checked, %d disagree" % (
+            cache.add_manifest(os.path.realpath(args.manifest)))
+    else:
+        for path, file_hashes in hashes.items():
+            cache.add(path, file_hashes)
+    cache.save()
+
+    if args.previous is not None:
+        print "-> Computing deltas from %s..." % (args.previous,)
+        previous_bitmask = "Bitmask-linux%s-%s" % (args.arch, args.previous)
+        previous_bundle, previous_decompressor = _find_bundle(
+            base, previous_bitmask)
+        previous = os.path.join(workdir, "previous")
+        if os.path.isdir(previous):
+            shutil.rmtree(previous)
+        _extract(previous_bundle, previous_decompressor, previous)
+        deltas = Deltas(previous, targets, args.previous)
+        deltas.build()
+        deltas.report()
+        shutil.rmtree(previous)
+
+    print "-> Doing release magic..."
+    Targets(repo, key_file, cache_path).build()
+
+    print "-> Creating output file..."
+    output = os.path.join(workdir, "output")
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    out_path = os.path.join(output, bitmask + "-tuf.tar.bz2")
+    _compress_repo(repo, out_path)
+
+    print "TUF release complete."
+    print "You can find the resulting file in:"
+    print out_path
+    print "%s  %s" % (_sha256(out_path), out_path)
@@ -21,12 +21,23 @@ Tool to generate TUF related files after a release
 The 'repo' folder should contain two folders:
   - 'metadata.staged' with all the jsons from the previows release
   - 'targets' where the release targets are
+
+The hashes of the targets are kept in a cache file between releases, only
+the targets that changed since the last release are read. The
+MANIFEST.sha256 that the bundler writes can be checked against the cached
+hashes, the signed metadata only gets the hashes computed here.
 """
 
 import datetime
+import hashlib
+import json
+import multiprocessing
 import os.path
 import sys
 
+import tuf.conf
+import tuf.util
+
 from tuf.repository_tool import load_repository
 from tuf.repository_tool import import_rsa_privatekey_from_file
 
@@ -36,31 +47,200 @@ of days the TUF client won't accept this files.
 """
 EXPIRATION_DAYS = 90
 
+"""
+Default name of the hash cache, it is kept next to the repo folder.
+"""
+HASH_CACHE = "target-hashes.json"
+
 
 def usage():
-    print "Usage:  %s repo key" % (sys.argv[0],)
+    print "Usage:  %s repo key [hash_cache [manifest]]" % (sys.argv[0],)
+    print "        %s release [options]  (see release -h)" % (sys.argv[0],)
 
 
 def main():
+    if sys.argv[1:2] == ["release"]:
+        import pipeline
+        pipeline.main(sys.argv[2:])
+        return
+
     if len(sys.argv) < 3:
         usage()
         return
 
     repo_path = sys.argv[1]
     key_path = sys.argv[2]
-    targets = Targets(repo_path, key_path)
+    cache_path = None
+    if len(sys.argv) > 3:
+        cache_path = sys.argv[3]
+    manifest_path = None
+    if len(sys.argv) > 4:
+        manifest_path = sys.argv[4]
+    targets = Targets(repo_path, key_path, cache_path, manifest_path)
     targets.build()
 
     print "%s/metadata.staged/(targets|snapshot).json[.gz] are ready" % \
           (repo_path,)
 
 
+def _hash_file(args):
+    """
+    Return the path, size and hashes of a file, the hashes are a dict by
+    algorithm like the ones that TUF computes.
+    """
+    path, algorithms = args
+    digests = [hashlib.new(a) for a in algorithms]
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            size += len(chunk)
+            for d in digests:
+                d.update(chunk)
+    return path, size, dict((a, d.hexdigest())
+                            for a, d in zip(algorithms, digests))
+
+
+class HashCache(object):
+    """
+    Hashes of the targets, by path relative to the targets folder.
+
+    A cached hash is used while the size and modification time of the file
+    don't change. The inode is not used: the targets are extracted again
+    from the bundle tarball on each release, which keeps the times.
+    """
+
+    def __init__(self, path, targets_path):
+        """
+        Constructor
+
+        :param path: file where the cache is kept
+        :type path: str
+        :param targets_path: path of the targets folder
+        :type targets_path: str
+        """
+        self._path = path
+        self._targets_path = os.path.abspath(targets_path)
+        self._entries = {}
+        self._hashes = {}
+        try:
+            with open(path, 'r') as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self._targets_path)
+
+    def _stamp(self, path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime]
+
+    def update(self, paths, algorithms):
+        """
+        Hash the files of paths that are not cached yet, in parallel.
+        """
+        missing = []
+        for path in paths:
+            entry = self._entries.get(self._key(path))
+            if (entry is None or entry[0] != self._stamp(path) or
+                    not set(algorithms) <= set(entry[1])):
+                missing.append(path)
+            else:
+                self._hashes[os.path.abspath(path)] = entry
+
+        print "Hashing %d of %d targets..." % (len(missing), len(paths))
+        if not missing:
+            return
+        pool = multiprocessing.Pool()
+        try:
+            jobs = [(path, algorithms) for path in missing]
+            for path, size, hashes in pool.imap_unordered(_hash_file, jobs,
+                                                          chunksize=16):
+                entry = [self._stamp(path), hashes]
+                self._entries[self._key(path)] = entry
+                self._hashes[os.path.abspath(path)] = entry
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def add(self, path, hashes):
+        """
+        Keep the hashes of path, computed somewhere else (e.g. while the
+        file was written).
+        """
+        entry = [self._stamp(path), hashes]
+        self._entries[self._key(path)] = entry
+        self._hashes[os.path.abspath(path)] = entry
+
+    def add_manifest(self, manifest_path):
+        """
+        Check the targets listed in the manifest at manifest_path against
+        the cache, its lines have the sha256, size, mode and path relative
+        to the targets folder of each file.
+
+        The manifest is not trusted, its digests end up in the signed
+        targets metadata only through the cache: an entry is accepted if
+        this cache hashed the file itself, with the same size and
+        modification time it has now, and got the same sha256. The cached
+        hashes that disagree with the manifest are dropped, every target
+        that isn't accepted is hashed again by update.
+
+        :return: the amount of targets accepted and of the ones whose
+                 cached hash disagrees with the manifest
+        :rtype: tuple(int, int)
+        """
+        accepted, disagree = 0, 0
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                digest, size, mode, relpath = line.rstrip("\n").split(" ", 3)
+                path = os.path.join(self._targets_path, relpath)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if (st.st_size != int(size) or
+                        st.st_mode & 07777 != int(mode, 8)):
+                    continue
+                key = self._key(path)
+                entry = self._entries.get(key)
+                if entry is None or entry[0] != self._stamp(path):
+                    continue
+                if entry[1].get('sha256') != digest:
+                    print "The manifest disagrees on %s, hashing it" % (
+                        relpath,)
+                    del self._entries[key]
+                    disagree += 1
+                    continue
+                self._hashes[os.path.abspath(path)] = entry
+                accepted += 1
+        return accepted, disagree
+
+    def get(self, path, algorithms):
+        """
+        Return the size and hashes of path if they are known and the file
+        didn't change, None otherwise.
+        """
+        entry = self._hashes.get(os.path.abspath(path))
+        if entry is None or entry[0] != self._stamp(path):
+            return None
+        if not set(algorithms) <= set(entry[1]):
+            return None
+        return entry[0][0], dict((a, entry[1][a]) for a in algorithms)
+
+    def save(self):
+        # forget the targets that are gone
+        entries = dict((self._key(p), e) for p, e in self._hashes.items())
+        with open(self._path, 'w') as f:
+            json.dump(entries, f)
+
+
 class Targets(object):
     """
     Targets builder class
     """
 
-    def __init__(self, repo_path, key_path):
+    def __init__(self, repo_path, key_path, cache_path=None,
+                 manifest_path=None):
         """
         Constructor
 
@@ -68,9 +248,23 @@ class Targets(object):
         :type repo_path: str
         :param key_path: path where the private targets key lives
         :type key_path: str
+        :param cache_path: file where the hashes of the targets are kept,
+                           HASH_CACHE next to the repo if None
+        :type cache_path: str
+        :param manifest_path: MANIFEST.sha256 of the bundle, to check the
+                              cached hashes of the targets against
+        :type manifest_path: str
         """
         self._repo_path = repo_path
         self._key = import_rsa_privatekey_from_file(key_path)
+        if cache_path is None:
+            cache_path = os.path.join(
+                os.path.dirname(os.path.abspath(repo_path)), HASH_CACHE)
+        self._cache = HashCache(cache_path,
+                                os.path.join(repo_path, 'targets'))
+        if manifest_path is not None:
+            print "%d targets of the manifest checked, %d disagree" % (
+                self._cache.add_manifest(manifest_path))
 
     def build(self):
         """
@@ -89,7 +283,23 @@ class Targets(object):
         self._repo.targets.expiration = (
             datetime.datetime.now() +
             datetime.timedelta(days=EXPIRATION_DAYS))
-        self._repo.write_partial()
+
+        # TUF hashes every target while writing targets.json, give it the
+        # hashes that we already have instead
+        get_file_details = tuf.util.get_file_details
+
+        def cached_file_details(filepath, hash_algorithms=['sha256']):
+            details = self._cache.get(filepath, hash_algorithms)
+            if details is None:
+                return get_file_details(filepath, hash_algorithms)
+            return details
+
+        tuf.util.get_file_details = cached_file_details
+        try:
+            self._repo.write_partial()
+        finally:
+            tuf.util.get_file_details = get_file_details
+        self._cache.save()
 
     def _load_targets(self):
         """
@@ -102,6 +312,7 @@ class Targets(object):
             followlinks=True)
 
         self._remove_obsolete_targets(target_list)
+        self._cache.update(target_list, tuf.conf.REPOSITORY_HASH_ALGORITHMS)
 
         for target in target_list:
             octal_file_permissions = oct(os.stat(target).st_mode)[3:]
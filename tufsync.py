@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Update a TUF repo on the server uploading only the targets that changed.
+
+Each update goes to its own folder, releases/<time>-<id>, next to the
+served names:
+
+  current -> releases/<time>-<id>
+  targets -> current/targets
+  metadata -> current/metadata
+  metadata.staged -> current/metadata.staged
+  releases/<time>-<id>/MANIFEST.sha256
+
+The targets that didn't change since the current release are hardlinked
+from it, the rest are uploaded in a single tarball. Once the new release
+is complete the `current` symlink is replaced by a rename, so the clients
+see either the old targets and metadata or the new ones, never a mix.
+
+The manifest of each release has a "sha256 size mode path" line for each
+target, like the MANIFEST.sha256 written by the bundler. A server still in
+the old layout (real targets and metadata folders) is hashed once and
+moved to the new one by the first update.
+
+Usage:  tufsync.py repo_file dest [--release-id ID] [--keep N]
+to update a repo on the local filesystem, `fab sync` does it on the server.
+"""
+import argparse
+import hashlib
+import os
+import pipes
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+
+MANIFEST = "MANIFEST.sha256"
+
+CURRENT = "current"
+RELEASES = "releases"
+
+# the names served, they point inside the current release
+SERVED = ("targets", "metadata", "metadata.staged")
+
+# the metadata that comes from the new repo, the rest (root.json and the
+# timestamp.json written by cron) is kept from the current release
+UPDATED_METADATA = ("targets.json", "snapshot.json")
+
+BUFFER_SIZE = 1024 * 1024
+
+# the repo tarball may have several bz2 streams (pbzip2), python's bz2
+# module only reads the first one
+DECOMPRESSORS = [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]]
+
+
+def _sha256(path):
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), ''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def parse_manifest(data):
+    """
+    Return the entries of the manifest in data by path, as (sha256, size,
+    mode) tuples.
+
+    :rtype: dict
+    """
+    entries = {}
+    for line in data.splitlines():
+        if not line:
+            continue
+        digest, size, mode, path = line.split(" ", 3)
+        entries[path] = (digest, int(size), int(mode, 8))
+    return entries
+
+
+def format_manifest(entries):
+    return "".join("{0} {1} {2:04o} {3}\n".format(digest, size, mode, path)
+                   for path, (digest, size, mode) in sorted(entries.items()))
+
+
+def local_manifest(root, manifest_path=None):
+    """
+    Return the manifest of the files under root. The digests of the ones
+    listed with the same size and mode in the manifest at manifest_path
+    (e.g. the MANIFEST.sha256 of the bundle) are taken from it, the other
+    files are hashed.
+
+    :rtype: dict
+    """
+    known = {}
+    if manifest_path is not None:
+        with open(manifest_path, 'r') as f:
+            known = parse_manifest(f.read())
+
+    entries = {}
+    for dirpath, dirs, files in os.walk(root, followlinks=True):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, root).replace(os.sep, "/")
+            st = os.stat(path)
+            mode = st.st_mode & 07777
+            entry = known.get(relpath)
+            if entry is None or entry[1:] != (st.st_size, mode):
+                entry = (_sha256(path), st.st_size, mode)
+            entries[relpath] = entry
+    return entries
+
+
+def diff_manifests(old, new):
+    """
+    Return the paths of new that can be kept from old, the ones to
+    upload and the paths of old that are gone.
+
+    :rtype: tuple(list of str, list of str, list of str)
+    """
+    same = sorted(p for p, e in new.items() if old.get(p) == e)
+    changed = sorted(p for p, e in new.items() if old.get(p) != e)
+    removed = sorted(p for p in old if p not in new)
+    return same, changed, removed
+
+
+@contextmanager
+def extracted_repo(repo_file):
+    """
+    Extract the repo tarball made by `release.py release`, its top folder
+    holds metadata.staged and targets, and yield where.
+    """
+    decompressor = None
+    for command in DECOMPRESSORS:
+        if find_executable(command[0]) is not None:
+            decompressor = command
+            break
+    if decompressor is None:
+        raise RuntimeError("None of %s is installed" % (
+            ", ".join(c[0] for c in DECOMPRESSORS),))
+
+    tmp = tempfile.mkdtemp(prefix="tufsync-")
+    try:
+        with open(repo_file, 'rb') as f:
+            proc = subprocess.Popen(decompressor, stdin=f,
+                                    stdout=subprocess.PIPE)
+            try:
+                tar = tarfile.open(fileobj=proc.stdout, mode="r|")
+                tar.extractall(tmp)
+                tar.close()
+            finally:
+                proc.stdout.close()
+                if proc.wait() != 0:
+                    raise RuntimeError("%s failed on %s" % (decompressor[0],
+                                                             repo_file))
+        names = [n for n in os.listdir(tmp)
+                 if os.path.isdir(os.path.join(tmp, n))]
+        if len(names) != 1:
+            raise ValueError("Expected one top folder in %s" %
+                             (repo_file,))
+        yield os.path.join(tmp, names[0])
+    finally:
+        shutil.rmtree(tmp)
+
+
+class LocalBackend(object):
+    """
+    A repo on the local filesystem, paths are relative to its root.
+    """
+
+    def __init__(self, root):
+        self._root = os.path.abspath(root)
+
+    def _path(self, path):
+        return os.path.join(self._root, path)
+
+    def exists(self, path):
+        return os.path.lexists(self._path(path))
+
+    def readlink(self, path):
+        """
+        Return the target of the symlink at path, None if it is not one.
+        """
+        if not os.path.islink(self._path(path)):
+            return None
+        return os.readlink(self._path(path))
+
+    def listdir(self, path):
+        if not os.path.isdir(self._path(path)):
+            return []
+        return sorted(os.listdir(self._path(path)))
+
+    def read(self, path):
+        """
+        Return the contents of the file at path, None if there is none.
+        """
+        try:
+            with open(self._path(path), 'r') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def write(self, path, data):
+        with open(self._path(path), 'w') as f:
+            f.write(data)
+
+    def mkdir_p(self, path):
+        if not os.path.isdir(self._path(path)):
+            os.makedirs(self._path(path))
+
+    def rm_rf(self, path):
+        if os.path.isdir(self._path(path)) and \
+                not os.path.islink(self._path(path)):
+            shutil.rmtree(self._path(path))
+        elif os.path.lexists(self._path(path)):
+            os.remove(self._path(path))
+
+    def remove(self, base, paths):
+        for path in paths:
+            self.rm_rf(os.path.join(base, path))
+
+    def link_tree(self, src, dst):
+        """
+        Make dst a copy of the tree src with hardlinks, like `cp -al`.
+        """
+        src = os.path.realpath(self._path(src))
+        for dirpath, dirs, files in os.walk(src):
+            dest = os.path.join(self._path(dst), os.path.relpath(dirpath,
+                                                                 src))
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            for name in files:
+                os.link(os.path.join(dirpath, name), os.path.join(dest, name))
+
+    def copy_tree(self, src, dst):
+        shutil.copytree(os.path.realpath(self._path(src)), self._path(dst),
+                        symlinks=True)
+
+    def rename(self, src, dst):
+        os.rename(self._path(src), self._path(dst))
+
+    def upload(self, local_root, paths, dst):
+        """
+        Copy the files of paths, relative to local_root, into dst.
+        """
+        for path in paths:
+            target = os.path.join(self._path(dst), path)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copy2(os.path.join(local_root, path), target)
+
+    def manifest(self, path):
+        return local_manifest(self._path(path))
+
+    def make_group_writable(self, path):
+        for dirpath, dirs, files in os.walk(self._path(path)):
+            for name in dirs + files + ["."]:
+                target = os.path.join(dirpath, name)
+                try:
+                    os.chmod(target, os.stat(target).st_mode | 0020)
+                except OSError:
+                    pass
+
+    def flip(self, name, target):
+        """
+        Point the symlink name to target, replacing what name was with a
+        rename so it is never missing.
+        """
+        tmp = self._path(name + ".new")
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(target, tmp)
+        os.rename(tmp, self._path(name))
+
+
+class FabricBackend(LocalBackend):
+    """
+    A repo on the server of the current fabric env, paths are relative to
+    its root. Needs fabric.
+    """
+
+    def __init__(self, root):
+        from fabric import api
+        self._api = api
+        self._root = root
+
+    def _run(self, command, warn_only=False):
+        with self._api.settings(self._api.hide('output'),
+                                warn_only=warn_only):
+            return self._api.run(command)
+
+    def _q(self, path):
+        return pipes.quote(self._path(path))
+
+    def exists(self, path):
+        return self._run("test -e {0} -o -L {0}".format(self._q(path)),
+                         warn_only=True).succeeded
+
+    def readlink(self, path):
+        result = self._run("readlink {0}".format(self._q(path)),
+                           warn_only=True)
+        if not result.succeeded:
+            return None
+        return result.strip()
+
+    def listdir(self, path):
+        result = self._run("ls -1 {0}".format(self._q(path)), warn_only=True)
+        if not result.succeeded:
+            return []
+        return sorted(result.splitlines())
+
+    def read(self, path):
+        result = self._run("cat {0}".format(self._q(path)), warn_only=True)
+        if not result.succeeded:
+            return None
+        return result.replace("\r\n", "\n") + "\n"
+
+    def write(self, path, data):
+        fd, tmp = tempfile.mkstemp(prefix="tufsync-")
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        try:
+            self._api.put(tmp, self._path(path))
+        finally:
+            os.remove(tmp)
+
+    def mkdir_p(self, path):
+        self._run("mkdir -p {0}".format(self._q(path)))
+
+    def rm_rf(self, path):
+        self._run("rm -rf {0}".format(self._q(path)))
+
+    def remove(self, base, paths):
+        if paths:
+            self.write(base + ".remove", "\0".join(paths))
+            self._run("cd {0} && xargs -0 rm -f < {1} && rm {1}".format(
+                self._q(base), self._q(base + ".remove")))
+
+    def link_tree(self, src, dst):
+        self._run("cp -al {0}/ {1}".format(self._q(src), self._q(dst)))
+
+    def copy_tree(self, src, dst):
+        self._run("cp -a {0}/ {1}".format(self._q(src), self._q(dst)))
+
+    def rename(self, src, dst):
+        self._run("mv -T {0} {1}".format(self._q(src), self._q(dst)))
+
+    def upload(self, local_root, paths, dst):
+        """
+        Upload the files of paths, relative to local_root, into dst in a
+        single tarball.
+        """
+        self.mkdir_p(dst)
+        if not paths:
+            return
+        fd, tmp = tempfile.mkstemp(prefix="tufsync-", suffix=".tar.gz")
+        os.close(fd)
+        try:
+            with tarfile.open(tmp, "w:gz") as tar:
+                for path in paths:
+                    tar.add(os.path.join(local_root, path), path)
+            remote = dst + ".upload.tar.gz"
+            self._api.put(tmp, self._path(remote))
+        finally:
+            os.remove(tmp)
+        self._run("tar xzf {0} -C {1} && rm {0}".format(self._q(remote),
+                                                        self._q(dst)))
+
+    def manifest(self, path):
+        sizes = self._run("cd {0} && find . -type f -printf '%s %m %P\\n'"
+                          .format(self._q(path)))
+        sums = self._run("cd {0} && find . -type f -exec sha256sum {{}} +"
+                         .format(self._q(path)))
+        digests = {}
+        for line in sums.splitlines():
+            digest, name = line.split("  ", 1)
+            digests[os.path.normpath(name)] = digest
+        entries = {}
+        for line in sizes.splitlines():
+            size, mode, name = line.split(" ", 2)
+            entries[name] = (digests[name], int(size), int(mode, 8))
+        return entries
+
+    def make_group_writable(self, path):
+        # '|| true' is a hack to avoid permissions problems
+        self._run("chmod g+w -f -R {0} || true".format(self._q(path)))
+
+    def flip(self, name, target):
+        self._run("ln -sfn {0} {1} && mv -Tf {1} {2}".format(
+            pipes.quote(target), self._q(name + ".new"), self._q(name)))
+
+
+def _release_path(release_id=None):
+    # by time first, so they sort from the oldest to the newest
+    name = time.strftime("%Y%m%d%H%M%S")
+    if release_id is not None:
+        name += "-" + release_id
+    return os.path.join(RELEASES, name)
+
+
+def _migrate(backend):
+    """
+    Move a repo in the old layout, with real folders, to a release and
+    point the served names to it.
+    """
+    release = _release_path("initial")
+    print "-> Moving the current repo to", release
+    backend.mkdir_p(release)
+    backend.flip(CURRENT, release)
+    for name in SERVED:
+        if backend.exists(name):
+            # the name is missing between these two renames
+            backend.rename(name, os.path.join(release, name))
+            backend.flip(name, os.path.join(CURRENT, name))
+    return release
+
+
+def sync(repo_dir, backend, release_id=None, keep=2, manifest_path=None):
+    """
+    Make the repo at repo_dir, with its metadata.staged and targets, the
+    current release of backend.
+
+    :param release_id: name of the new release, added to the time
+    :type release_id: str
+    :param keep: how many of the previous releases to keep
+    :type keep: int
+    :param manifest_path: MANIFEST.sha256 of the bundle, to take the
+                          hashes of the targets from
+    :type manifest_path: str
+    :return: the path of the new release
+    :rtype: str
+    """
+    release = _release_path(release_id)
+    if backend.exists(release):
+        raise ValueError("The release %s already exists" % (release,))
+
+    local_targets = os.path.join(repo_dir, "targets")
+    print "-> Hashing the local targets..."
+    local = local_manifest(local_targets, manifest_path)
+
+    current = backend.readlink(CURRENT)
+    if current is None:
+        current = _migrate(backend)
+    remote = backend.read(os.path.join(current, MANIFEST))
+    if remote is None:
+        print "-> Hashing the remote targets..."
+        remote = backend.manifest(os.path.join(current, "targets"))
+    else:
+        remote = parse_manifest(remote)
+
+    same, changed, removed = diff_manifests(remote, local)
+    print "%d targets unchanged, %d to upload, %d removed" % (
+        len(same), len(changed), len(removed))
+
+    print "-> Preparing", release
+    backend.mkdir_p(RELEASES)
+    targets = os.path.join(release, "targets")
+    backend.link_tree(os.path.join(current, "targets"), targets)
+    # never write through a hardlink of the current release
+    backend.remove(targets, [p for p in changed if p in remote] + removed)
+    backend.upload(local_targets, changed, targets)
+
+    metadata = os.path.join(release, "metadata")
+    backend.copy_tree(os.path.join(current, "metadata"), metadata)
+    staged = os.path.join(repo_dir, "metadata.staged")
+    staged_names = sorted(os.listdir(staged))
+    backend.upload(staged, staged_names, os.path.join(release,
+                                                      "metadata.staged"))
+    updated = [n for n in staged_names
+               if n.split(".json")[0] + ".json" in UPDATED_METADATA]
+    backend.remove(metadata, updated)
+    backend.upload(staged, updated, metadata)
+    backend.write(os.path.join(release, MANIFEST), format_manifest(local))
+    # cron writes the timestamp from metadata.staged
+    backend.make_group_writable(os.path.join(release, "metadata.staged"))
+    backend.make_group_writable(metadata)
+
+    print "-> Switching to", release
+    backend.flip(CURRENT, release)
+
+    old = sorted((os.path.join(RELEASES, n)
+                  for n in backend.listdir(RELEASES)
+                  if os.path.join(RELEASES, n) != release), reverse=True)
+    for path in old[keep:]:
+        print "-> Removing", path
+        backend.rm_rf(path)
+    return release
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Update a TUF repo on the local filesystem uploading "
+                    "only the changed targets.")
+    parser.add_argument('repo_file',
+                        help="the repo tarball made by `release.py release`")
+    parser.add_argument('dest', help="the root of the served repo")
+    parser.add_argument('--release-id',
+                        help="name of the new release, added to the time")
+    parser.add_argument('--keep', type=int, default=2,
+                        help="how many of the previous releases to keep")
+    parser.add_argument('--manifest',
+                        help="MANIFEST.sha256 of the bundle, to take the "
+                             "hashes of the targets from")
+    args = parser.parse_args()
+
+    with extracted_repo(args.repo_file) as repo_dir:
+        sync(repo_dir, LocalBackend(args.dest), args.release_id, args.keep,
+             args.manifest)
+
+
+if __name__ == "__main__":
+    main()